@@ -0,0 +1,5 @@
+import sys
+
+import fhtbioinfpy.cli as cli
+
+sys.exit(cli.main())
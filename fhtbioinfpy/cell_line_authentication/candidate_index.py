@@ -0,0 +1,126 @@
+"""
+truncated SVD index of the standardized reference columns, for a cheap candidate search before exact correlation.
+With the standardized reference Z = U S V^T, the pearson correlation of a standardized query column q with every
+reference column is q^T Z; keeping the first n_components singular vectors approximates it as (U_k^T q)^T (S_k V_k^T),
+a product over n_components instead of every gene. cell_line_correlation --pca_candidates takes the best candidates
+of that approximation and reranks only them exactly. The index is built once per compiled reference store with this
+module and saved next to its standardized data; it is only used while the store it was built from is unchanged.
+"""
+import logging
+import fhtbioinfpy.setup_logger as setup_logger
+import argparse
+import sys
+import collections
+
+import os
+import pandas as pd
+import numpy
+import fhtbioinfpy.cell_line_authentication.reference_store as reference_store
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+PCA_INDEX_FILENAME = "pca_index.npz"
+DEFAULT_N_COMPONENTS = 50
+
+# genes / columns: labels of the indexed reference, components: U_k (genes x n_components),
+# ref_coords: S_k V_k^T (n_components x columns), singular_values: all singular values, to judge the truncation
+CandidateIndex = collections.namedtuple("CandidateIndex", ["genes", "columns", "components", "ref_coords", "singular_values"])
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--verbose", "-v", help="Whether to print a bunch of output.", action="store_true", default=False)
+    parser.add_argument("--ref_store_dir", help="compiled reference store (see reference_store) to build the index for", type=str, required = True)
+    parser.add_argument("--n_components", help="number of singular vectors kept", type=int, default=DEFAULT_N_COMPONENTS)
+    return parser
+
+
+# truncated SVD of the standardized reference (genes x columns, columns already mean-centered and unit norm)
+def build_candidate_index(ref_std_df, n_components=DEFAULT_N_COMPONENTS):
+    u, s, vt = numpy.linalg.svd(numpy.asarray(ref_std_df.to_numpy(), dtype=numpy.float64), full_matrices=False)
+    n_components = min(n_components, len(s))
+    logger.debug("fraction of the reference variance kept by {} components: {}".format(
+        n_components, (s[:n_components]**2).sum() / (s**2).sum()))
+    return CandidateIndex(ref_std_df.index.to_numpy(), ref_std_df.columns.to_numpy(), u[:, :n_components],
+        s[:n_components, numpy.newaxis] * vt[:n_components], s)
+
+
+# saves the index in store_dir with the fingerprint of the store it was built from
+def save_candidate_index(index, store_dir):
+    index_filepath = os.path.join(store_dir, PCA_INDEX_FILENAME)
+    numpy.savez(index_filepath, genes=index.genes.astype(str), columns=index.columns.astype(str),
+        components=index.components, ref_coords=index.ref_coords, singular_values=index.singular_values,
+        reference_fingerprint=reference_store.reference_fingerprint(store_dir))
+    return index_filepath
+
+
+# the index saved in a compiled reference store, or None when the path is not a store, has no index, or the store was
+# recompiled since the index was built
+def load_candidate_index(store_dir):
+    index_filepath = os.path.join(store_dir, PCA_INDEX_FILENAME)
+    if not (reference_store.is_reference_store(store_dir) and os.path.isfile(index_filepath)):
+        return None
+    with numpy.load(index_filepath) as saved:
+        saved_fingerprint = str(saved["reference_fingerprint"]) if "reference_fingerprint" in saved.files else None
+        if saved_fingerprint != reference_store.reference_fingerprint(store_dir):
+            logger.warning("the candidate index of {} was built from another version of the store, rebuild it with candidate_index".format(store_dir))
+            return None
+        return CandidateIndex(saved["genes"].astype(object), saved["columns"].astype(object), saved["components"],
+            saved["ref_coords"], saved["singular_values"])
+
+
+# the n_candidates reference column positions per query column with the highest approximate correlation. The query is
+# standardized over its matched genes and projected with the components of those genes only
+def select_candidates(subset_query_expr, index, n_candidates):
+    if n_candidates < 1:
+        msg = "\n!!!\nn_candidates must be at least 1, got {}: without candidates every correlation would be nan.\n".format(n_candidates)
+        logger.exception(msg)
+        raise FhtbioinfpyCandidateIndexNoCandidates(msg)
+    gene_positions = pd.Index(index.genes).get_indexer(subset_query_expr.index)
+    if (gene_positions < 0).any():
+        msg = """\n!!!\nThe query genes are not all in the candidate index.
+        number of missing genes:  {}\n""".format((gene_positions < 0).sum())
+        logger.exception(msg)
+        raise FhtbioinfpyCandidateIndexGenesNotIndexed(msg)
+
+    query_std = reference_store.standardize_columns(subset_query_expr.to_numpy())
+    approx_corr = query_std.T.dot(index.components[gene_positions]).dot(index.ref_coords)
+
+    n_candidates = min(n_candidates, approx_corr.shape[1])
+    approx_corr = numpy.where(numpy.isnan(approx_corr), -numpy.inf, approx_corr)
+    if n_candidates == approx_corr.shape[1]:
+        return numpy.broadcast_to(numpy.arange(n_candidates), approx_corr.shape).copy()
+    return numpy.argpartition(-approx_corr, n_candidates - 1, axis=1)[:, :n_candidates]
+
+
+# fraction of the exact top k reference columns of every query that are among its candidates
+def candidate_recall(exact_corr_df, candidate_positions, k=1):
+    exact_arr = numpy.where(numpy.isnan(exact_corr_df.to_numpy()), -numpy.inf, exact_corr_df.to_numpy())
+    k = min(k, exact_arr.shape[1])
+    exact_top_k = numpy.argpartition(-exact_arr, k - 1, axis=1)[:, :k]
+    found = (exact_top_k[:, :, numpy.newaxis] == candidate_positions[:, numpy.newaxis, :]).any(axis=2)
+    return found.mean()
+
+
+def main(args):
+    ref_std_df, manifest = reference_store.load_reference_store(args.ref_store_dir)
+    index = build_candidate_index(ref_std_df, n_components=args.n_components)
+    index_filepath = save_candidate_index(index, args.ref_store_dir)
+    logger.info("saved a {} component candidate index of {} genes x {} columns to {}".format(
+        index.components.shape[1], len(index.genes), len(index.columns), index_filepath))
+
+
+class FhtbioinfpyCandidateIndexGenesNotIndexed(Exception):
+    pass
+
+
+class FhtbioinfpyCandidateIndexNoCandidates(Exception):
+    pass
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args(sys.argv[1:])
+    setup_logger.setup(verbose=args.verbose)
+    logger.debug("args:  {}".format(args))
+
+    main(args)
@@ -0,0 +1,181 @@
+"""
+batch mode of cell_line_auth_pipeline: correlates and authenticates every experiment of a manifest (a tab separated
+file with experiment_id and query_expr_filepath columns, optionally output_subdir) against one reference that is loaded
+and standardized once. Each experiment writes its usual outputs; --experiment_id names the consolidated summary with
+one row per experiment.
+"""
+import logging
+import fhtbioinfpy.setup_logger as setup_logger
+import fhtbioinfpy.stage_profiler as stage_profiler
+import sys
+import argparse
+import copy
+
+import os
+import pandas as pd
+import fhtbioinfpy.cell_line_authentication.cell_line_correlation as cell_line_correlation
+import fhtbioinfpy.cell_line_authentication.cell_line_authentication as cell_line_authentication
+import fhtbioinfpy.cell_line_authentication.cell_line_auth_pipeline as cell_line_auth_pipeline
+import fhtbioinfpy.cell_line_authentication.reference_store as reference_store
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+MANIFEST_REQUIRED_COLUMNS = ["experiment_id", "query_expr_filepath"]
+
+
+# the cell_line_auth_pipeline options, with the query file and experiment id of each experiment coming from the manifest
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--experiment_id", help="id of the batch, names the consolidated summary", required = True)
+    parser.add_argument("--manifest_filepath", help="tab separated manifest with experiment_id and query_expr_filepath columns (optionally output_subdir)", type=str, required = True)
+    cell_line_auth_pipeline.add_common_arguments(parser)
+    return cell_line_auth_pipeline.add_output_arguments(parser)
+
+
+# reads the manifest and checks it has the required columns
+def read_manifest(manifest_filepath):
+    manifest_df = pd.read_csv(manifest_filepath, sep="\t", dtype=str)
+    missing_columns = [c for c in MANIFEST_REQUIRED_COLUMNS if c not in manifest_df.columns]
+    if len(missing_columns) > 0:
+        msg = """\n!!!\nThe batch manifest is missing required columns.
+        manifest_filepath:  {}
+        missing columns:  {}
+        required columns:  {}\n""".format(manifest_filepath, missing_columns, MANIFEST_REQUIRED_COLUMNS)
+        logger.exception(msg)
+        raise FhtbioinfpyCellLineAuthBatchManifestMissingColumns(msg)
+    logger.debug("\nmanifest_df\n{}".format(manifest_df))
+    return manifest_df
+
+
+# loads the reference once for the whole batch; a GCT/GCTX reference is standardized in memory like a compiled store
+def load_batch_reference(ref_expr_filepath):
+    ref_expr_df, ref_manifest = cell_line_correlation.load_reference(ref_expr_filepath)
+    if ref_manifest is None:
+        ref_expr_df, ref_manifest = reference_store.standardize_reference(ref_expr_df, source_filepath=ref_expr_filepath)
+    return ref_expr_df, ref_manifest
+
+
+# one row of the consolidated summary; an experiment whose only mismatches are near twins of the reference is
+# "ok (near twins)"
+def summarize_experiment(experiment_id, query_expr_filepath, compared_depmap_df, match_scores_df, compared_depmap_filepath):
+    n_mismatched = int((~compared_depmap_df["cell_line_match"]).sum())
+    n_near_twin = int(compared_depmap_df["near_twin_match"].sum()) if "near_twin_match" in compared_depmap_df.columns else 0
+    if n_mismatched == 0:
+        status = "ok"
+    elif n_mismatched == n_near_twin:
+        status = "ok (near twins)"
+    else:
+        status = "mismatch"
+    return {"experiment_id": experiment_id, "query_expr_filepath": query_expr_filepath,
+        "n_samples": len(compared_depmap_df), "n_matched": len(compared_depmap_df) - n_mismatched,
+        "n_mismatched": n_mismatched, "n_ambiguous": int(match_scores_df["ambiguous_match"].sum()),
+        "status": status, "compared_depmap_filepath": compared_depmap_filepath}
+
+
+# correlates and authenticates one experiment of the manifest against the already loaded reference and writes its outputs
+def run_experiment(experiment_args, ref_expr_df, ref_manifest, alignment_memo, near_twins_df=None):
+    query_expr_gctoo = cell_line_correlation.read_RNA_seq_gctx(experiment_args.query_expr_filepath)
+
+    if not os.path.isdir(experiment_args.output_subdir):
+        os.makedirs(experiment_args.output_subdir)
+
+    compared_depmap_df, match_scores_df, corr_df = cell_line_auth_pipeline.authenticate_experiment(query_expr_gctoo,
+        ref_expr_df, ref_manifest, experiment_args, alignment_memo=alignment_memo, near_twins_df=near_twins_df)
+    if experiment_args.save_corr_df:
+        cell_line_auth_pipeline.save_correlations(corr_df, experiment_args)
+    cell_line_authentication.save_match_scores_df(match_scores_df, experiment_args.experiment_id, experiment_args.output_subdir)
+    compared_depmap_filepath = cell_line_authentication.save_compared_depmap_df(compared_depmap_df,
+        experiment_args.experiment_id, experiment_args.output_subdir)
+
+    return summarize_experiment(experiment_args.experiment_id, experiment_args.query_expr_filepath, compared_depmap_df,
+        match_scores_df, compared_depmap_filepath)
+
+
+# runs every experiment of the manifest in turn, so only one query is held in memory at a time. An experiment that
+# fails is recorded in the summary and the batch moves on to the next one
+def run_batch(manifest_df, ref_expr_df, ref_manifest, args, profiler=None):
+    if profiler is None:
+        profiler = stage_profiler.StageProfiler("cell_line_auth_batch")
+    alignment_memo = {}
+    near_twins_df = cell_line_auth_pipeline.load_reference_near_twins(args)
+    summary_rows = []
+    for _, manifest_row in manifest_df.iterrows():
+        experiment_args = copy.copy(args)
+        experiment_args.experiment_id = manifest_row["experiment_id"]
+        experiment_args.query_expr_filepath = manifest_row["query_expr_filepath"]
+        # every sample of the experiment's query is authenticated
+        experiment_args.query_sample_ids = None
+        if "output_subdir" in manifest_df.columns and pd.notna(manifest_row["output_subdir"]):
+            experiment_args.output_subdir = manifest_row["output_subdir"]
+        logger.info("batch experiment: {}  query_expr_filepath: {}".format(experiment_args.experiment_id, experiment_args.query_expr_filepath))
+
+        try:
+            with profiler.stage("experiment {}".format(experiment_args.experiment_id)):
+                summary_rows.append(run_experiment(experiment_args, ref_expr_df, ref_manifest, alignment_memo,
+                    near_twins_df=near_twins_df))
+        except Exception as e:
+            logger.exception("batch experiment {} failed: {}".format(experiment_args.experiment_id, e))
+            summary_rows.append({"experiment_id": experiment_args.experiment_id,
+                "query_expr_filepath": experiment_args.query_expr_filepath, "status": "error: {}".format(e)})
+
+    summary_df = pd.DataFrame(summary_rows, columns=["experiment_id", "query_expr_filepath", "n_samples", "n_matched",
+        "n_mismatched", "n_ambiguous", "status", "compared_depmap_filepath"]).set_index("experiment_id")
+    logger.debug("\nsummary_df\n{}".format(summary_df))
+    return summary_df
+
+
+# saves the consolidated summary as a csv/txt file
+def save_summary_df(summary_df, batch_id, subdir):
+    output_filename = "{batch_id}_cell_line_authentication_batch_summary_r{nrows}x{ncols}.txt".format(
+        batch_id=batch_id, nrows=summary_df.shape[0], ncols=summary_df.shape[1]
+    )
+    output_filepath = os.path.join(subdir, output_filename)
+    logger.debug("output_filepath : {}".format(output_filepath))
+    summary_df.to_csv(output_filepath, sep="\t")
+    return output_filepath
+
+
+# raises when any experiment of the batch had a sample without a DepMap ID match, or failed
+def check_batch_for_warnings(summary_df):
+    failed_df = summary_df[~summary_df["status"].isin(["ok", "ok (near twins)"])]
+    if not failed_df.empty:
+        msg = """\n!!!\n The following experiments have samples with no DepMap ID match or failed. \n{}\n""".format(failed_df)
+        with pd.option_context('display.max_rows', None, 'display.max_columns', None):
+            logger.exception(msg)
+            print(failed_df[["n_samples", "n_mismatched", "status"]])
+            raise FhtbioinfpyCellLineAuthBatchExperimentsFailed(msg)
+
+
+def main(args):
+    cell_line_correlation.check_engine_arguments(args)
+    cell_line_correlation.check_output_arguments(args)
+    profiler = stage_profiler.StageProfiler("cell_line_auth_batch", enabled=args.profile)
+    manifest_df = read_manifest(args.manifest_filepath)
+    with profiler.stage("load_reference") as stage:
+        ref_expr_df, ref_manifest = load_batch_reference(args.ref_expr_filepath)
+        stage_profiler.add_shapes(stage, ref_expr=ref_expr_df)
+
+    if not os.path.isdir(args.output_subdir):
+        os.makedirs(args.output_subdir)
+
+    summary_df = run_batch(manifest_df, ref_expr_df, ref_manifest, args, profiler=profiler)
+    save_summary_df(summary_df, args.experiment_id, args.output_subdir)
+    profiler.save_report(args.experiment_id, args.output_subdir)
+
+    check_batch_for_warnings(summary_df)
+
+
+class FhtbioinfpyCellLineAuthBatchManifestMissingColumns(Exception):
+    pass
+
+
+class FhtbioinfpyCellLineAuthBatchExperimentsFailed(Exception):
+    pass
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args(sys.argv[1:])
+    setup_logger.setup(verbose=args.verbose)
+    logger.debug("args:  {}".format(args))
+
+    main(args)
@@ -0,0 +1,204 @@
+"""
+benchmark suite for the authentication steps on synthetic data of configurable size. Generates a GCTX reference
+(genes x reference lines) and a GCTX query whose samples are noisy copies of known reference lines, sharing a
+configurable fraction of the reference genes, then times build_matched_datasets, run_correlation_calculation,
+save_corr_df / load_correlation_df and the rank and compare steps of cell_line_authentication. Results are written as
+JSON and compared against a stored baseline (--save_baseline stores a new one). Each step is compared by its share of
+the total wall time rather than its absolute time, so a slower or faster machine does not count as a regression (nor
+does a slowdown of every step alike); steps whose share grew by more than --regression_tolerance are reported, and fail
+the run with --fail_on_regression.
+"""
+import logging
+import fhtbioinfpy.setup_logger as setup_logger
+import fhtbioinfpy.stage_profiler as stage_profiler
+import argparse
+import sys
+import json
+import collections
+
+import os
+import pandas as pd
+import numpy
+import cmapPy.pandasGEXpress.GCToo as GCToo
+import cmapPy.pandasGEXpress.write_gctx as write_gctx
+import fhtbioinfpy.cell_line_authentication.cell_line_correlation as cell_line_correlation
+import fhtbioinfpy.cell_line_authentication.cell_line_authentication as cell_line_authentication
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+# the baseline shipped with the module, measured with the default configuration
+DEFAULT_BASELINE_FILEPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cell_line_auth_benchmark_baseline.json")
+DEFAULT_REGRESSION_TOLERANCE = 1.5
+
+BenchmarkConfig = collections.namedtuple("BenchmarkConfig",
+    ["n_genes", "n_query_samples", "n_ref_lines", "gene_overlap", "noise", "random_state"])
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--verbose", "-v", help="Whether to print a bunch of output.", action="store_true", default=False)
+    parser.add_argument("--output_dir", help="directory for the synthetic GCTX files, the saved correlations and the results", type=str, default="./cell_line_auth_benchmark/")
+    parser.add_argument("--n_genes", help="number of reference genes", type=int, default=5000)
+    parser.add_argument("--n_query_samples", help="number of query samples", type=int, default=96)
+    parser.add_argument("--n_ref_lines", help="number of reference lines (columns)", type=int, default=1406)
+    parser.add_argument("--gene_overlap", help="fraction of the reference genes that are also in the query", type=float, default=0.9)
+    parser.add_argument("--noise", help="standard deviation of the noise added to a query sample's reference line", type=float, default=0.5)
+    parser.add_argument("--random_state", help="seed of the synthetic data", type=int, default=0)
+    parser.add_argument("--repeats", help="number of times each step is timed; the fastest run is reported", type=int, default=3)
+    parser.add_argument("--output_format", help="format of the correlation matrix for the save / load steps", choices=cell_line_correlation.CORR_OUTPUT_FORMATS, default="txt")
+    parser.add_argument("--baseline_filepath", help="stored results of an earlier run to compare against", type=str, default=DEFAULT_BASELINE_FILEPATH)
+    parser.add_argument("--save_baseline", help="store the results as --baseline_filepath instead of comparing against it", action="store_true", default=False)
+    parser.add_argument("--regression_tolerance", help="a step is a regression when its share of the total wall time is this many times its share in the baseline", type=float, default=DEFAULT_REGRESSION_TOLERANCE)
+    parser.add_argument("--fail_on_regression", help="raise when a step is a regression instead of only reporting it", action="store_true", default=False)
+    return parser
+
+
+# synthetic reference and query GCToo objects. The reference rows are genes (rid = gene symbol), the query rows are
+# probes with a gene_symbol row metadata column: gene_overlap of the reference genes plus query-only genes. Every query
+# sample is a reference line plus noise, and that line is its DepMap_ID
+def generate_synthetic_datasets(config):
+    random_state = numpy.random.RandomState(config.random_state)
+    ref_genes = numpy.array(["SYN{}".format(i) for i in range(config.n_genes)])
+    ref_lines = numpy.array(["ACH-{:06d}".format(i) for i in range(config.n_ref_lines)])
+
+    # gene level means shared by every line, plus a line specific profile
+    gene_means = random_state.gamma(2.0, 2.0, size=(config.n_genes, 1))
+    ref_arr = (gene_means + random_state.normal(0.0, 1.0, size=(config.n_genes, config.n_ref_lines))).astype(numpy.float32)
+    ref_gctoo = GCToo.GCToo(data_df=pd.DataFrame(ref_arr, index=pd.Index(ref_genes, name="rid"), columns=pd.Index(ref_lines, name="cid")))
+
+    n_shared = int(round(config.gene_overlap * config.n_genes))
+    shared_positions = numpy.sort(random_state.choice(config.n_genes, size=n_shared, replace=False))
+    n_query_only = config.n_genes - n_shared
+    query_genes = numpy.concatenate([ref_genes[shared_positions], ["SYNQ{}".format(i) for i in range(n_query_only)]])
+
+    true_lines = random_state.choice(config.n_ref_lines, size=config.n_query_samples)
+    query_arr = numpy.vstack([ref_arr[shared_positions][:, true_lines],
+        random_state.normal(4.0, 1.0, size=(n_query_only, config.n_query_samples))])
+    query_arr = (query_arr + random_state.normal(0.0, config.noise, size=query_arr.shape)).astype(numpy.float32)
+
+    query_rids = pd.Index(["probe_{}".format(i) for i in range(len(query_genes))], name="rid")
+    query_cids = pd.Index(["S{}".format(i) for i in range(config.n_query_samples)], name="cid")
+    query_gctoo = GCToo.GCToo(data_df=pd.DataFrame(query_arr, index=query_rids, columns=query_cids),
+        row_metadata_df=pd.DataFrame({"gene_symbol": query_genes}, index=query_rids),
+        col_metadata_df=pd.DataFrame({"DepMap_ID": ref_lines[true_lines], "bio_context_id": ref_lines[true_lines]}, index=query_cids))
+    return query_gctoo, ref_gctoo
+
+
+# writes the synthetic datasets as GCTX files, returns their paths
+def write_synthetic_datasets(query_gctoo, ref_gctoo, output_dir):
+    query_filepath = os.path.join(output_dir, "synthetic_query_r{}x{}.gctx".format(*query_gctoo.data_df.shape))
+    ref_filepath = os.path.join(output_dir, "synthetic_ref_r{}x{}.gctx".format(*ref_gctoo.data_df.shape))
+    write_gctx.write(query_gctoo, query_filepath)
+    write_gctx.write(ref_gctoo, ref_filepath)
+    return query_filepath, ref_filepath
+
+
+# runs function repeats times as the stage name of the profiler, returns its last result
+def time_step(profiler, name, repeats, function, *args, **kwargs):
+    for _ in range(repeats):
+        with profiler.stage(name):
+            result = function(*args, **kwargs)
+    return result
+
+
+# times every step on the synthetic datasets, returns the fastest run of each step
+def run_benchmark(query_gctoo, ref_gctoo, output_dir, repeats=3, output_format="txt"):
+    profiler = stage_profiler.StageProfiler("cell_line_auth_benchmark", enabled=True)
+    ref_expr_df = ref_gctoo.data_df
+    query_col_meta_df = query_gctoo.col_metadata_df
+
+    query_expr_df = cell_line_correlation.query_set_index(query_gctoo, "gene_symbol")
+    subset_query_expr, subset_ref_expr = time_step(profiler, "build_matched_datasets", repeats,
+        cell_line_correlation.build_matched_datasets, query_expr_df, ref_expr_df)
+    corr_df = time_step(profiler, "run_correlation_calculation", repeats,
+        cell_line_correlation.run_correlation_calculation, subset_query_expr, subset_ref_expr)
+
+    corr_filepath = time_step(profiler, "save_corr_df", repeats,
+        cell_line_correlation.save_corr_df, corr_df, "benchmark", output_dir, output_format=output_format)
+    loaded_corr_df = time_step(profiler, "load_correlation_df", repeats, cell_line_authentication.load_correlation_df, corr_filepath)
+
+    # the rank step as it was (a full row rank) and as it is (partial selection match scores)
+    time_step(profiler, "rank_full_row", repeats,
+        lambda df: cell_line_authentication.identify_rank(df.rank(axis=1, method="first", ascending=False)), loaded_corr_df)
+    match_scores_df = time_step(profiler, "build_match_scores", repeats,
+        cell_line_authentication.build_match_scores, loaded_corr_df, query_col_meta_df)
+    compared_depmap_df = time_step(profiler, "compare_depmap_id", repeats,
+        cell_line_authentication.compare_depmap_id, query_col_meta_df, match_scores_df["top_corr_depmap_ID"])
+
+    steps = collections.OrderedDict()
+    for stage in profiler.stages:
+        best = steps.get(stage["stage"])
+        if best is None or stage["wall_s"] < best["wall_s"]:
+            steps[stage["stage"]] = {"wall_s": stage["wall_s"], "cpu_s": stage["cpu_s"], "rss_delta_mb": stage["rss_delta_mb"],
+                "process_peak_rss_mb": stage["process_peak_rss_mb"]}
+
+    report = profiler.report()
+    return {"python": report["python"], "numpy": report["numpy"], "pandas": report["pandas"],
+        "n_matched_genes": subset_query_expr.shape[0], "match_rate": float(compared_depmap_df["cell_line_match"].mean()),
+        "steps": steps}
+
+
+# share of every step in the total wall time of the steps that are in both runs, compared with its share in the
+# baseline; steps whose share grew by more than regression_tolerance times are regressions
+def compare_to_baseline(results, baseline, regression_tolerance=DEFAULT_REGRESSION_TOLERANCE):
+    wall_s = pd.Series({step: timing["wall_s"] for step, timing in results["steps"].items()}, dtype=float)
+    baseline_wall_s = pd.Series({step: timing.get("wall_s") for step, timing in baseline["steps"].items()}, dtype=float).reindex(wall_s.index)
+    common = baseline_wall_s.notna()
+    share = wall_s / wall_s[common].sum()
+    baseline_share = baseline_wall_s / baseline_wall_s[common].sum()
+    ratio = share / baseline_share
+    comparison_df = pd.DataFrame({"wall_s": wall_s, "baseline_wall_s": baseline_wall_s, "share": share,
+        "baseline_share": baseline_share, "ratio": ratio, "regression": ratio > regression_tolerance})
+    comparison_df.index.name = "step"
+    if results["config"] != baseline.get("config"):
+        logger.warning("the baseline was measured with another configuration:\nbaseline: {}\nthis run: {}".format(
+            baseline.get("config"), results["config"]))
+    logger.info("\ncomparison to baseline\n{}".format(comparison_df))
+    return comparison_df
+
+
+def main(args):
+    config = BenchmarkConfig(args.n_genes, args.n_query_samples, args.n_ref_lines, args.gene_overlap, args.noise, args.random_state)
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    query_gctoo, ref_gctoo = generate_synthetic_datasets(config)
+    write_synthetic_datasets(query_gctoo, ref_gctoo, args.output_dir)
+
+    results = run_benchmark(query_gctoo, ref_gctoo, args.output_dir, repeats=args.repeats, output_format=args.output_format)
+    results["config"] = dict(config._asdict(), output_format=args.output_format)
+    results_filepath = os.path.join(args.output_dir, "cell_line_auth_benchmark_results.json")
+    with open(results_filepath, "w") as f:
+        json.dump(results, f, indent=2)
+    logger.info("benchmark results: {}".format(results_filepath))
+
+    if args.save_baseline:
+        with open(args.baseline_filepath, "w") as f:
+            json.dump(results, f, indent=2)
+        logger.info("stored as baseline: {}".format(args.baseline_filepath))
+    elif os.path.isfile(args.baseline_filepath):
+        with open(args.baseline_filepath, "r") as f:
+            baseline = json.load(f)
+        comparison_df = compare_to_baseline(results, baseline, regression_tolerance=args.regression_tolerance)
+        regression_df = comparison_df[comparison_df["regression"]]
+        if not regression_df.empty:
+            msg = """\n!!!\nThe following steps take a share of the wall time more than {} times their share in the baseline {}\n{}\n""".format(
+                args.regression_tolerance, args.baseline_filepath, regression_df)
+            if args.fail_on_regression:
+                logger.exception(msg)
+                raise FhtbioinfpyCellLineAuthBenchmarkRegression(msg)
+            logger.warning(msg)
+    else:
+        logger.info("no baseline at {}, run with --save_baseline to store one".format(args.baseline_filepath))
+
+
+class FhtbioinfpyCellLineAuthBenchmarkRegression(Exception):
+    pass
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args(sys.argv[1:])
+    setup_logger.setup(verbose=args.verbose)
+    logger.debug("args:  {}".format(args))
+
+    main(args)
@@ -0,0 +1,124 @@
+"""
+correlate and authenticate in one process: the query expression file is parsed once, the correlations and best
+matches stay in memory, and compare_depmap_id / check_for_warnings run on those same objects. The intermediate
+correlation matrix (or top k table) is only written when --save_corr_df is given.
+"""
+import logging
+import fhtbioinfpy.setup_logger as setup_logger
+import fhtbioinfpy.stage_profiler as stage_profiler
+import sys
+import argparse
+
+import os
+import fhtbioinfpy.cell_line_authentication.cell_line_correlation as cell_line_correlation
+import fhtbioinfpy.cell_line_authentication.cell_line_authentication as cell_line_authentication
+import fhtbioinfpy.cell_line_authentication.reference_similarity as reference_similarity
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    cell_line_correlation.add_query_arguments(parser)
+    add_common_arguments(parser)
+    return add_output_arguments(parser)
+
+
+# the cell_line_correlation output options, plus whether to also write the intermediate correlations; shared with the
+# batch parser
+def add_output_arguments(parser):
+    cell_line_correlation.add_output_arguments(parser)
+    parser.add_argument("--save_corr_df", help="also save the correlation matrix (or the top k long table) like cell_line_correlation does", action="store_true", default=False)
+    return parser
+
+
+# the cell_line_correlation options, plus how matches are scored; shared with the batch and server parsers
+def add_common_arguments(parser):
+    cell_line_correlation.add_common_arguments(parser)
+    parser.add_argument("--ambiguous_margin", help="flag matches whose top 1 r minus top 2 r is below this as ambiguous in the match scores output", type=float, default=cell_line_authentication.DEFAULT_AMBIGUOUS_MARGIN)
+    parser.add_argument("--near_twin_min_r", help="when the reference is a compiled store with a self-similarity map (see reference_similarity), reference lines correlating at least this much are near twins and a mismatch with a near twin is only warned about", type=float, default=reference_similarity.DEFAULT_NEAR_TWIN_MIN_R)
+    return parser
+
+
+# correlates the parsed query against the loaded reference, scores the matches and compares the best matches with the
+# annotated DepMap_ID. Returns the compared depmap df, the match scores and the correlation df (the top k long table when
+# args.top_k is given). Mismatches with a near twin of the reference (see load_reference_near_twins) are flagged
+def authenticate_experiment(query_expr_gctoo, ref_expr_df, ref_manifest, args, alignment_memo=None, near_twins_df=None):
+    query_expr_df = cell_line_correlation.query_set_index(query_expr_gctoo, args.row_metadata_for_matching)
+    query_col_meta_df = query_expr_gctoo.col_metadata_df
+    if args.query_sample_ids is not None:
+        query_positions = cell_line_correlation.find_query_samples(args.query_sample_ids, query_expr_df.columns)
+        query_expr_df = query_expr_df.iloc[:, query_positions]
+        query_col_meta_df = query_col_meta_df.loc[args.query_sample_ids]
+    return authenticate_query_df(query_expr_df, query_col_meta_df, ref_expr_df, ref_manifest, args, alignment_memo=alignment_memo,
+        near_twins_df=near_twins_df)
+
+
+# authenticate_experiment for a query that is already a dataframe indexed by row_metadata_for_matching, with its
+# column metadata (which needs a DepMap_ID column)
+def authenticate_query_df(query_expr_df, query_col_meta_df, ref_expr_df, ref_manifest, args, alignment_memo=None, near_twins_df=None):
+    subset_query_expr, subset_ref_expr = cell_line_correlation.match_datasets(query_expr_df, ref_expr_df, args, alignment_memo=alignment_memo)
+    subset_query_expr, subset_ref_expr, ref_is_standardized = cell_line_correlation.prepare_for_method(
+        subset_query_expr, subset_ref_expr, ref_manifest, args)
+
+    corr_df = cell_line_correlation.compute_correlations(subset_query_expr, subset_ref_expr, ref_is_standardized, args)
+    scored_df = corr_df.set_index("sample_id") if args.top_k is not None else corr_df
+    match_scores_df = cell_line_authentication.build_match_scores(scored_df, query_col_meta_df, ambiguous_margin=args.ambiguous_margin)
+
+    compared_depmap_df = cell_line_authentication.compare_depmap_id(query_col_meta_df, match_scores_df["top_corr_depmap_ID"],
+        near_twins_df=near_twins_df)
+    return compared_depmap_df, match_scores_df, corr_df
+
+
+# the near-twin pairs of args.ref_expr_filepath when it is a compiled store with a self-similarity map, otherwise None
+# (cell_line_authentication.load_near_twins reads args.ref_store_dir instead)
+def load_reference_near_twins(args):
+    return reference_similarity.load_near_twins(args.ref_expr_filepath, min_r=args.near_twin_min_r)
+
+
+# saves the correlations in the format cell_line_correlation would have written them
+def save_correlations(corr_df, args):
+    if args.top_k is not None:
+        return cell_line_correlation.save_top_k_df(corr_df, args.top_k, args.experiment_id, args.output_subdir)
+    return cell_line_correlation.save_corr_df(corr_df, args.experiment_id, args.output_subdir,
+        output_format=args.output_format, output_dtype=args.output_dtype)
+
+
+def main(args):
+    cell_line_correlation.check_engine_arguments(args)
+    cell_line_correlation.check_output_arguments(args)
+    profiler = stage_profiler.StageProfiler("cell_line_auth_pipeline", enabled=args.profile)
+    # parsed once: the data for the correlation and the column metadata for the comparison
+    with profiler.stage("load") as stage:
+        query_expr_gctoo = cell_line_correlation.read_RNA_seq_gctx(args.query_expr_filepath)
+        ref_expr_df, ref_manifest = cell_line_correlation.load_reference(args.ref_expr_filepath)
+        near_twins_df = load_reference_near_twins(args)
+        stage_profiler.add_shapes(stage, query_expr=query_expr_gctoo.data_df, ref_expr=ref_expr_df)
+
+    if not os.path.isdir(args.output_subdir):
+        os.mkdir(args.output_subdir)
+
+    # align, correlate, rank and compare run on in-memory objects, so they are profiled as one stage
+    with profiler.stage("authenticate") as stage:
+        compared_depmap_df, match_scores_df, corr_df = authenticate_experiment(query_expr_gctoo, ref_expr_df, ref_manifest, args,
+            near_twins_df=near_twins_df)
+        stage_profiler.add_shapes(stage, corr_df=corr_df, compared_depmap_df=compared_depmap_df)
+
+    with profiler.stage("save"):
+        if args.save_corr_df:
+            save_correlations(corr_df, args)
+
+        cell_line_authentication.save_match_scores_df(match_scores_df, args.experiment_id, args.output_subdir)
+        cell_line_authentication.save_compared_depmap_df(compared_depmap_df, args.experiment_id, args.output_subdir)
+    profiler.save_report(args.experiment_id, args.output_subdir)
+
+    #looks through output_df, finds where compared)depmaps_df is False , throw exception "doesn't match"
+    cell_line_authentication.check_for_warnings(compared_depmap_df)
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args(sys.argv[1:])
+    setup_logger.setup(verbose=args.verbose)
+    logger.debug("args:  {}".format(args))
+
+    main(args)
@@ -0,0 +1,185 @@
+"""
+long-running local authentication server: the reference is loaded and standardized once at startup and the gene
+alignments are kept in memory, so a check from a LIMS or a notebook only pays for its own correlation. Requests are
+JSON over HTTP on localhost and are scored by a pool of worker threads (numpy releases the GIL in the matrix products).
+
+    GET  /health        reference shape and server settings
+    POST /authenticate  {"query_expr_filepath": "<gct/gctx path under --data_root>"} or
+                        {"query_expr": {"index": [genes], "columns": [sample ids], "data": [[...], ...]},
+                         "depmap_ids": {"<sample id>": "<annotated DepMap_ID>", ...}}
+                        answers with the match scores and cell_line_match of every sample
+
+Query files are only opened below --data_root (without it, requests must send the matrix). Requests are scored on
+threads, so the server does not take --workers.
+"""
+import logging
+import fhtbioinfpy.setup_logger as setup_logger
+import sys
+import argparse
+import collections
+import concurrent.futures
+import http.server
+import json
+
+import os
+import numpy
+import pandas as pd
+import fhtbioinfpy.cell_line_authentication.cell_line_correlation as cell_line_correlation
+import fhtbioinfpy.cell_line_authentication.cell_line_auth_pipeline as cell_line_auth_pipeline
+import fhtbioinfpy.cell_line_authentication.cell_line_auth_batch as cell_line_auth_batch
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+DEFAULT_PORT = 8765
+DEFAULT_REQUEST_WORKERS = 4
+
+# what a request handler needs, attached to the server: the warm reference and its near-twin pairs, the settings from
+# the command line, the alignments built so far and the pool the requests are scored in
+ServerState = collections.namedtuple("ServerState", ["ref_expr_df", "ref_manifest", "near_twins_df", "args", "alignment_memo", "executor"])
+
+
+# the cell_line_auth_pipeline options (fixed for every request), plus where to listen and how many requests run at once.
+# Every request brings its own query and gets its answer in the response, so the query and output options are left out
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    cell_line_auth_pipeline.add_common_arguments(parser)
+    parser.add_argument("--host", help="address to listen on", type=str, default="127.0.0.1")
+    parser.add_argument("--port", help="port to listen on (0 picks a free port)", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--request_workers", help="number of requests scored at the same time", type=cell_line_correlation.positive_int, default=DEFAULT_REQUEST_WORKERS)
+    parser.add_argument("--data_root", help="directory the query_expr_filepath of a request must be under; if not provided, requests can only send the query matrix", type=str, default=None)
+    return parser
+
+
+# the real path of a query file named by a request, when it is a file under data_root
+def resolve_request_filepath(query_expr_filepath, data_root):
+    if data_root is None:
+        raise FhtbioinfpyCellLineAuthServerBadRequest("query_expr_filepath requests are disabled, the server has no --data_root")
+    real_root = os.path.realpath(data_root)
+    real_filepath = os.path.realpath(os.path.join(real_root, str(query_expr_filepath)))
+    if os.path.commonpath([real_root, real_filepath]) != real_root or not os.path.isfile(real_filepath):
+        raise FhtbioinfpyCellLineAuthServerBadRequest("query_expr_filepath is not a file under the data root: {}".format(query_expr_filepath))
+    return real_filepath
+
+
+# the query of a request as a dataframe indexed by row_metadata_for_matching, and its column metadata with DepMap_ID.
+# A query file is resolved under args.data_root (relative paths from there); a malformed request raises
+# FhtbioinfpyCellLineAuthServerBadRequest
+def parse_authenticate_request(request, args):
+    if not isinstance(request, dict):
+        raise FhtbioinfpyCellLineAuthServerBadRequest("request must be a JSON object")
+
+    if "query_expr_filepath" in request:
+        query_expr_gctoo = cell_line_correlation.read_RNA_seq_gctx(resolve_request_filepath(request["query_expr_filepath"], args.data_root))
+        query_expr_df = cell_line_correlation.query_set_index(query_expr_gctoo, args.row_metadata_for_matching)
+        return query_expr_df, query_expr_gctoo.col_metadata_df
+
+    if "query_expr" in request:
+        try:
+            query_expr = request["query_expr"]
+            query_expr_df = pd.DataFrame(numpy.asarray(query_expr["data"], dtype=numpy.float64),
+                index=pd.Index(query_expr["index"], name=args.row_metadata_for_matching), columns=query_expr["columns"])
+            # samples without an annotated DepMap_ID are scored, but cannot match
+            depmap_id_s = pd.Series(request.get("depmap_ids", {}), dtype=object).reindex(query_expr_df.columns)
+        except (KeyError, TypeError, ValueError) as e:
+            raise FhtbioinfpyCellLineAuthServerBadRequest("query_expr is not a matrix with index, columns and data: {}".format(e))
+        return query_expr_df, pd.DataFrame({"DepMap_ID": depmap_id_s})
+
+    msg = "request needs a query_expr_filepath or a query_expr matrix"
+    raise FhtbioinfpyCellLineAuthServerBadRequest(msg)
+
+
+# scores one request against the warm reference, returns the JSON-able response
+def authenticate_request(request, state):
+    query_expr_df, query_col_meta_df = parse_authenticate_request(request, state.args)
+    compared_depmap_df, match_scores_df, corr_df = cell_line_auth_pipeline.authenticate_query_df(query_expr_df,
+        query_col_meta_df, state.ref_expr_df, state.ref_manifest, state.args, alignment_memo=state.alignment_memo,
+        near_twins_df=state.near_twins_df)
+
+    match_scores_df = match_scores_df.join(compared_depmap_df[[c for c in ["cell_line_match", "near_twin_match"] if c in compared_depmap_df.columns]])
+    return {"n_samples": len(match_scores_df), "n_mismatched": int((~match_scores_df["cell_line_match"]).sum()),
+        "match_scores": json.loads(match_scores_df.to_json(orient="index"))}
+
+
+class CellLineAuthRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != "/health":
+            self.send_json(404, {"error": "unknown path: {}".format(self.path)})
+            return
+        state = self.server.state
+        self.send_json(200, {"status": "ok", "n_genes": state.ref_expr_df.shape[0], "n_columns": state.ref_expr_df.shape[1],
+            "method": state.args.method, "top_k": state.args.top_k})
+
+    def do_POST(self):
+        if self.path != "/authenticate":
+            self.send_json(404, {"error": "unknown path: {}".format(self.path)})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except ValueError as e:
+            self.send_json(400, {"error": "request body is not JSON: {}".format(e)})
+            return
+
+        # the handler thread waits while a pool worker scores the request, so at most --request_workers run at once
+        future = self.server.state.executor.submit(authenticate_request, request, self.server.state)
+        try:
+            self.send_json(200, future.result())
+        except FhtbioinfpyCellLineAuthServerBadRequest as e:
+            logger.exception("bad authenticate request: {}".format(e))
+            self.send_json(400, {"error": str(e)})
+        except Exception as e:
+            logger.exception("authenticate request failed: {}".format(e))
+            self.send_json(500, {"error": str(e)})
+
+    def send_json(self, status, body):
+        encoded = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def log_message(self, format, *args):
+        logger.debug("{} - {}".format(self.address_string(), format % args))
+
+
+# loads the reference and builds the server, ready for serve_forever. Requests are scored on the threads of the
+# server, which do not mix with the process pool of --workers
+def build_server(args):
+    if args.workers is not None and args.workers > 1:
+        msg = "\n!!!\nThe server scores requests on threads and does not take --workers {}; use --request_workers.\n".format(args.workers)
+        logger.exception(msg)
+        raise FhtbioinfpyCellLineAuthServerWorkersNotSupported(msg)
+    ref_expr_df, ref_manifest = cell_line_auth_batch.load_batch_reference(args.ref_expr_filepath)
+    logger.info("reference loaded: {} genes x {} columns".format(ref_expr_df.shape[0], ref_expr_df.shape[1]))
+
+    server = http.server.ThreadingHTTPServer((args.host, args.port), CellLineAuthRequestHandler)
+    server.state = ServerState(ref_expr_df, ref_manifest, cell_line_auth_pipeline.load_reference_near_twins(args), args, {},
+        concurrent.futures.ThreadPoolExecutor(max_workers=args.request_workers))
+    return server
+
+
+def main(args):
+    server = build_server(args)
+    logger.info("cell line authentication server listening on http://{}:{}".format(*server.server_address[:2]))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        server.state.executor.shutdown()
+
+
+class FhtbioinfpyCellLineAuthServerBadRequest(Exception):
+    pass
+
+
+class FhtbioinfpyCellLineAuthServerWorkersNotSupported(Exception):
+    pass
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args(sys.argv[1:])
+    setup_logger.setup(verbose=args.verbose)
+    logger.debug("args:  {}".format(args))
+
+    main(args)
@@ -1,24 +1,22 @@
-import ast
 import logging
-import operator
-import re
-import shutil
 import fhtbioinfpy.setup_logger as setup_logger
+import fhtbioinfpy.stage_profiler as stage_profiler
 import argparse
 import sys
 
 import os
 import pandas as pd
 import numpy
-import collections
-import cmapPy
 import cmapPy.pandasGEXpress.parse as parse
-import cmapPy.math.fast_corr as fast_corr
-
-import plotly.express as pltexpr
+import json
+import fhtbioinfpy.cell_line_authentication.cell_line_correlation as cell_line_correlation
+import fhtbioinfpy.cell_line_authentication.reference_similarity as reference_similarity
 
 logger = logging.getLogger(setup_logger.LOGGER_NAME)
 
+# matches whose top 1 r is less than this above the top 2 r are flagged as ambiguous
+DEFAULT_AMBIGUOUS_MARGIN = 0.01
+
 
 def build_parser():
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -27,12 +25,28 @@ def build_parser():
     # parser.add_argument("--ref_expr_filepath", help="reference expression file: in-house RNA-seq dataset", type=str, required = True)
     parser.add_argument("--experiment_id", help = "specific id for experiment", required = True)
     parser.add_argument("--output_subdir", help="subdirectory for output", type=str, default="./cell_line_auth/")
-    parser.add_argument("--corr_filepath", help="correlation_depmap filepath to load the correlation df", type=str, required = True)        
+    parser.add_argument("--corr_filepath", help="correlation_depmap filepath to load the correlation df, or the top k long table written by cell_line_correlation --top_k", type=str, required = True)        
+    parser.add_argument("--profile", help="record wall time, CPU time, RSS and array shapes of each stage into a JSON report in output_subdir", action="store_true", default=False)
+    parser.add_argument("--ambiguous_margin", help="flag matches whose top 1 r minus top 2 r is below this as ambiguous in the match scores output", type=float, default=DEFAULT_AMBIGUOUS_MARGIN)
+    parser.add_argument("--ref_store_dir", help="compiled reference store with a self-similarity map (see reference_similarity); mismatches whose top match is a near twin of the annotated DepMap ID are then only warned about", type=str, default=None)
+    parser.add_argument("--near_twin_min_r", help="reference lines correlating at least this much are near twins", type=float, default=reference_similarity.DEFAULT_NEAR_TWIN_MIN_R)
     return parser
 
-#load the correlation df that was saved in cell_line_correlation
+#load the correlation df that was saved in cell_line_correlation - the format is detected from the file extension,
+#npy matrices are memory mapped
 def load_correlation_df(corr_filepath):
-    corr_df = pd.read_csv(corr_filepath, sep='\t', index_col = 0)
+    if corr_filepath.endswith(".npy"):
+        with open(corr_filepath[:-len(".npy")] + cell_line_correlation.NPY_LABELS_SUFFIX, "r") as f:
+            labels = json.load(f)
+        corr_df = pd.DataFrame(numpy.load(corr_filepath, mmap_mode="r"),
+            index=pd.Index(labels["index"], name=labels["index_name"]),
+            columns=pd.Index(labels["columns"], name=labels["columns_name"]), copy=False)
+    elif corr_filepath.endswith(".parquet"):
+        corr_df = pd.read_parquet(corr_filepath)
+    elif corr_filepath.endswith(".gctx"):
+        corr_df = parse.parse(corr_filepath).data_df
+    else:
+        corr_df = pd.read_csv(corr_filepath, sep='\t', index_col = 0)
     logger.debug("\ncorr_df\n{}".format(corr_df))    
     # corr_df.set_index("cid", inplace = True)
     logger.debug("\ncorr_df\n{}".format(corr_df))
@@ -54,18 +68,134 @@ def identify_rank(corr_rank_df):
     cl_match_ID_s.name = "top_corr_depmap_ID"
     return cl_match_ID_s
 
+# per sample match confidence from the full correlation df, without ranking the whole rows: the top 1 is an argmax (the
+# first of tied columns, like rank(method="first")), the top 2 r a partial selection. Reports top 1 r, top 1 - top 2 margin,
+# z-score of top 1 against the row, and the rank and r of the expected DepMap_ID (nan when it is not a reference column)
+def score_matches(corr_df, expected_depmap_s=None, ambiguous_margin=DEFAULT_AMBIGUOUS_MARGIN):
+    corr_arr = numpy.asarray(corr_df.to_numpy(), dtype=numpy.float64)
+    n_rows, n_cols = corr_arr.shape
+    rows = numpy.arange(n_rows)
+    is_nan = numpy.isnan(corr_arr)
+    filled_arr = numpy.where(is_nan, -numpy.inf, corr_arr)
+    n_valid = n_cols - is_nan.sum(axis=1)
+
+    top1_positions = numpy.argmax(filled_arr, axis=1)
+    top1_r = filled_arr[rows, top1_positions]
+    if n_cols > 1:
+        top2_r = numpy.partition(filled_arr, n_cols - 2, axis=1)[:, n_cols - 2]
+    else:
+        top2_r = numpy.full(n_rows, -numpy.inf)
+    top1_r[~numpy.isfinite(top1_r)] = numpy.nan
+    top2_r[~numpy.isfinite(top2_r)] = numpy.nan
+
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        row_mean = numpy.where(is_nan, 0.0, corr_arr).sum(axis=1) / n_valid
+        row_std = numpy.sqrt((numpy.where(is_nan, 0.0, corr_arr - row_mean[:, numpy.newaxis]) ** 2).sum(axis=1) / n_valid)
+        zscore = (top1_r - row_mean) / row_std
+
+    top_ids = corr_df.columns.to_numpy()[top1_positions].astype(object)
+    top_ids[n_valid == 0] = numpy.nan
+    margin = top1_r - top2_r
+    scores_df = pd.DataFrame({"top_corr_depmap_ID": top_ids, "top1_r": top1_r, "top2_r": top2_r, "margin": margin,
+        "zscore": zscore}, index=corr_df.index)
+
+    expected_r = numpy.full(n_rows, numpy.nan)
+    expected_rank = numpy.full(n_rows, numpy.nan)
+    if expected_depmap_s is not None:
+        expected_positions = corr_df.columns.get_indexer(expected_depmap_s.reindex(corr_df.index))
+        found = (expected_positions >= 0)
+        expected_r[found] = corr_arr[rows[found], expected_positions[found]]
+        found &= ~numpy.isnan(expected_r)
+        # same tie handling as the top 1: equal r in an earlier column ranks ahead
+        found_r = expected_r[found][:, numpy.newaxis]
+        ahead = (filled_arr[found] > found_r) | ((filled_arr[found] == found_r) &
+            (numpy.arange(n_cols) < expected_positions[found][:, numpy.newaxis]))
+        expected_rank[found] = 1 + ahead.sum(axis=1)
+        scores_df.insert(0, "DepMap_ID", expected_depmap_s.reindex(corr_df.index))
+    scores_df["expected_rank"] = pd.array(numpy.where(numpy.isnan(expected_rank), None, expected_rank), dtype="Int64")
+    scores_df["expected_r"] = expected_r
+    scores_df["ambiguous_match"] = margin < ambiguous_margin
+    logger.debug("\nscores_df\n{}".format(scores_df))
+    return scores_df
+
+# match scores from the top k long table: as score_matches, but the z-score needs the whole row so it is nan, and the
+# expected DepMap_ID only has a rank and r when it made the top k
+def score_top_k_matches(top_k_df, expected_depmap_s=None, ambiguous_margin=DEFAULT_AMBIGUOUS_MARGIN):
+    best_df = top_k_df[top_k_df["rank"] == 1]
+    top2_r = top_k_df[top_k_df["rank"] == 2]["r"].reindex(best_df.index)
+    scores_df = pd.DataFrame({"top_corr_depmap_ID": best_df["DepMap_ID"], "top1_r": best_df["r"], "top2_r": top2_r,
+        "margin": best_df["r"] - top2_r, "zscore": numpy.nan}, index=best_df.index)
+
+    if expected_depmap_s is not None:
+        expected_ids = expected_depmap_s.reindex(top_k_df.index).to_numpy()
+        expected_df = top_k_df[top_k_df["DepMap_ID"].to_numpy() == expected_ids].reindex(best_df.index)
+        scores_df.insert(0, "DepMap_ID", expected_depmap_s.reindex(best_df.index))
+        scores_df["expected_rank"] = expected_df["rank"].astype("Int64")
+        scores_df["expected_r"] = expected_df["r"]
+    else:
+        scores_df["expected_rank"] = pd.array([None] * len(scores_df), dtype="Int64")
+        scores_df["expected_r"] = numpy.nan
+    scores_df["ambiguous_match"] = scores_df["margin"] < ambiguous_margin
+    logger.debug("\nscores_df\n{}".format(scores_df))
+    return scores_df
+
+# return series of the depmap ID with the best correlation for every row of the full correlation df
+def identify_best_match(corr_df):
+    cl_match_ID_s = score_matches(corr_df)["top_corr_depmap_ID"]
+    logger.debug("\ncl_match_ID_s\n{}".format(cl_match_ID_s))
+    return cl_match_ID_s
+
+# whether the loaded correlation file is the long top k table (sample_id, rank, DepMap_ID, r) rather than the full matrix
+def is_top_k_df(corr_df):
+    return {"rank", "DepMap_ID", "r"}.issubset(corr_df.columns)
+
+# return series of the depmap ID ranked first in the top k long table - it is already ranked, so no rank over the row is needed
+def identify_top_k_match(top_k_df):
+    best_df = top_k_df[top_k_df["rank"] == 1]
+    cl_match_ID_s = best_df["DepMap_ID"].copy()
+    logger.debug("\ncl_match_ID_s\n{}".format(cl_match_ID_s))
+    cl_match_ID_s.name = "top_corr_depmap_ID"
+    return cl_match_ID_s
+
+# match scores for the loaded correlation df (full matrix or top k long table) against the DepMap_ID annotated in the
+# query column metadata, and logs how many matches are ambiguous
+def build_match_scores(corr_df, query_expr_col_meta_df, ambiguous_margin=DEFAULT_AMBIGUOUS_MARGIN):
+    expected_depmap_s = query_expr_col_meta_df["DepMap_ID"]
+    if is_top_k_df(corr_df):
+        match_scores_df = score_top_k_matches(corr_df, expected_depmap_s, ambiguous_margin=ambiguous_margin)
+    else:
+        match_scores_df = score_matches(corr_df, expected_depmap_s, ambiguous_margin=ambiguous_margin)
+
+    n_ambiguous = match_scores_df["ambiguous_match"].sum()
+    if n_ambiguous > 0:
+        logger.info("{} of {} samples have an ambiguous top match (margin < {})".format(n_ambiguous, len(match_scores_df), ambiguous_margin))
+    return match_scores_df
+
 # adds column onto df that tells us whether the depmap_id that has the best correlation matches the depmap id in query_expr col metadata
-def compare_depmap_id(query_expr_col_meta_df, cl_match_ID_s):
+# given the near-twin pairs of the reference (see reference_similarity.find_near_twins), also adds a near_twin_match
+# column: mismatches whose top match is a known near twin of the annotated DepMap_ID
+def compare_depmap_id(query_expr_col_meta_df, cl_match_ID_s, near_twins_df=None):
     logger.debug("\n\nquery_expr_col_meta_df\n {} \n df_cl_match_ID_depmap_ID_col\n{}\n".format(query_expr_col_meta_df, cl_match_ID_s))
     df_match = query_expr_col_meta_df.join(cl_match_ID_s)
     logger.debug("\n df_match\n{}".format(df_match))
     df_match["cell_line_match"] = df_match.DepMap_ID == df_match["top_corr_depmap_ID"]
+    if near_twins_df is not None:
+        near_twin_pairs = pd.MultiIndex.from_frame(near_twins_df[["DepMap_ID", "near_twin_depmap_ID"]])
+        sample_pairs = pd.MultiIndex.from_arrays([df_match["DepMap_ID"], df_match["top_corr_depmap_ID"]])
+        df_match["near_twin_match"] = ~df_match["cell_line_match"] & sample_pairs.isin(near_twin_pairs)
     logger.debug("\n df_match\n{}".format(df_match))
     return df_match
     
 # checks for whether any values in the cell_line_match column of df are False, meaning the depmap_id doesn't have a match
+# mismatches flagged as near_twin_match (see compare_depmap_id) are only logged as warnings
 def check_for_warnings(compared_depmaps_df):
     #depmapid, bio_context_id, top_corr, cell_linematch
+    if "near_twin_match" in compared_depmaps_df.columns:
+        near_twin_df = compared_depmaps_df[compared_depmaps_df.near_twin_match]
+        if not near_twin_df.empty:
+            logger.warning("\nThe top match of the following samples is a near twin of their DepMap ID.\n{}\n".format(
+                near_twin_df[["DepMap_ID", "top_corr_depmap_ID"]]))
+        compared_depmaps_df = compared_depmaps_df[~compared_depmaps_df.near_twin_match]
     depmap_no_match_df = compared_depmaps_df[~compared_depmaps_df.cell_line_match]
     logger.debug("\n~compared_depmaps_df.cell_line_match:\n{}".format(~compared_depmaps_df.cell_line_match))
     logger.debug("\ndepmap_no_match_df:\n{}".format(depmap_no_match_df))
@@ -77,6 +207,26 @@ def check_for_warnings(compared_depmaps_df):
             raise FhtbioinfpyCellLineAuthenticationNoDepMapIDMatch(msg)
      
 
+# the near-twin pairs of args.ref_store_dir (None when no store is given); a store without a self-similarity map is
+# only warned about, every mismatch is then reported as before
+def load_near_twins(args):
+    if args.ref_store_dir is None:
+        return None
+    near_twins_df = reference_similarity.load_near_twins(args.ref_store_dir, min_r=args.near_twin_min_r)
+    if near_twins_df is None:
+        logger.warning("{} has no reference self-similarity map, near twins are not flagged (see reference_similarity)".format(args.ref_store_dir))
+    return near_twins_df
+
+# saves the match scores as a csv/txt file
+def save_match_scores_df(match_scores_df, exp_id, subdir):
+    output_filename = "{experiment_id}_cell_line_authentication_match_scores_r{nrows}x{ncols}.txt".format(
+        experiment_id=exp_id, nrows=match_scores_df.shape[0], ncols=match_scores_df.shape[1]
+    )
+    output_filepath = os.path.join(subdir, output_filename)
+    logger.debug("output_filepath : {}".format(output_filepath))
+    match_scores_df.to_csv(output_filepath, sep="\t")
+    return output_filepath
+
 # saves the compared_depmap_df as a csv/txt file
 def save_compared_depmap_df(compared_depmap_df, exp_id, subdir):
     compared_depmap_df_shape = compared_depmap_df.shape
@@ -90,23 +240,35 @@ def save_compared_depmap_df(compared_depmap_df, exp_id, subdir):
     return output_filepath
 
 def main(args):
-    query_expr_gctoo = read_RNA_seq_gctx(args.query_expr_filepath)
-    # load correlation_df
-    corr_df = load_correlation_df(args.corr_filepath)
+    profiler = stage_profiler.StageProfiler("cell_line_authentication", enabled=args.profile)
+    with profiler.stage("load") as stage:
+        query_expr_gctoo = read_RNA_seq_gctx(args.query_expr_filepath)
+        # load correlation_df
+        corr_df = load_correlation_df(args.corr_filepath)
+        near_twins_df = load_near_twins(args)
+        stage_profiler.add_shapes(stage, query_expr=query_expr_gctoo.data_df, corr_df=corr_df)
     
     if not os.path.isdir(args.output_subdir):
         os.mkdir(args.output_subdir)
 
    
-    corr_rank_df = corr_df.rank(axis = 1, method = "first", ascending = False)
-    cl_match_ID_s = identify_rank(corr_rank_df) #1 of the columns
+    # top match, margin, z-score and the rank of the expected DepMap_ID per sample
+    with profiler.stage("rank") as stage:
+        match_scores_df = build_match_scores(corr_df, query_expr_gctoo.col_metadata_df, ambiguous_margin=args.ambiguous_margin)
+        stage_profiler.add_shapes(stage, match_scores_df=match_scores_df)
+    cl_match_ID_s = match_scores_df["top_corr_depmap_ID"] #1 of the columns
 
 
     #yes/no column - does query_exp depmap match with ref_Exp depmap
-    compared_depmap_df = compare_depmap_id(query_expr_gctoo.col_metadata_df, cl_match_ID_s) #merge them and check if they match
+    with profiler.stage("compare") as stage:
+        compared_depmap_df = compare_depmap_id(query_expr_gctoo.col_metadata_df, cl_match_ID_s, near_twins_df=near_twins_df) #merge them and check if they match
+        stage_profiler.add_shapes(stage, compared_depmap_df=compared_depmap_df)
 
     # save df
-    save_compared_depmap_df(compared_depmap_df, args.experiment_id, args.output_subdir)
+    with profiler.stage("save"):
+        save_match_scores_df(match_scores_df, args.experiment_id, args.output_subdir)
+        save_compared_depmap_df(compared_depmap_df, args.experiment_id, args.output_subdir)
+    profiler.save_report(args.experiment_id, args.output_subdir)
 
     #looks through output_df, finds where compared)depmaps_df is False , throw exception "doesn't match"
     check_for_warnings(compared_depmap_df)
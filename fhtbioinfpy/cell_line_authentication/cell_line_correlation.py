@@ -1,34 +1,101 @@
-import ast
 import logging
-import operator
-import re
-import shutil
 import fhtbioinfpy.setup_logger as setup_logger
+import fhtbioinfpy.stage_profiler as stage_profiler
 import argparse
 import sys
 
 import os
 import pandas as pd
 import numpy
-import collections
-import cmapPy
+import concurrent.futures
+import multiprocessing.shared_memory as shared_memory
 import cmapPy.pandasGEXpress.parse as parse
+import cmapPy.pandasGEXpress.parse_gctx as parse_gctx
+import cmapPy.pandasGEXpress.write_gctx as write_gctx
+import cmapPy.pandasGEXpress.GCToo as GCToo
+import json
+import h5py
 import cmapPy.math.fast_corr as fast_corr
-
-import plotly.express as pltexpr
+import fhtbioinfpy.cell_line_authentication.reference_store as reference_store
+import fhtbioinfpy.cell_line_authentication.gene_alignment as gene_alignment
+import fhtbioinfpy.cell_line_authentication.correlation_cache as correlation_cache
+import fhtbioinfpy.cell_line_authentication.candidate_index as candidate_index
 
 logger = logging.getLogger(setup_logger.LOGGER_NAME)
 
+# working memory for the blocks of the top k search when no --memory_budget_mb is given
+DEFAULT_TOP_K_MEMORY_BUDGET_MB = 256
+TOP_K_COLUMNS = ["sample_id", "rank", "DepMap_ID", "r"]
+
+# standardized reference of a correlation worker process, attached from shared memory by _init_correlation_worker
+_worker_shared_memory = None
+_worker_ref_std = None
+# query partitions handed out per worker process (so a slow partition does not hold up the pool), and the narrowest
+# partition: each one is a single matrix multiply, which a handful of columns would not amortize
+QUERY_PARTITIONS_PER_WORKER = 4
+MIN_QUERY_PARTITION_COLUMNS = 32
+
+# samples recomputed in float64 by the --dtype float32 accuracy guard, and how far their margins may drift
+DEFAULT_ACCURACY_CHECK_SAMPLES = 32
+DEFAULT_ACCURACY_MARGIN_TOLERANCE = 1e-3
+
+CORR_OUTPUT_FORMATS = ["txt", "npy", "parquet", "gctx"]
+# row and column labels of a .npy correlation matrix are written next to it in <matrix basename>_labels.json
+NPY_LABELS_SUFFIX = "_labels.json"
+
+# query columns reranked together by the candidate search, which bounds the union of their candidate reference columns
+CANDIDATE_QUERY_BLOCK_SIZE = 256
+
+
+# argparse type of the options that only make sense for a count of at least 1
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("{} is not a positive integer".format(value))
+    return number
+
 
 def build_parser():
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument("--verbose", "-v", help="Whether to print a bunch of output.", action="store_true", default=False)
+    add_query_arguments(parser)
+    add_common_arguments(parser)
+    return add_output_arguments(parser)
+
+
+# the query file, experiment id and query samples of a single run; batch and server parsers take them from elsewhere
+def add_query_arguments(parser):
     parser.add_argument("--query_expr_filepath", help="query expression file: sample_id and depmap_id", type=str, required = True)
-    parser.add_argument("--ref_expr_filepath", help="reference expression file: in-house RNA-seq dataset", type=str, required = True)
     parser.add_argument("--experiment_id", help = "specific id for experiment", required = True)
+    parser.add_argument("--query_sample_ids", help="if provided, only these query samples (column ids) are loaded and correlated", default=None, nargs="+")
+    return parser
+
+
+# where and how the outputs of a run are written; the server, which answers requests instead, does not take them
+def add_output_arguments(parser):
     parser.add_argument("--output_subdir", help="subdirectory for output", type=str, default="./cell_line_auth/")
+    parser.add_argument("--output_format", help="file format of the saved correlation matrix; npy is written with a _labels.json sidecar. The top k long table of --top_k is always txt", choices=CORR_OUTPUT_FORMATS, default="txt")
+    parser.add_argument("--output_dtype", help="if provided, precision of the saved correlation values; otherwise they are saved in the precision they were computed in (see --dtype). Not combined with --top_k", choices=["float64", "float32"], default=None)
+    parser.add_argument("--profile", help="record wall time, CPU time, RSS and array shapes of each stage into a JSON report in output_subdir", action="store_true", default=False)
+    return parser
+
+
+# the reference and correlation options shared by cell_line_correlation and the entry points built on it
+def add_common_arguments(parser):
+    parser.add_argument("--verbose", "-v", help="Whether to print a bunch of output.", action="store_true", default=False)
+    parser.add_argument("--ref_expr_filepath", help="reference expression file: in-house RNA-seq dataset, or a reference store directory compiled by reference_store", type=str, required = True)
     parser.add_argument("--row_metadata_for_matching", help="the column from query_row_metadata to use to match rows of query with rows of reference", type=str, default = "gene_symbol")
-        
+    parser.add_argument("--duplicate_gene_aggregation", help="how query (or reference) rows sharing a row_metadata_for_matching label are collapsed", choices=gene_alignment.AGGREGATIONS, default="mean")
+    parser.add_argument("--alignment_cache_dir", help="if provided, directory to cache the gene alignment of a query row metadata / reference pair", type=str, default=None)
+    parser.add_argument("--method", help="correlation method", choices=["pearson", "spearman"], default="pearson")
+    parser.add_argument("--rank_cache_dir", help="directory to cache reference ranks for --method spearman (a compiled reference store caches them inside the store)", type=str, default=None)
+    parser.add_argument("--memory_budget_mb", help="if provided, compute the correlations in blocks of query and reference columns whose working memory stays within this budget (MB)", type=float, default=None)
+    parser.add_argument("--dtype", help="precision of the standardization and matrix product; float32 is checked against float64 on a sample of the query. Not combined with --pca_candidates", choices=["float64", "float32"], default="float64")
+    parser.add_argument("--accuracy_check_samples", help="number of query samples recomputed in float64 to check a --dtype float32 run", type=positive_int, default=DEFAULT_ACCURACY_CHECK_SAMPLES)
+    parser.add_argument("--top_k", help="if provided, only keep the k best correlated reference columns per query sample and save them as a long table instead of the full correlation matrix", type=positive_int, default=None)
+    parser.add_argument("--workers", help="if provided, number of processes to split the query samples over; the standardized reference is shared between them. Not combined with --top_k, --pca_candidates or --memory_budget_mb", type=positive_int, default=None)
+    parser.add_argument("--pca_candidates", help="if provided, only this many best reference columns of the truncated SVD index of a compiled reference store (built with candidate_index) are correlated exactly for each query sample; the others are left nan. Without an index the exact engine runs. Computed in float64, so not combined with --dtype float32", type=positive_int, default=None)
+    parser.add_argument("--cache_dir", help="if provided, directory of the per-sample correlation cache; samples whose expression, reference and settings were correlated before are merged from it instead of recomputed", type=str, default=None)
+    parser.add_argument("--cache_max_mb", help="size limit of --cache_dir (MB), least recently used entries are evicted beyond it", type=float, default=correlation_cache.DEFAULT_CACHE_MAX_MB)
     return parser
 
 
@@ -50,6 +117,95 @@ def load_ref_expr_data(ref_expr_file):
     ref_expr.head()
     return ref_expr_gctoo
 
+# reads the given rows (and optionally columns) of the data matrix of a GCTX file, returned in the requested order and
+# in the dtype of the file. GCTX stores the matrix transposed (columns x rows); only the requested columns are selected,
+# and rows are read as contiguous slices of sorted positions, or straight from a memory map of the file when the dataset
+# is stored contiguous and uncompressed
+def read_gctx_rows(gctx_file, ridx, cidx=None):
+    # the memory map opens the file by path as well, so both need the expanded one
+    gctx_file = os.path.expanduser(gctx_file)
+    ridx = numpy.asarray(ridx, dtype=numpy.int64)
+    sorted_ridx, inverse_ridx = numpy.unique(ridx, return_inverse=True)
+    if cidx is not None:
+        # h5py selects a list of positions only when it is increasing and without repeats
+        sorted_cidx, inverse_cidx = numpy.unique(numpy.asarray(cidx, dtype=numpy.int64), return_inverse=True)
+
+    with h5py.File(gctx_file, "r") as gctx:
+        data_dset = gctx[parse_gctx.data_node]
+        n_file_cols, n_file_rows = data_dset.shape
+
+        layout = data_dset.id.get_create_plist().get_layout()
+        if layout == h5py.h5d.CONTIGUOUS and data_dset.compression is None and data_dset.id.get_offset() is not None:
+            logger.debug("reading {} rows of {} from memory map".format(len(sorted_ridx), gctx_file))
+            data_mmap = numpy.memmap(gctx_file, dtype=data_dset.dtype, mode="r", offset=data_dset.id.get_offset(), shape=data_dset.shape)
+            data_array = data_mmap[:, sorted_ridx] if cidx is None else data_mmap[numpy.ix_(sorted_cidx, sorted_ridx)]
+            del data_mmap
+        else:
+            # split the sorted rows into runs of consecutive positions and read each run as one hyperslab
+            run_starts = numpy.flatnonzero(numpy.diff(sorted_ridx, prepend=-2) != 1)
+            run_stops = numpy.append(run_starts[1:], len(sorted_ridx))
+            logger.debug("reading {} rows of {} in {} contiguous slices".format(len(sorted_ridx), gctx_file, len(run_starts)))
+            col_selection = slice(None) if cidx is None else sorted_cidx
+            data_array = numpy.empty((n_file_cols if cidx is None else len(sorted_cidx), len(sorted_ridx)), dtype=data_dset.dtype)
+            for start, stop in zip(run_starts, run_stops):
+                data_array[:, start:stop] = data_dset[col_selection, sorted_ridx[start]:sorted_ridx[stop - 1] + 1]
+
+    data_array = data_array.T[inverse_ridx]
+    return data_array if cidx is None else data_array[:, inverse_cidx]
+
+# positions of query_sample_ids in sample_ids; raises when some of them are not there
+def find_query_samples(query_sample_ids, sample_ids):
+    positions = pd.Index(sample_ids).get_indexer(query_sample_ids)
+    if (positions < 0).any():
+        msg = """\n!!!\nSome query_sample_ids were not found in the query columns.\n{}\n""".format(
+            [sample_id for sample_id, position in zip(query_sample_ids, positions) if position < 0]
+        )
+        logger.exception(msg)
+        raise FhtbioinfpyCellLineCorrelationQuerySampleNotFound(msg)
+    return positions
+
+# metadata-first loading: reads only the row metadata of the GCTX query (and the row ids of a GCTX reference or
+# the gene index of a compiled store), intersects the genes, then reads just those rows (and optionally only the
+# requested query columns) from the data matrices. Returns the same matched datasets as build_matched_datasets
+def load_matched_gctx_datasets(query_expr_file, ref_expr_file, row_metadata_for_matching, query_sample_ids=None,
+        aggregation="mean", alignment_cache_dir=None):
+    query_row_meta = parse_gctx.get_row_metadata(query_expr_file)
+    query_col_meta = parse_gctx.get_column_metadata(query_expr_file)
+
+    ref_manifest = None
+    if reference_store.is_reference_store(ref_expr_file):
+        ref_expr_df, ref_manifest = reference_store.load_reference_store(ref_expr_file)
+        ref_genes = ref_expr_df.index
+    else:
+        ref_row_meta = parse_gctx.get_row_metadata(ref_expr_file)
+        ref_col_meta = parse_gctx.get_column_metadata(ref_expr_file)
+        ref_genes = ref_row_meta.index
+
+    alignment = gene_alignment.load_or_build_gene_alignment(query_row_meta[row_metadata_for_matching].to_numpy(),
+        ref_genes, aggregation=aggregation, cache_dir=alignment_cache_dir)
+
+    # unnamed column index, like the query_set_index join gives
+    query_cidx = None
+    query_columns = query_col_meta.index.rename(None)
+    if query_sample_ids is not None:
+        query_cidx = find_query_samples(query_sample_ids, query_col_meta.index)
+        query_columns = query_columns[query_cidx]
+
+    query_arr = gene_alignment.aggregate_aligned_rows(read_gctx_rows(query_expr_file, alignment.query_positions, query_cidx),
+        alignment.query_group_starts, aggregation)
+    subset_query_expr = pd.DataFrame(query_arr, index=pd.Index(alignment.genes, name=row_metadata_for_matching), columns=query_columns)
+
+    if ref_manifest is not None:
+        ref_arr = ref_expr_df.to_numpy()[alignment.ref_positions]
+    else:
+        ref_arr = read_gctx_rows(ref_expr_file, alignment.ref_positions)
+    ref_arr = gene_alignment.aggregate_aligned_rows(ref_arr, alignment.ref_group_starts, aggregation)
+    subset_ref_expr = pd.DataFrame(ref_arr, index=pd.Index(alignment.genes, name=ref_genes.name),
+        columns=ref_expr_df.columns if ref_manifest is not None else ref_col_meta.index)
+
+    logger.debug("subset_query_expr.shape: {}  subset_ref_expr.shape: {}".format(subset_query_expr.shape, subset_ref_expr.shape))
+    return subset_query_expr, subset_ref_expr, ref_manifest
+
 # adds users choice to query row metadata (Default: gene_index), 
 def query_set_index(query_expr_gctoo, row_metadata_for_matching):
     query_expr_df = query_expr_gctoo.data_df.join(
@@ -58,22 +214,15 @@ def query_set_index(query_expr_gctoo, row_metadata_for_matching):
     return query_expr_df
 
 # returns a subset of the query_expr and subset of the ref_expr that only has the intersection of both indices / shortens size of index (genes)
-def build_matched_datasets(query_expr, ref_expr):
-    A = set(query_expr.index)
-    logger.debug("\nlen(query_expr set):\n{}\n".format(len(A)))
-    B = set(ref_expr.index)
-    logger.debug("\nlen(ref_expr set):\n{}\n".format(len(B)))
-
-    gene_intersection_set = A.intersection(B)
-    logger.debug("\nlen(gene_intersection_set): \n{}\n".format(len(gene_intersection_set)))
-    gene_intersection_list = sorted(gene_intersection_set)
-
-    logger.debug("\ngene_intersection_list[:3] : \n{}\n".format(gene_intersection_list[:3]))
+# duplicate labels in either index are collapsed with aggregation; pass a (cached) alignment to skip building it
+def build_matched_datasets(query_expr, ref_expr, aggregation="mean", alignment=None):
+    if alignment is None:
+        alignment = gene_alignment.build_gene_alignment(query_expr.index, ref_expr.index, aggregation=aggregation)
+    logger.debug("\nalignment.genes[:3] : \n{}\n".format(alignment.genes[:3]))
 
     # rearranges the query expression data and reference expression data
     # so that the genes (the index of both dataframes) is in the same order
-    subset_query_expr = query_expr.loc[gene_intersection_list]
-    subset_ref_expr = ref_expr.loc[gene_intersection_list]
+    subset_query_expr, subset_ref_expr = gene_alignment.apply_gene_alignment(alignment, query_expr, ref_expr)
 
     return subset_query_expr, subset_ref_expr
 
@@ -88,45 +237,537 @@ def run_correlation_calculation(subset_query_expr, subset_ref_expr):
     #column depmapID
     return corr_df
 
-# save the correlation df as csv/txt file
-def save_corr_df(corr_df, exp_id, subdir):
+# standardized reference columns in the compute dtype: store columns are only cast, anything else is standardized
+def _standardize_ref(ref_arr, ref_is_standardized, dtype=numpy.float64):
+    if ref_is_standardized:
+        return numpy.asarray(ref_arr, dtype=dtype)
+    return reference_store.standardize_columns(ref_arr, dtype=dtype)
+
+# correlation against a compiled reference store, whose columns are already standardized over the full store gene index
+# pearson is unchanged by shifting/scaling a column, so when only a subset of the store genes is matched the
+# standardized subset is simply standardized again
+def run_standardized_correlation(subset_query_expr, subset_ref_std, ref_is_standardized=True, dtype=numpy.float64):
+    query_std = reference_store.standardize_columns(subset_query_expr.to_numpy(), dtype=dtype)
+    ref_std = _standardize_ref(subset_ref_std.to_numpy(), ref_is_standardized, dtype=dtype)
+    corr_arr = query_std.T.dot(ref_std)
+    logger.debug("\ncorr_arr:\n{}".format(corr_arr))
+    corr_df = pd.DataFrame(corr_arr, columns=subset_ref_std.columns, index = subset_query_expr.columns)
+    corr_df.index.name = subset_query_expr.columns.name
+    return corr_df
+
+# replaces query expression values with their per-sample ranks and the reference with its (cached) standardized ranks,
+# so that the pearson engines below compute spearman correlation
+def build_ranked_datasets(subset_query_expr, subset_ref_expr, fingerprint, rank_cache_dir=None):
+    ranked_query_expr = pd.DataFrame(reference_store.rank_columns(subset_query_expr.to_numpy()),
+        index=subset_query_expr.index, columns=subset_query_expr.columns)
+    ref_rank_std_df = reference_store.load_or_compute_standardized_ranks(subset_ref_expr, fingerprint, cache_dir=rank_cache_dir)
+    return ranked_query_expr, ref_rank_std_df
+
+# number of query and reference columns per block so that the two standardized blocks plus their correlation block
+# fit in the memory budget: n_genes*(query_block + ref_block) + query_block*ref_block elements
+def compute_block_sizes(n_genes, n_query, n_ref, memory_budget_bytes, itemsize=8):
+    budget_elements = max(memory_budget_bytes // itemsize, 1)
+
+    # square blocks first, then hand whatever the smaller side does not need to the other side
+    block_size = int(numpy.sqrt(n_genes**2 + budget_elements) - n_genes)
+    query_block_size = max(min(block_size, n_query), 1)
+    ref_block_size = int((budget_elements - n_genes * query_block_size) // (n_genes + query_block_size))
+    ref_block_size = max(min(ref_block_size, n_ref), 1)
+    if ref_block_size == n_ref:
+        query_block_size = int((budget_elements - n_genes * ref_block_size) // (n_genes + ref_block_size))
+        query_block_size = max(min(query_block_size, n_query), 1)
+
+    logger.debug("query_block_size: {}  ref_block_size: {}".format(query_block_size, ref_block_size))
+    return query_block_size, ref_block_size
+
+# correlation computed over blocks of query and reference columns, so only one pair of standardized blocks is held at a time
+def run_blocked_correlation(subset_query_expr, subset_ref_expr, memory_budget_mb, ref_is_standardized=False, dtype=numpy.float64):
+    n_genes, n_query = subset_query_expr.shape
+    n_ref = subset_ref_expr.shape[1]
+    query_block_size, ref_block_size = compute_block_sizes(n_genes, n_query, n_ref, int(memory_budget_mb * 1024**2),
+        itemsize=numpy.dtype(dtype).itemsize)
+
+    corr_arr = numpy.empty((n_query, n_ref), dtype=dtype)
+    for ref_start in range(0, n_ref, ref_block_size):
+        ref_stop = min(ref_start + ref_block_size, n_ref)
+        ref_block_std = _standardize_ref(subset_ref_expr.iloc[:, ref_start:ref_stop].to_numpy(), ref_is_standardized, dtype=dtype)
+
+        for query_start in range(0, n_query, query_block_size):
+            query_stop = min(query_start + query_block_size, n_query)
+            query_block_std = reference_store.standardize_columns(subset_query_expr.iloc[:, query_start:query_stop].to_numpy(), dtype=dtype)
+            corr_arr[query_start:query_stop, ref_start:ref_stop] = query_block_std.T.dot(ref_block_std)
+
+    corr_df = pd.DataFrame(corr_arr, columns=subset_ref_expr.columns, index = subset_query_expr.columns, copy=False)
+    corr_df.index.name = subset_query_expr.columns.name
+    return corr_df
+
+# runs once in each worker process: attaches to the standardized reference in shared memory instead of receiving a pickled copy
+def _init_correlation_worker(shared_memory_name, ref_shape, ref_dtype):
+    global _worker_shared_memory, _worker_ref_std
+    _worker_shared_memory = shared_memory.SharedMemory(name=shared_memory_name)
+    _worker_ref_std = numpy.ndarray(ref_shape, dtype=ref_dtype, buffer=_worker_shared_memory.buf)
+
+# correlations of one partition of query columns against the shared reference
+def _correlate_query_partition(query_partition):
+    query_std = reference_store.standardize_columns(query_partition, dtype=_worker_ref_std.dtype)
+    return query_std.T.dot(_worker_ref_std)
+
+# splits the query columns into contiguous partitions, a few per worker and at least min_columns wide
+def build_query_partitions(n_query, workers, min_columns=MIN_QUERY_PARTITION_COLUMNS):
+    partition_size = max(int(numpy.ceil(n_query / (workers * QUERY_PARTITIONS_PER_WORKER))), min_columns, 1)
+    return [(start, min(start + partition_size, n_query)) for start in range(0, n_query, partition_size)]
+
+# correlation with the query columns split into partitions scored in a process pool; the standardized reference is
+# placed in shared memory once and every worker reads it from there. Every sample is scored like
+# run_standardized_correlation scores it, so the result matches it up to floating point rounding of the matrix products.
+# A query that makes a single partition is scored in this process, without the pool or the shared memory
+def run_parallel_correlation(subset_query_expr, subset_ref_expr, workers, ref_is_standardized=False, dtype=numpy.float64):
+    partitions = build_query_partitions(subset_query_expr.shape[1], workers)
+    logger.debug("number of query partitions: {}  workers: {}".format(len(partitions), workers))
+    if workers <= 1 or len(partitions) <= 1:
+        return run_standardized_correlation(subset_query_expr, subset_ref_expr, ref_is_standardized=ref_is_standardized, dtype=dtype)
+
+    ref_std = _standardize_ref(subset_ref_expr.to_numpy(), ref_is_standardized, dtype=dtype)
+    query_arr = subset_query_expr.to_numpy()
+    query_partitions = [query_arr[:, start:stop] for start, stop in partitions]
+
+    ref_shared_memory = shared_memory.SharedMemory(create=True, size=max(ref_std.nbytes, 1))
+    try:
+        shared_ref_std = numpy.ndarray(ref_std.shape, dtype=ref_std.dtype, buffer=ref_shared_memory.buf)
+        shared_ref_std[:] = ref_std
+        del ref_std
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(query_partitions)), initializer=_init_correlation_worker,
+                initargs=(ref_shared_memory.name, shared_ref_std.shape, shared_ref_std.dtype)) as executor:
+            partition_corrs = list(executor.map(_correlate_query_partition, query_partitions))
+        del shared_ref_std
+    finally:
+        ref_shared_memory.close()
+        ref_shared_memory.unlink()
+
+    corr_arr = numpy.vstack(partition_corrs)
+    corr_df = pd.DataFrame(corr_arr, columns=subset_ref_expr.columns, index = subset_query_expr.columns, copy=False)
+    corr_df.index.name = subset_query_expr.columns.name
+    return corr_df
+
+# picks the correlation engine: query partitions in a process pool when more than one worker is requested, blocked
+# when a memory budget is given, a single matrix multiply against a standardized reference (or in reduced precision),
+# otherwise fast_corr
+def run_correlation(subset_query_expr, subset_ref_expr, ref_is_standardized=False, memory_budget_mb=None, workers=None,
+        dtype=numpy.float64):
+    if workers is not None and workers > 1:
+        corr_df = run_parallel_correlation(subset_query_expr, subset_ref_expr, workers, ref_is_standardized=ref_is_standardized, dtype=dtype)
+    elif memory_budget_mb is not None:
+        corr_df = run_blocked_correlation(subset_query_expr, subset_ref_expr, memory_budget_mb, ref_is_standardized=ref_is_standardized, dtype=dtype)
+    elif ref_is_standardized or numpy.dtype(dtype) != numpy.float64:
+        corr_df = run_standardized_correlation(subset_query_expr, subset_ref_expr, ref_is_standardized=ref_is_standardized, dtype=dtype)
+    else:
+        corr_df = run_correlation_calculation(subset_query_expr, subset_ref_expr)
+    return corr_df
+
+# raises when --workers is combined with an engine option the process pool does not honor: the top k search, the
+# candidate search and the memory budget each run in a single process. Also raises for --dtype float32 with
+# --pca_candidates, whose candidate correlations are always computed (and so never checked) in float64
+def check_engine_arguments(args):
+    if args.pca_candidates is not None and args.dtype != "float64":
+        msg = """\n!!!\n--dtype {} cannot be combined with --pca_candidates; the candidate correlations are computed in float64.\n""".format(
+            args.dtype)
+        logger.exception(msg)
+        raise FhtbioinfpyCellLineCorrelationIncompatibleArguments(msg)
+    if args.workers is None or args.workers <= 1:
+        return
+    conflicting = [option for option, value in [("--top_k", args.top_k), ("--pca_candidates", args.pca_candidates),
+        ("--memory_budget_mb", args.memory_budget_mb)] if value is not None]
+    if len(conflicting) > 0:
+        msg = """\n!!!\n--workers {} cannot be combined with {}; run them without --workers (or with --workers 1).\n""".format(
+            args.workers, ", ".join(conflicting))
+        logger.exception(msg)
+        raise FhtbioinfpyCellLineCorrelationIncompatibleArguments(msg)
+
+# merges a block of correlations into the running k best values per row (and their reference column positions), best
+# first. Ties are broken by reference column position, so the selection is the same whatever the block sizes are
+def merge_top_k(top_values, top_positions, block_corr, block_start, k):
+    block_positions = numpy.broadcast_to(numpy.arange(block_start, block_start + block_corr.shape[1]), block_corr.shape)
+    # nan correlations (constant columns) never make it into the top k
+    block_corr = numpy.where(numpy.isnan(block_corr), -numpy.inf, block_corr)
+
+    candidate_values = numpy.hstack([top_values, block_corr])
+    candidate_positions = numpy.hstack([top_positions, block_positions])
+    # sorts each row by r (descending), then by position
+    keep = numpy.lexsort((candidate_positions, -candidate_values), axis=1)[:, :k]
+    return numpy.take_along_axis(candidate_values, keep, axis=1), numpy.take_along_axis(candidate_positions, keep, axis=1)
+
+# the k best correlated reference columns for each query sample, computed block by block so the full
+# query x reference correlation matrix is never held in memory. Returns a long table: sample_id, rank, DepMap_ID, r
+def run_top_k_correlation(subset_query_expr, subset_ref_expr, k, ref_is_standardized=False, memory_budget_mb=None,
+        dtype=numpy.float64):
+    if memory_budget_mb is None:
+        memory_budget_mb = DEFAULT_TOP_K_MEMORY_BUDGET_MB
+    n_genes, n_query = subset_query_expr.shape
+    n_ref = subset_ref_expr.shape[1]
+    k = min(k, n_ref)
+    query_block_size, ref_block_size = compute_block_sizes(n_genes, n_query, n_ref, int(memory_budget_mb * 1024**2),
+        itemsize=numpy.dtype(dtype).itemsize)
+
+    top_k_values = numpy.empty((n_query, k), dtype=dtype)
+    top_k_positions = numpy.empty((n_query, k), dtype=numpy.int64)
+    for query_start in range(0, n_query, query_block_size):
+        query_stop = min(query_start + query_block_size, n_query)
+        query_block_std = reference_store.standardize_columns(subset_query_expr.iloc[:, query_start:query_stop].to_numpy(), dtype=dtype)
+
+        block_values = numpy.empty((query_stop - query_start, 0), dtype=dtype)
+        block_positions = numpy.empty((query_stop - query_start, 0), dtype=numpy.int64)
+        for ref_start in range(0, n_ref, ref_block_size):
+            ref_stop = min(ref_start + ref_block_size, n_ref)
+            ref_block_std = _standardize_ref(subset_ref_expr.iloc[:, ref_start:ref_stop].to_numpy(), ref_is_standardized, dtype=dtype)
+
+            block_values, block_positions = merge_top_k(block_values, block_positions, query_block_std.T.dot(ref_block_std), ref_start, k)
+
+        top_k_values[query_start:query_stop] = block_values
+        top_k_positions[query_start:query_stop] = block_positions
+
+    top_k_values[numpy.isneginf(top_k_values)] = numpy.nan
+    return build_top_k_df(subset_query_expr.columns, subset_ref_expr.columns, top_k_positions, top_k_values)
+
+# the long top k table from the (n_query, k) best reference column positions and their r, best first
+def build_top_k_df(query_columns, ref_columns, top_k_positions, top_k_values):
+    n_query, k = top_k_values.shape
+    top_k_df = pd.DataFrame({
+        TOP_K_COLUMNS[0]: numpy.repeat(query_columns.to_numpy(), k),
+        TOP_K_COLUMNS[1]: numpy.tile(numpy.arange(1, k + 1), n_query),
+        TOP_K_COLUMNS[2]: ref_columns.to_numpy()[top_k_positions.ravel()],
+        TOP_K_COLUMNS[3]: top_k_values.ravel(),
+    })
+    logger.debug("\ntop_k_df\n{}".format(top_k_df))
+    return top_k_df
+
+# the long top k table of a correlation matrix
+def top_k_from_corr_df(corr_df, k):
+    k = min(k, corr_df.shape[1])
+    n_query = corr_df.shape[0]
+    top_k_values, top_k_positions = merge_top_k(numpy.empty((n_query, 0)), numpy.empty((n_query, 0), dtype=numpy.int64),
+        corr_df.to_numpy(), 0, k)
+    top_k_values[numpy.isneginf(top_k_values)] = numpy.nan
+    return build_top_k_df(corr_df.index, corr_df.columns, top_k_positions, top_k_values)
+
+# the candidate index saved in the reference store, when the correlation runs on the store's standardized columns
+# (pearson) and the index matches them; otherwise None, with a warning
+def load_store_candidate_index(subset_ref_expr, args):
+    if args.method != "pearson":
+        logger.warning("--pca_candidates only serves --method pearson (the candidate index approximates the pearson correlation of the standardized reference), --method {}: running the exact correlation".format(
+            args.method))
+        return None
+    index = candidate_index.load_candidate_index(args.ref_expr_filepath)
+    if index is None:
+        logger.warning("--pca_candidates needs a candidate index built with candidate_index for a compiled reference store, {} has none: running the exact correlation".format(
+            args.ref_expr_filepath))
+        return None
+    if list(index.columns) != list(subset_ref_expr.columns) or not subset_ref_expr.index.isin(index.genes).all():
+        logger.warning("the candidate index of {} does not cover the reference columns and matched genes of this run: running the exact correlation".format(
+            args.ref_expr_filepath))
+        return None
+    return index
+
+# correlations of each query column with only its n_candidates best reference columns of the candidate index. The
+# candidates are reranked with run_correlation_calculation, one block of query columns (and the union of their
+# candidates) at a time; the other reference columns of each row are nan
+def run_candidate_correlation(subset_query_expr, subset_ref_expr, index, n_candidates):
+    candidate_positions = candidate_index.select_candidates(subset_query_expr, index, n_candidates)
+    n_query, n_ref = subset_query_expr.shape[1], subset_ref_expr.shape[1]
+
+    corr_arr = numpy.full((n_query, n_ref), numpy.nan)
+    for query_start in range(0, n_query, CANDIDATE_QUERY_BLOCK_SIZE):
+        query_stop = min(query_start + CANDIDATE_QUERY_BLOCK_SIZE, n_query)
+        block_candidates = candidate_positions[query_start:query_stop]
+        union_positions = numpy.unique(block_candidates)
+        union_corr_df = run_correlation_calculation(subset_query_expr.iloc[:, query_start:query_stop], subset_ref_expr.iloc[:, union_positions])
+
+        block_values = numpy.take_along_axis(union_corr_df.to_numpy(), numpy.searchsorted(union_positions, block_candidates), axis=1)
+        numpy.put_along_axis(corr_arr[query_start:query_stop], block_candidates, block_values, axis=1)
+    logger.debug("reranked {} candidates of {} reference columns per query sample".format(candidate_positions.shape[1], n_ref))
+
+    corr_df = pd.DataFrame(corr_arr, columns=subset_ref_expr.columns, index = subset_query_expr.columns, copy=False)
+    corr_df.index.name = subset_query_expr.columns.name
+    return corr_df
+
+# best reference column of every row of a correlation matrix and its margin over the second best, with a partial selection
+def top_match_margins(corr_arr):
+    corr_arr = numpy.where(numpy.isnan(corr_arr), -numpy.inf, corr_arr)
+    if corr_arr.shape[1] < 2:
+        return numpy.zeros(corr_arr.shape[0], dtype=numpy.int64), numpy.full(corr_arr.shape[0], numpy.nan)
+    top_two_positions = numpy.argpartition(-corr_arr, 1, axis=1)[:, :2]
+    top_two_values = numpy.take_along_axis(corr_arr, top_two_positions, axis=1)
+    best = numpy.argmax(top_two_values, axis=1)[:, numpy.newaxis]
+    best_positions = numpy.take_along_axis(top_two_positions, best, axis=1)[:, 0]
+    margins = numpy.abs(top_two_values[:, 0] - top_two_values[:, 1])
+    return best_positions, margins
+
+# top_corr_depmap_ID and margin (top 1 r - top 2 r) per sample, from the full correlation matrix
+def summarize_top_matches(corr_df):
+    best_positions, margins = top_match_margins(corr_df.to_numpy())
+    return pd.DataFrame({"top_corr_depmap_ID": corr_df.columns.to_numpy()[best_positions], "margin": margins}, index=corr_df.index)
+
+# top_corr_depmap_ID and margin per sample, from the top k long table (margin is nan when k is 1)
+def summarize_top_k_matches(top_k_df):
+    best_df = top_k_df[top_k_df["rank"] == 1].set_index("sample_id")
+    second_r_s = top_k_df[top_k_df["rank"] == 2].set_index("sample_id")["r"]
+    return pd.DataFrame({"top_corr_depmap_ID": best_df["DepMap_ID"], "margin": best_df["r"] - second_r_s.reindex(best_df.index)})
+
+# accuracy guard for reduced precision: recomputes the correlations of a random sample of query columns in float64 and
+# warns about every sampled column whose top match or margin differs from the reduced precision result
+def check_float32_accuracy(subset_query_expr, subset_ref_expr, top_matches_df, ref_is_standardized=False,
+        n_check_samples=DEFAULT_ACCURACY_CHECK_SAMPLES, margin_tolerance=DEFAULT_ACCURACY_MARGIN_TOLERANCE, random_state=0):
+    n_query = subset_query_expr.shape[1]
+    check_positions = numpy.sort(numpy.random.RandomState(random_state).choice(n_query, size=min(n_check_samples, n_query), replace=False))
+    check_query_expr = subset_query_expr.iloc[:, check_positions]
+
+    corr64_df = run_standardized_correlation(check_query_expr, subset_ref_expr, ref_is_standardized=ref_is_standardized)
+    top_matches64_df = summarize_top_matches(corr64_df)
+
+    compared_df = top_matches_df.loc[check_query_expr.columns].join(top_matches64_df, rsuffix="_float64")
+    disagree = (compared_df["top_corr_depmap_ID"] != compared_df["top_corr_depmap_ID_float64"])
+    if compared_df["margin"].notna().any():
+        disagree |= (compared_df["margin"] - compared_df["margin_float64"]).abs() > margin_tolerance
+    disagreement_df = compared_df[disagree]
+    logger.debug("\ncompared_df\n{}".format(compared_df))
+
+    if not disagreement_df.empty:
+        msg = """\n!!!\nReduced precision correlation disagrees with float64 on {} of {} checked samples (margin tolerance {}).
+        Consider rerunning with --dtype float64.\n{}\n""".format(len(disagreement_df), len(compared_df), margin_tolerance, disagreement_df)
+        logger.warning(msg)
+    else:
+        logger.info("float32 top matches and margins agree with float64 on {} checked samples".format(len(compared_df)))
+    return disagreement_df
+
+# save the top k long table as csv/txt file
+def save_top_k_df(top_k_df, k, exp_id, subdir):
+    output_filename = "{experiment_id}_cell_line_authentication_top{k}_r{nrows}x{ncols}.txt".format(
+        experiment_id=exp_id, k=k, nrows=top_k_df.shape[0], ncols=top_k_df.shape[1]
+    )
+    logger.debug("output_filename : {}".format(output_filename))
+
+    output_filepath = os.path.join(subdir, output_filename)
+    logger.debug("output_filepath : {}".format(output_filepath))
+
+    top_k_df.to_csv(output_filepath, sep="\t", index=False)
+    return output_filepath
+
+# save the correlation df as csv/txt file, or in a binary format (npy + labels sidecar, parquet, gctx) that
+# cell_line_authentication.load_correlation_df loads without parsing text
+def save_corr_df(corr_df, exp_id, subdir, output_format="txt", output_dtype=None):
     corr_df_shape = corr_df.shape
-    output_filename = "{experiment_id}_cell_line_authentication_corr_r{nrows}x{ncols}.txt".format(
-        experiment_id=exp_id, nrows=corr_df_shape[0], ncols=corr_df_shape[1]
+    output_filename = "{experiment_id}_cell_line_authentication_corr_r{nrows}x{ncols}.{ext}".format(
+        experiment_id=exp_id, nrows=corr_df_shape[0], ncols=corr_df_shape[1], ext=output_format
     )
     logger.debug("output_filename : {}".format(output_filename))
 
     output_filepath = os.path.join(subdir, output_filename)
     logger.debug("output_filepath : {}".format(output_filepath))
-    
-    corr_df.to_csv(output_filepath, sep="\t")
+
+    # only converted when it changes the precision, a matrix already in output_dtype is written as is
+    if output_dtype is not None and (corr_df.dtypes != numpy.dtype(output_dtype)).any():
+        corr_df = corr_df.astype(output_dtype)
+
+    if output_format == "txt":
+        corr_df.to_csv(output_filepath, sep="\t")
+    elif output_format == "npy":
+        numpy.save(output_filepath, corr_df.to_numpy())
+        labels = {"index": corr_df.index.astype(str).tolist(), "columns": corr_df.columns.astype(str).tolist(),
+                  "index_name": corr_df.index.name, "columns_name": corr_df.columns.name}
+        with open(output_filepath[:-len(".npy")] + NPY_LABELS_SUFFIX, "w") as f:
+            json.dump(labels, f)
+    elif output_format == "parquet":
+        corr_df.to_parquet(output_filepath)
+    elif output_format == "gctx":
+        write_gctx.write(GCToo.GCToo(data_df=corr_df.copy()), output_filepath,
+            matrix_dtype=corr_df.to_numpy().dtype)
     return output_filepath
 
 
+# whether a file can be read with the metadata-first GCTX loader
+def is_gctx_file(filepath):
+    return filepath.endswith(".gctx")
+
+# loads the reference expression data: a compiled reference store (already standardized, no parsing) or a GCT/GCTX file
+def load_reference(ref_expr_file):
+    if reference_store.is_reference_store(ref_expr_file):
+        ref_expr_df, ref_manifest = reference_store.load_reference_store(ref_expr_file)
+    else:
+        ref_expr_df = load_ref_expr_data(ref_expr_file).data_df
+        ref_manifest = None
+    return ref_expr_df, ref_manifest
+
+# aligns the query (indexed by row_metadata_for_matching) to the reference genes. alignment_memo is an optional dict
+# that keeps the alignments in memory across queries sharing their row metadata
+def match_datasets(query_expr_df, ref_expr_df, args, alignment_memo=None):
+    alignment_key = gene_alignment.gene_alignment_key(query_expr_df.index, ref_expr_df.index, args.duplicate_gene_aggregation)
+    if alignment_memo is not None and alignment_key in alignment_memo:
+        alignment = alignment_memo[alignment_key]
+    else:
+        alignment = gene_alignment.load_or_build_gene_alignment(query_expr_df.index, ref_expr_df.index,
+            aggregation=args.duplicate_gene_aggregation, cache_dir=args.alignment_cache_dir)
+        if alignment_memo is not None:
+            alignment_memo[alignment_key] = alignment
+    subset_query_expr, subset_ref_expr = build_matched_datasets(query_expr_df, ref_expr_df, alignment=alignment)
+    return subset_query_expr, subset_ref_expr
+
+# readies the matched datasets for the correlation method: ranks them for spearman, and works out whether the
+# reference columns are already standardized
+def prepare_for_method(subset_query_expr, subset_ref_expr, ref_manifest, args):
+    # the store columns are standardized over all store genes, so they only stay standardized if every gene matched
+    ref_is_standardized = ref_manifest is not None and subset_ref_expr.shape[0] == ref_manifest["n_genes"]
+
+    if args.method == "spearman":
+        rank_cache_dir = args.rank_cache_dir
+        if rank_cache_dir is None and reference_store.is_reference_store(args.ref_expr_filepath):
+            rank_cache_dir = os.path.join(args.ref_expr_filepath, reference_store.RANK_CACHE_DIRNAME)
+        subset_query_expr, subset_ref_expr = build_ranked_datasets(subset_query_expr, subset_ref_expr,
+            reference_store.reference_fingerprint(args.ref_expr_filepath), rank_cache_dir=rank_cache_dir)
+        ref_is_standardized = True
+    return subset_query_expr, subset_ref_expr, ref_is_standardized
+
+# runs the correlation engine picked by args (through the per-sample cache when --cache_dir is given): the top k long
+# table when --top_k is given, otherwise the full corr_df
+def compute_correlations(subset_query_expr, subset_ref_expr, ref_is_standardized, args):
+    if args.cache_dir is not None:
+        return compute_cached_correlations(subset_query_expr, subset_ref_expr, ref_is_standardized, args)
+    return run_correlation_engine(subset_query_expr, subset_ref_expr, ref_is_standardized, args)
+
+# correlations of only the query samples that are not in the cache yet; the others are merged from the cache.
+# A sample's entry holds its row of the corr_df, or its k best reference column positions and r with --top_k
+def compute_cached_correlations(subset_query_expr, subset_ref_expr, ref_is_standardized, args):
+    settings = {"method": args.method, "dtype": args.dtype, "top_k": args.top_k, "pca_candidates": args.pca_candidates,
+        "row_metadata_for_matching": args.row_metadata_for_matching, "duplicate_gene_aggregation": args.duplicate_gene_aggregation}
+    settings_hexdigest = correlation_cache.settings_key(reference_store.reference_fingerprint(args.ref_expr_filepath),
+        subset_query_expr.index, subset_ref_expr.columns, settings)
+    keys = correlation_cache.sample_keys(subset_query_expr, settings_hexdigest)
+
+    entries = [correlation_cache.load_entry(args.cache_dir, key) for key in keys]
+    missing = [i for i, entry in enumerate(entries) if entry is None]
+    logger.info("{} of {} query samples merged from the correlation cache, {} to correlate".format(
+        len(keys) - len(missing), len(keys), len(missing)))
+
+    if len(missing) > 0:
+        computed_df = run_correlation_engine(subset_query_expr.iloc[:, missing], subset_ref_expr, ref_is_standardized, args)
+        if args.top_k is not None:
+            k = min(args.top_k, subset_ref_expr.shape[1])
+            computed_positions = subset_ref_expr.columns.get_indexer(computed_df[TOP_K_COLUMNS[2]]).reshape(len(missing), k)
+            computed_values = computed_df[TOP_K_COLUMNS[3]].to_numpy().reshape(len(missing), k)
+            computed_entries = [{"positions": p, "r": v} for p, v in zip(computed_positions, computed_values)]
+        else:
+            computed_entries = [{"r": r} for r in computed_df.to_numpy()]
+
+        for i, entry in zip(missing, computed_entries):
+            correlation_cache.save_entry(args.cache_dir, keys[i], **entry)
+            entries[i] = entry
+        correlation_cache.evict(args.cache_dir, int(args.cache_max_mb * 1024**2))
+
+    if args.top_k is not None:
+        return build_top_k_df(subset_query_expr.columns, subset_ref_expr.columns,
+            numpy.vstack([entry["positions"] for entry in entries]), numpy.vstack([entry["r"] for entry in entries]))
+    corr_df = pd.DataFrame(numpy.vstack([entry["r"] for entry in entries]), columns=subset_ref_expr.columns,
+        index=subset_query_expr.columns, copy=False)
+    corr_df.index.name = subset_query_expr.columns.name
+    return corr_df
+
+# raises when an output option is given that the top k long table does not honor: it is always written as txt, with
+# the r of each match as computed
+def check_output_arguments(args):
+    if args.top_k is None:
+        return
+    conflicting = [option for option, given in [("--output_format {}".format(args.output_format), args.output_format != "txt"),
+        ("--output_dtype {}".format(args.output_dtype), args.output_dtype is not None)] if given]
+    if len(conflicting) > 0:
+        msg = """\n!!!\n--top_k saves a txt long table and cannot be combined with {}.\n""".format(", ".join(conflicting))
+        logger.exception(msg)
+        raise FhtbioinfpyCellLineCorrelationIncompatibleArguments(msg)
+
+# runs the correlation engine picked by args: the top k long table when --top_k is given, otherwise the full corr_df.
+# reduced precision results are checked against float64
+def run_correlation_engine(subset_query_expr, subset_ref_expr, ref_is_standardized, args):
+    check_engine_arguments(args)
+    index = load_store_candidate_index(subset_ref_expr, args) if args.pca_candidates is not None else None
+    if index is not None:
+        # approximate candidate search, exact correlations for the candidates only
+        corr_df = run_candidate_correlation(subset_query_expr, subset_ref_expr, index, args.pca_candidates)
+        return top_k_from_corr_df(corr_df, args.top_k) if args.top_k is not None else corr_df
+
+    if args.top_k is not None:
+        # only the k best matches per sample are kept, the full matrix is never built
+        top_k_df = run_top_k_correlation(subset_query_expr, subset_ref_expr, args.top_k,
+            ref_is_standardized=ref_is_standardized, memory_budget_mb=args.memory_budget_mb, dtype=args.dtype)
+        if args.dtype != "float64":
+            check_float32_accuracy(subset_query_expr, subset_ref_expr, summarize_top_k_matches(top_k_df),
+                ref_is_standardized=ref_is_standardized, n_check_samples=args.accuracy_check_samples)
+        return top_k_df
+
+    #run correlation calculation
+    corr_df = run_correlation(subset_query_expr, subset_ref_expr, ref_is_standardized=ref_is_standardized,
+        memory_budget_mb=args.memory_budget_mb, workers=args.workers, dtype=args.dtype)
+    if args.dtype != "float64":
+        check_float32_accuracy(subset_query_expr, subset_ref_expr, summarize_top_matches(corr_df),
+            ref_is_standardized=ref_is_standardized, n_check_samples=args.accuracy_check_samples)
+    return corr_df
 
 def main(args):
-    #query expression
-    query_expr_gctoo = read_RNA_seq_gctx(args.query_expr_filepath)
+    check_engine_arguments(args)
+    check_output_arguments(args)
+    profiler = stage_profiler.StageProfiler("cell_line_correlation", enabled=args.profile)
+    if is_gctx_file(args.query_expr_filepath) and (is_gctx_file(args.ref_expr_filepath) or reference_store.is_reference_store(args.ref_expr_filepath)):
+        # only the genes in both datasets (and the requested samples) are read from disk, so loading and aligning are one stage
+        with profiler.stage("load_align") as stage:
+            subset_query_expr, subset_ref_expr, ref_manifest = load_matched_gctx_datasets(args.query_expr_filepath,
+                args.ref_expr_filepath, args.row_metadata_for_matching, query_sample_ids=args.query_sample_ids,
+                aggregation=args.duplicate_gene_aggregation, alignment_cache_dir=args.alignment_cache_dir)
+            stage_profiler.add_shapes(stage, subset_query_expr=subset_query_expr, subset_ref_expr=subset_ref_expr)
+    else:
+        with profiler.stage("load") as stage:
+            #query expression
+            query_expr_gctoo = read_RNA_seq_gctx(args.query_expr_filepath)
 
-    ref_expr_gctoo = load_ref_expr_data(args.ref_expr_filepath)
+            query_expr_df = query_set_index(query_expr_gctoo, args.row_metadata_for_matching)
+            # query_expr_df = query_expr_gctoo.data_df.join(
+            #     query_expr_gctoo.row_metadata_df[[args.row_metadata_for_matching]]
+            # ).set_index(args.row_metadata_for_matching)
+            if args.query_sample_ids is not None:
+                query_expr_df = query_expr_df.iloc[:, find_query_samples(args.query_sample_ids, query_expr_df.columns)]
 
-    query_expr_df = query_set_index(query_expr_gctoo, args.row_metadata_for_matching)
-    # query_expr_df = query_expr_gctoo.data_df.join(
-    #     query_expr_gctoo.row_metadata_df[[args.row_metadata_for_matching]]
-    # ).set_index(args.row_metadata_for_matching)
+            ref_expr_df, ref_manifest = load_reference(args.ref_expr_filepath)
+            stage_profiler.add_shapes(stage, query_expr=query_expr_df, ref_expr=ref_expr_df)
 
-    subset_query_expr, subset_ref_expr = build_matched_datasets(query_expr_df, ref_expr_gctoo.data_df)
+        with profiler.stage("align") as stage:
+            subset_query_expr, subset_ref_expr = match_datasets(query_expr_df, ref_expr_df, args)
+            stage_profiler.add_shapes(stage, subset_query_expr=subset_query_expr, subset_ref_expr=subset_ref_expr)
+
+    with profiler.stage("prepare"):
+        subset_query_expr, subset_ref_expr, ref_is_standardized = prepare_for_method(subset_query_expr, subset_ref_expr, ref_manifest, args)
 
-    #run fast_corr calculation
-    corr_df = run_correlation_calculation(subset_query_expr, subset_ref_expr) 
- 
     # cell_line_auth directory , check if exists
     
     if(os.path.isdir(args.output_subdir)==False):
         os.mkdir(args.output_subdir)
 
-    # save corr df
-    output_filepath = save_corr_df(corr_df, args.experiment_id, args.output_subdir)
+    with profiler.stage("correlate") as stage:
+        corr_df = compute_correlations(subset_query_expr, subset_ref_expr, ref_is_standardized, args)
+        stage_profiler.add_shapes(stage, corr_df=corr_df)
+
+    # save corr df (or the top k long table)
+    with profiler.stage("save"):
+        if args.top_k is not None:
+            output_filepath = save_top_k_df(corr_df, args.top_k, args.experiment_id, args.output_subdir)
+        else:
+            output_filepath = save_corr_df(corr_df, args.experiment_id, args.output_subdir,
+                output_format=args.output_format, output_dtype=args.output_dtype)
+
+    profiler.save_report(args.experiment_id, args.output_subdir)
+
+
+class FhtbioinfpyCellLineCorrelationQuerySampleNotFound(Exception):
+    pass
+
+
+class FhtbioinfpyCellLineCorrelationIncompatibleArguments(Exception):
+    pass
 
 
 if __name__ == "__main__":
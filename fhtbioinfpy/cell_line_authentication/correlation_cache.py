@@ -0,0 +1,104 @@
+"""
+content-addressed cache of per-sample correlation results. Every query sample is keyed by a sha256 of its matched
+expression vector, the reference fingerprint (store path, format version and compile time, or file size and mtime) and
+the method settings, so rerunning an experiment after a few samples were added or re-sequenced only correlates the new
+or changed samples. The cache directory is kept under a size limit by evicting the least recently used entries.
+"""
+import logging
+import fhtbioinfpy.setup_logger as setup_logger
+import hashlib
+import json
+import threading
+
+import os
+import numpy
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+DEFAULT_CACHE_MAX_MB = 1024
+ENTRY_SUFFIX = ".npz"
+
+
+# key of everything a sample's result depends on besides its own expression values: the reference, the matched genes
+# and reference columns, and the method settings
+def settings_key(ref_fingerprint, genes, ref_columns, settings):
+    key = hashlib.sha256()
+    key.update(ref_fingerprint.encode())
+    key.update(b"\1")
+    key.update("\0".join(str(g) for g in genes).encode())
+    key.update(b"\1")
+    key.update("\0".join(str(c) for c in ref_columns).encode())
+    key.update(b"\1")
+    key.update(json.dumps(settings, sort_keys=True).encode())
+    return key.hexdigest()
+
+
+# one key per query column: the settings key plus the bytes of the column's expression values
+def sample_keys(subset_query_expr, settings_hexdigest):
+    query_arr = numpy.ascontiguousarray(numpy.asarray(subset_query_expr.to_numpy(), dtype=numpy.float64).T)
+    keys = []
+    for query_vector in query_arr:
+        key = hashlib.sha256(settings_hexdigest.encode())
+        key.update(query_vector.tobytes())
+        keys.append(key.hexdigest())
+    return keys
+
+
+def entry_path(cache_dir, key):
+    return os.path.join(cache_dir, key + ENTRY_SUFFIX)
+
+
+# the cached arrays of a sample, or None when it is not in the cache. A hit refreshes the entry's mtime, which is the
+# recency used by evict
+def load_entry(cache_dir, key):
+    path = entry_path(cache_dir, key)
+    try:
+        with numpy.load(path) as cached:
+            entry = {name: cached[name] for name in cached.files}
+        os.utime(path)
+    except FileNotFoundError:
+        # not cached, or evicted by a concurrent run
+        return None
+    return entry
+
+
+# writes a sample's arrays to the cache; written to a temporary file (per process and thread) first so a concurrent
+# reader never sees half an entry
+def save_entry(cache_dir, key, **arrays):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = entry_path(cache_dir, key)
+    tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    with open(tmp_path, "wb") as f:
+        numpy.savez(f, **arrays)
+    os.replace(tmp_path, path)
+    return path
+
+
+# deletes the least recently used entries until the cache fits in max_bytes, returns the number of entries evicted
+def evict(cache_dir, max_bytes):
+    if not os.path.isdir(cache_dir):
+        return 0
+    entries = []
+    for filename in os.listdir(cache_dir):
+        if filename.endswith(ENTRY_SUFFIX):
+            try:
+                stat = os.stat(os.path.join(cache_dir, filename))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, filename))
+
+    total_bytes = sum(size for _, size, _ in entries)
+    n_evicted = 0
+    for _, size, filename in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, filename))
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+        n_evicted += 1
+
+    if n_evicted > 0:
+        logger.info("evicted {} entries from the correlation cache {}".format(n_evicted, cache_dir))
+    return n_evicted
@@ -0,0 +1,121 @@
+"""
+integer alignment of the rows (genes) of a query expression dataset to the rows of a reference expression dataset.
+The alignment is built once from the two gene label lists and then applied with take-style gathers; genes that
+appear more than once on a side are collapsed with a configurable aggregation (sum, mean or max).
+"""
+import logging
+import fhtbioinfpy.setup_logger as setup_logger
+import collections
+import hashlib
+
+import os
+import pandas as pd
+import numpy
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+AGGREGATIONS = ["sum", "mean", "max"]
+
+# genes: sorted gene intersection
+# query_positions / ref_positions: row positions of each side, grouped by gene in the order of genes
+# query_group_starts / ref_group_starts: offset into the positions where the rows of each gene start
+GeneAlignment = collections.namedtuple("GeneAlignment",
+    ["genes", "query_positions", "query_group_starts", "ref_positions", "ref_group_starts", "aggregation"])
+
+
+# row positions of the labels that are in genes, grouped by gene, and where each gene's group starts
+def _group_positions(labels, genes):
+    codes = pd.Index(genes).get_indexer(labels)
+    positions = numpy.flatnonzero(codes >= 0)
+    positions = positions[numpy.argsort(codes[positions], kind="stable")]
+    group_starts = numpy.searchsorted(codes[positions], numpy.arange(len(genes)))
+    return positions, group_starts
+
+
+# maps the query and reference rows to integer positions of their sorted gene intersection
+def build_gene_alignment(query_genes, ref_genes, aggregation="mean"):
+    if aggregation not in AGGREGATIONS:
+        msg = """\n!!!\nUnknown duplicate gene aggregation: {}\nsupported: {}\n""".format(aggregation, AGGREGATIONS)
+        logger.exception(msg)
+        raise FhtbioinfpyGeneAlignmentUnknownAggregation(msg)
+
+    genes = numpy.array(sorted(set(query_genes).intersection(ref_genes)), dtype=object)
+    logger.debug("\nlen(genes): \n{}\n".format(len(genes)))
+
+    query_positions, query_group_starts = _group_positions(query_genes, genes)
+    ref_positions, ref_group_starts = _group_positions(ref_genes, genes)
+    if len(query_positions) > len(genes):
+        logger.info("{} duplicate query rows collapsed into their genes with {}".format(len(query_positions) - len(genes), aggregation))
+    if len(ref_positions) > len(genes):
+        logger.info("{} duplicate reference rows collapsed into their genes with {}".format(len(ref_positions) - len(genes), aggregation))
+
+    return GeneAlignment(genes, query_positions, query_group_starts, ref_positions, ref_group_starts, aggregation)
+
+
+# collapses rows that were already gathered in alignment order (one group of consecutive rows per gene)
+def aggregate_aligned_rows(gathered_arr, group_starts, aggregation):
+    if len(gathered_arr) == len(group_starts):
+        return gathered_arr
+
+    gathered_arr = numpy.asarray(gathered_arr, dtype=numpy.float64)
+    if aggregation == "max":
+        return numpy.maximum.reduceat(gathered_arr, group_starts, axis=0)
+    summed = numpy.add.reduceat(gathered_arr, group_starts, axis=0)
+    if aggregation == "mean":
+        counts = numpy.diff(numpy.append(group_starts, len(gathered_arr)))
+        summed /= counts[:, numpy.newaxis]
+    return summed
+
+
+# applies the alignment to one side's dataframe: a positional take, plus the aggregation if that side has duplicates
+def _apply_to_side(expr_df, positions, group_starts, alignment):
+    if len(positions) == len(group_starts):
+        aligned_df = expr_df.take(positions)
+        aligned_df.index = pd.Index(alignment.genes, name=expr_df.index.name)
+    else:
+        aligned_arr = aggregate_aligned_rows(numpy.take(expr_df.to_numpy(), positions, axis=0), group_starts, alignment.aggregation)
+        aligned_df = pd.DataFrame(aligned_arr, index=pd.Index(alignment.genes, name=expr_df.index.name), columns=expr_df.columns)
+    return aligned_df
+
+
+# query and reference dataframes reduced to the aligned genes, both in the order of alignment.genes
+def apply_gene_alignment(alignment, query_expr, ref_expr):
+    subset_query_expr = _apply_to_side(query_expr, alignment.query_positions, alignment.query_group_starts, alignment)
+    subset_ref_expr = _apply_to_side(ref_expr, alignment.ref_positions, alignment.ref_group_starts, alignment)
+    return subset_query_expr, subset_ref_expr
+
+
+# cache key of an alignment: the query row labels, the reference row labels and the aggregation
+def gene_alignment_key(query_genes, ref_genes, aggregation):
+    key = hashlib.sha256()
+    key.update("\0".join(pd.Index(query_genes).astype(str)).encode())
+    key.update(b"\1")
+    key.update("\0".join(pd.Index(ref_genes).astype(str)).encode())
+    key.update(aggregation.encode())
+    return key.hexdigest()
+
+
+# builds the alignment, or loads it from cache_dir when the same query row metadata and reference were aligned before
+def load_or_build_gene_alignment(query_genes, ref_genes, aggregation="mean", cache_dir=None):
+    if cache_dir is None:
+        return build_gene_alignment(query_genes, ref_genes, aggregation=aggregation)
+
+    cache_filepath = os.path.join(cache_dir, "alignment_{}.npz".format(gene_alignment_key(query_genes, ref_genes, aggregation)))
+    if os.path.isfile(cache_filepath):
+        logger.debug("loading cached gene alignment: {}".format(cache_filepath))
+        with numpy.load(cache_filepath) as cached:
+            return GeneAlignment(cached["genes"].astype(object), cached["query_positions"], cached["query_group_starts"],
+                cached["ref_positions"], cached["ref_group_starts"], aggregation)
+
+    alignment = build_gene_alignment(query_genes, ref_genes, aggregation=aggregation)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    numpy.savez(cache_filepath, genes=alignment.genes.astype(str), query_positions=alignment.query_positions,
+        query_group_starts=alignment.query_group_starts, ref_positions=alignment.ref_positions,
+        ref_group_starts=alignment.ref_group_starts)
+    logger.debug("saved gene alignment to cache: {}".format(cache_filepath))
+    return alignment
+
+
+class FhtbioinfpyGeneAlignmentUnknownAggregation(Exception):
+    pass
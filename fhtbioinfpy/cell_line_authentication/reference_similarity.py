@@ -0,0 +1,113 @@
+"""
+reference-vs-reference pearson correlation of a compiled reference store, precomputed once and saved next to the
+standardized data. Some DepMap lines are near duplicates (isogenic pairs, re-derived lines), so a sample can correlate
+best with a sibling of its annotated line; with the map, cell_line_authentication tells such near-twin mismatches apart
+from real ones by a lookup, without correlating anything more at query time. The matrix is filled block by block of
+reference columns straight into a memory mapped file, so memory stays bounded by --block_size columns.
+"""
+import logging
+import fhtbioinfpy.setup_logger as setup_logger
+import argparse
+import sys
+
+import os
+import pandas as pd
+import numpy
+import fhtbioinfpy.cell_line_authentication.reference_store as reference_store
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+SELF_SIMILARITY_FILENAME = "ref_self_similarity.npy"
+DEFAULT_BLOCK_SIZE = 256
+# two reference lines correlating at least this much are near twins
+DEFAULT_NEAR_TWIN_MIN_R = 0.97
+NEAR_TWIN_COLUMNS = ["DepMap_ID", "near_twin_depmap_ID", "near_twin_r"]
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--verbose", "-v", help="Whether to print a bunch of output.", action="store_true", default=False)
+    parser.add_argument("--ref_store_dir", help="compiled reference store (see reference_store) to precompute the self-similarity of", type=str, required = True)
+    parser.add_argument("--block_size", help="number of reference columns correlated at a time", type=int, default=DEFAULT_BLOCK_SIZE)
+    parser.add_argument("--near_twin_min_r", help="only to report how many near-twin pairs the map holds at this correlation", type=float, default=DEFAULT_NEAR_TWIN_MIN_R)
+    return parser
+
+
+# correlation of every pair of standardized reference columns (float32), block_size columns at a time; out is an
+# existing (columns x columns) array or memory map to fill, otherwise one is allocated
+def compute_self_similarity(ref_standardized, block_size=DEFAULT_BLOCK_SIZE, out=None):
+    n_columns = ref_standardized.shape[1]
+    if out is None:
+        out = numpy.empty((n_columns, n_columns), dtype=numpy.float32)
+    for block_start in range(0, n_columns, block_size):
+        block_end = min(block_start + block_size, n_columns)
+        block = numpy.asarray(ref_standardized[:, block_start:block_end], dtype=numpy.float64)
+        out[:, block_start:block_end] = ref_standardized.T.dot(block)
+        logger.debug("self-similarity columns {}:{} of {}".format(block_start, block_end, n_columns))
+    return out
+
+
+# computes the self-similarity of a compiled store into a memory mapped file of the store, returns its path
+def save_self_similarity(store_dir, block_size=DEFAULT_BLOCK_SIZE):
+    ref_std_df, _ = reference_store.load_reference_store(store_dir)
+    self_similarity_filepath = os.path.join(store_dir, SELF_SIMILARITY_FILENAME)
+    tmp_filepath = self_similarity_filepath + ".tmp.npy"
+    out = numpy.lib.format.open_memmap(tmp_filepath, mode="w+", dtype=numpy.float32, shape=(ref_std_df.shape[1],) * 2)
+    compute_self_similarity(ref_std_df.to_numpy(), block_size=block_size, out=out)
+    out.flush()
+    del out
+    # a half written map is never picked up by a concurrent load
+    os.replace(tmp_filepath, self_similarity_filepath)
+    return self_similarity_filepath
+
+
+# the self-similarity map of a compiled store (memory mapped, labeled with the store columns), or None when the path is
+# not a store or has no map
+def load_self_similarity(store_dir):
+    self_similarity_filepath = os.path.join(store_dir, SELF_SIMILARITY_FILENAME)
+    if not (reference_store.is_reference_store(store_dir) and os.path.isfile(self_similarity_filepath)):
+        return None
+    columns = pd.Index(numpy.load(os.path.join(store_dir, reference_store.COLUMNS_FILENAME)))
+    return pd.DataFrame(numpy.load(self_similarity_filepath, mmap_mode="r"), index=columns, columns=columns, copy=False)
+
+
+# every ordered pair of distinct reference lines correlating at least min_r, as a long table (DepMap_ID,
+# near_twin_depmap_ID, near_twin_r) - both orientations are listed, so it can be joined on either line
+def find_near_twins(self_similarity_df, min_r=DEFAULT_NEAR_TWIN_MIN_R, block_size=DEFAULT_BLOCK_SIZE):
+    columns = self_similarity_df.columns.to_numpy()
+    arr = self_similarity_df.to_numpy()
+    pair_tables = []
+    for block_start in range(0, arr.shape[0], block_size):
+        block = numpy.asarray(arr[block_start:block_start + block_size])
+        rows, cols = numpy.nonzero(block >= min_r)
+        rows += block_start
+        off_diagonal = rows != cols
+        rows, cols = rows[off_diagonal], cols[off_diagonal]
+        pair_tables.append(pd.DataFrame({"DepMap_ID": columns[rows], "near_twin_depmap_ID": columns[cols],
+            "near_twin_r": arr[rows, cols]}, columns=NEAR_TWIN_COLUMNS))
+    near_twins_df = pd.concat(pair_tables, ignore_index=True) if pair_tables else pd.DataFrame(columns=NEAR_TWIN_COLUMNS)
+    logger.debug("\nnear_twins_df\n{}".format(near_twins_df))
+    return near_twins_df
+
+
+# the near-twin pairs of a compiled store at min_r, or None when it has no self-similarity map
+def load_near_twins(store_dir, min_r=DEFAULT_NEAR_TWIN_MIN_R):
+    self_similarity_df = load_self_similarity(store_dir)
+    if self_similarity_df is None:
+        return None
+    return find_near_twins(self_similarity_df, min_r=min_r)
+
+
+def main(args):
+    self_similarity_filepath = save_self_similarity(args.ref_store_dir, block_size=args.block_size)
+    near_twins_df = load_near_twins(args.ref_store_dir, min_r=args.near_twin_min_r)
+    logger.info("saved the reference self-similarity map to {}; {} reference lines have a near twin (r >= {})".format(
+        self_similarity_filepath, near_twins_df["DepMap_ID"].nunique(), args.near_twin_min_r))
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args(sys.argv[1:])
+    setup_logger.setup(verbose=args.verbose)
+    logger.debug("args:  {}".format(args))
+
+    main(args)
@@ -0,0 +1,207 @@
+"""
+compile a reference expression file (GCT/GCTX) into a versioned binary store that cell_line_correlation can load
+directly. The store is a directory holding the gene index, the column (DepMap) IDs and the reference columns already
+mean-centered and scaled to unit norm, so the correlation step is a single matrix multiply.
+
+layout of a store directory:
+    manifest.json          format_version, source_filepath, n_genes, n_columns, index/columns names and creation time
+    genes.npy              the gene index (row labels), as strings
+    columns.npy            the column (DepMap) IDs, as strings
+    ref_standardized.npy   the standardized reference, n_genes x n_columns float64, memory mapped when loaded
+modules that add to a store (rank cache, candidate index, reference similarity) write their own files (or rank_cache directory) next to these.
+
+load_manifest raises FhtbioinfpyReferenceStoreUnsupportedVersion when the manifest's format_version is not
+STORE_FORMAT_VERSION; the store has to be recompiled then. STORE_FORMAT_VERSION is bumped whenever the layout or the
+standardization changes. cell_line_correlation takes --ref_expr_filepath as a store when is_reference_store finds a
+manifest.json in it, and parses it as a GCT/GCTX file otherwise.
+"""
+import logging
+import fhtbioinfpy.setup_logger as setup_logger
+import argparse
+import sys
+import json
+import datetime
+import hashlib
+
+import os
+import pandas as pd
+import numpy
+import cmapPy.pandasGEXpress.parse as parse
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+STORE_FORMAT_VERSION = 1
+MANIFEST_FILENAME = "manifest.json"
+GENES_FILENAME = "genes.npy"
+COLUMNS_FILENAME = "columns.npy"
+STANDARDIZED_DATA_FILENAME = "ref_standardized.npy"
+RANK_CACHE_DIRNAME = "rank_cache"
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--verbose", "-v", help="Whether to print a bunch of output.", action="store_true", default=False)
+    parser.add_argument("--ref_expr_filepath", help="reference expression file (GCT/GCTX) to compile", type=str, required = True)
+    parser.add_argument("--output_store_dir", help="directory to write the compiled reference store into", type=str, required = True)
+    return parser
+
+
+# mean-centers each column and scales it to unit norm, so that the dot product of two standardized columns is their pearson correlation
+def standardize_columns(arr, dtype=numpy.float64):
+    standardized = numpy.array(arr, dtype=dtype)
+    standardized -= standardized.mean(axis=0)
+    norms = numpy.linalg.norm(standardized, axis=0)
+    # constant columns have no defined correlation - leave them as nan like fast_corr does
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        standardized /= norms
+    return standardized
+
+
+# average ranks (ties share the mean of their ordinal ranks, as in spearman) of every column, in one vectorized pass
+def rank_columns(arr):
+    arr = numpy.asarray(arr, dtype=numpy.float64)
+    n_rows, n_cols = arr.shape
+    order = numpy.argsort(arr, axis=0, kind="mergesort")
+    sorted_arr = numpy.take_along_axis(arr, order, axis=0)
+
+    # number the runs of equal values, uniquely across all columns, and give each run the mean of its ordinal ranks
+    is_new_run = numpy.ones(sorted_arr.shape, dtype=bool)
+    is_new_run[1:] = sorted_arr[1:] != sorted_arr[:-1]
+    run_ids = numpy.cumsum(is_new_run.ravel(order="F")).reshape(sorted_arr.shape, order="F") - 1
+    ordinal_ranks = numpy.broadcast_to(numpy.arange(1, n_rows + 1, dtype=numpy.float64)[:, numpy.newaxis], sorted_arr.shape)
+    run_mean_ranks = numpy.bincount(run_ids.ravel(), weights=ordinal_ranks.ravel()) / numpy.bincount(run_ids.ravel())
+
+    ranks = numpy.empty(arr.shape, dtype=numpy.float64)
+    numpy.put_along_axis(ranks, order, run_mean_ranks[run_ids], axis=0)
+    ranks[numpy.isnan(arr)] = numpy.nan
+    return ranks
+
+
+# identifies the reference content a derived artifact (e.g. cached ranks) was built from: the manifest of a compiled
+# store, or the path, size and modification time of a GCT/GCTX file
+def reference_fingerprint(ref_path):
+    if is_reference_store(ref_path):
+        manifest = load_manifest(ref_path)
+        return "store:{}:{}:{}".format(os.path.abspath(ref_path), manifest["format_version"], manifest["created"])
+    stat = os.stat(ref_path)
+    return "file:{}:{}:{}".format(os.path.abspath(ref_path), stat.st_size, stat.st_mtime_ns)
+
+
+# standardized ranks of the reference columns over the matched genes - loaded from cache_dir when the same reference
+# and gene set were ranked before, otherwise computed and (if cache_dir is given) saved for the next run
+def load_or_compute_standardized_ranks(subset_ref_expr, fingerprint, cache_dir=None):
+    key = hashlib.sha256()
+    key.update(fingerprint.encode())
+    key.update("\0".join(subset_ref_expr.index.astype(str)).encode())
+    key.update("\0".join(subset_ref_expr.columns.astype(str)).encode())
+    cache_filepath = None if cache_dir is None else os.path.join(cache_dir, "ranks_{}.npy".format(key.hexdigest()))
+
+    if cache_filepath is not None and os.path.isfile(cache_filepath):
+        logger.debug("loading cached reference ranks: {}".format(cache_filepath))
+        ref_rank_std = numpy.load(cache_filepath, mmap_mode="r")
+    else:
+        ref_rank_std = standardize_columns(rank_columns(subset_ref_expr.to_numpy()))
+        if cache_filepath is not None:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            numpy.save(cache_filepath, ref_rank_std)
+            logger.debug("saved reference ranks to cache: {}".format(cache_filepath))
+
+    ref_rank_std_df = pd.DataFrame(ref_rank_std, index=subset_ref_expr.index, columns=subset_ref_expr.columns, copy=False)
+    return ref_rank_std_df
+
+
+# standardizes the reference expression data and writes it with its gene index and column ids into store_dir
+def compile_reference_store(ref_expr_df, store_dir, source_filepath=None):
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+
+    ref_std_df, manifest = standardize_reference(ref_expr_df, source_filepath=source_filepath)
+    ref_standardized = ref_std_df.to_numpy()
+    logger.debug("ref_standardized.shape: {}".format(ref_standardized.shape))
+
+    numpy.save(os.path.join(store_dir, GENES_FILENAME), ref_expr_df.index.to_numpy().astype(str))
+    numpy.save(os.path.join(store_dir, COLUMNS_FILENAME), ref_expr_df.columns.to_numpy().astype(str))
+    numpy.save(os.path.join(store_dir, STANDARDIZED_DATA_FILENAME), ref_standardized)
+
+    with open(os.path.join(store_dir, MANIFEST_FILENAME), "w") as f:
+        json.dump(manifest, f, indent=2)
+    logger.debug("manifest: {}".format(manifest))
+
+    return manifest
+
+
+# the in-memory equivalent of a compiled store: the standardized reference and its manifest, for callers that correlate
+# many queries against a reference they parsed themselves
+def standardize_reference(ref_expr_df, source_filepath=None):
+    ref_std_df = pd.DataFrame(standardize_columns(ref_expr_df.to_numpy()), index=ref_expr_df.index, columns=ref_expr_df.columns, copy=False)
+    manifest = {
+        "format_version": STORE_FORMAT_VERSION,
+        "source_filepath": source_filepath,
+        "n_genes": ref_std_df.shape[0],
+        "n_columns": ref_std_df.shape[1],
+        "index_name": ref_expr_df.index.name,
+        "columns_name": ref_expr_df.columns.name,
+        "created": datetime.datetime.now().isoformat(),
+    }
+    return ref_std_df, manifest
+
+
+# whether the path is a directory containing a compiled reference store
+def is_reference_store(path):
+    return os.path.isfile(os.path.join(path, MANIFEST_FILENAME))
+
+
+# reads the manifest of a compiled reference store and checks that its format version is supported
+def load_manifest(store_dir):
+    with open(os.path.join(store_dir, MANIFEST_FILENAME), "r") as f:
+        manifest = json.load(f)
+
+    if manifest.get("format_version") != STORE_FORMAT_VERSION:
+        msg = """\n!!!\nUnsupported reference store format version.
+        store_dir:  {}
+        format_version found:  {}
+        format_version supported:  {}\nRecompile the reference with reference_store.""".format(
+            store_dir, manifest.get("format_version"), STORE_FORMAT_VERSION
+        )
+        logger.exception(msg)
+        raise FhtbioinfpyReferenceStoreUnsupportedVersion(msg)
+    return manifest
+
+
+# loads the standardized reference data (memory mapped) as a dataframe with the gene index and column ids
+def load_reference_store(store_dir):
+    manifest = load_manifest(store_dir)
+
+    genes = numpy.load(os.path.join(store_dir, GENES_FILENAME))
+    columns = numpy.load(os.path.join(store_dir, COLUMNS_FILENAME))
+    ref_standardized = numpy.load(os.path.join(store_dir, STANDARDIZED_DATA_FILENAME), mmap_mode="r")
+
+    ref_std_df = pd.DataFrame(
+        ref_standardized,
+        index=pd.Index(genes, name=manifest["index_name"]),
+        columns=pd.Index(columns, name=manifest["columns_name"]),
+        copy=False,
+    )
+    logger.debug("ref_std_df.shape: {}".format(ref_std_df.shape))
+    return ref_std_df, manifest
+
+
+def main(args):
+    ref_expr_gctoo = parse.parse(args.ref_expr_filepath)
+    manifest = compile_reference_store(ref_expr_gctoo.data_df, args.output_store_dir, source_filepath=args.ref_expr_filepath)
+    logger.info("compiled reference store {} genes x {} columns into {}".format(
+        manifest["n_genes"], manifest["n_columns"], args.output_store_dir
+    ))
+
+
+class FhtbioinfpyReferenceStoreUnsupportedVersion(Exception):
+    pass
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args(sys.argv[1:])
+    setup_logger.setup(verbose=args.verbose)
+    logger.debug("args:  {}".format(args))
+
+    main(args)
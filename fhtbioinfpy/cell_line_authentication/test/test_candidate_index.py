@@ -0,0 +1,111 @@
+import unittest
+import logging
+import fhtbioinfpy.setup_logger as setup_logger
+import fhtbioinfpy.cell_line_authentication.candidate_index as candidate_index
+import fhtbioinfpy.cell_line_authentication.reference_store as reference_store
+import fhtbioinfpy.cell_line_authentication.cell_line_correlation as clc
+import cmapPy.pandasGEXpress.parse as parse
+import pandas as pd
+import os
+import tempfile
+import numpy as np
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+class TestCandidateIndex(unittest.TestCase):
+
+    def setUp(self):
+        logger.debug("setUp")
+
+        self.query_expr_filepath = "./assets/test_cell_line_auth/test_cell_line_auth_query_data_r110x86.gctx"
+        self.ref_expr_filepath   = "./assets/test_cell_line_auth/test_cell_line_auth_ref_data_r108x1406.gctx"
+
+        query_expr_df = clc.query_set_index(parse.parse(self.query_expr_filepath), "gene_symbol")
+        self.ref_expr_df = clc.load_ref_expr_data(self.ref_expr_filepath).data_df
+        self.subset_query_expr, self.subset_ref_expr = clc.build_matched_datasets(query_expr_df, self.ref_expr_df)
+        self.exact_corr_df = clc.run_correlation_calculation(self.subset_query_expr, self.subset_ref_expr)
+
+    def tearDown(self):
+        logger.debug("tearDown")
+
+    def test_build_candidate_index(self):
+        ref_std_df, _ = reference_store.standardize_reference(self.subset_ref_expr)
+
+        # with every component the approximation is the exact correlation
+        index = candidate_index.build_candidate_index(ref_std_df, n_components=10**6)
+        self.assertEqual(index.components.shape, (97, 97))
+        self.assertEqual(index.ref_coords.shape, (97, 1406))
+        query_std = reference_store.standardize_columns(self.subset_query_expr.to_numpy())
+        np.testing.assert_allclose(query_std.T.dot(index.components).dot(index.ref_coords), self.exact_corr_df.to_numpy(), atol=1e-5)
+
+        index = candidate_index.build_candidate_index(ref_std_df, n_components=20)
+        self.assertEqual(index.components.shape, (97, 20))
+
+    def test_candidate_recall(self):
+        ref_std_df, _ = reference_store.standardize_reference(self.ref_expr_df)
+        index = candidate_index.build_candidate_index(ref_std_df)
+
+        # recall of the exact search on the test fixtures
+        recalls = {}
+        for n_candidates in [10, 50, 100]:
+            candidate_positions = candidate_index.select_candidates(self.subset_query_expr, index, n_candidates)
+            self.assertEqual(candidate_positions.shape, (86, n_candidates))
+            recalls[n_candidates] = [candidate_index.candidate_recall(self.exact_corr_df, candidate_positions, k=k) for k in [1, 5]]
+        logger.debug("recall@1, recall@5 by number of candidates: {}".format(recalls))
+
+        self.assertGreaterEqual(recalls[10][0], 0.9)
+        self.assertEqual(recalls[50][0], 1.0)
+        self.assertEqual(recalls[100], [1.0, 1.0])
+
+        # every column a candidate: full recall
+        all_positions = candidate_index.select_candidates(self.subset_query_expr, index, 10**6)
+        self.assertEqual(candidate_index.candidate_recall(self.exact_corr_df, all_positions, k=5), 1.0)
+
+    def test_select_candidates_genes_not_indexed(self):
+        ref_std_df, _ = reference_store.standardize_reference(self.subset_ref_expr.iloc[1:])
+        index = candidate_index.build_candidate_index(ref_std_df)
+        with self.assertRaises(candidate_index.FhtbioinfpyCandidateIndexGenesNotIndexed) as context:
+            candidate_index.select_candidates(self.subset_query_expr, index, 10)
+
+    def test_select_candidates_none(self):
+        ref_std_df, _ = reference_store.standardize_reference(self.subset_ref_expr)
+        index = candidate_index.build_candidate_index(ref_std_df)
+        with self.assertRaises(candidate_index.FhtbioinfpyCandidateIndexNoCandidates):
+            candidate_index.select_candidates(self.subset_query_expr, index, 0)
+
+    def test_main_functional(self):
+        with tempfile.TemporaryDirectory(prefix = "fhtbioinfpy_test_candidate_index") as tmpdirname:
+            store_dir = os.path.join(tmpdirname, "ref_store")
+            reference_store.main(reference_store.build_parser().parse_args(["--ref_expr_filepath", self.ref_expr_filepath,
+                                                                            "--output_store_dir", store_dir]))
+            self.assertIsNone(candidate_index.load_candidate_index(store_dir))
+
+            candidate_index.main(candidate_index.build_parser().parse_args(["--ref_store_dir", store_dir, "--n_components", "30"]))
+            index = candidate_index.load_candidate_index(store_dir)
+            self.assertEqual(index.components.shape, (108, 30))
+            self.assertEqual(list(index.columns), list(self.ref_expr_df.columns))
+
+            # correlation against the store with the saved index: the candidates hold their exact r, the rest is nan
+            args = clc.build_parser().parse_args(["--query_expr_filepath", self.query_expr_filepath,
+                                                  "--ref_expr_filepath", store_dir,
+                                                  "--experiment_id", "test_experiment_id",
+                                                  "--output_subdir", os.path.join(tmpdirname, "out"),
+                                                  "--pca_candidates", "50",
+                                                  "--output_format", "npy"])
+            clc.main(args)
+            corr_arr = np.load(os.path.join(tmpdirname, "out", "test_experiment_id_cell_line_authentication_corr_r86x1406.npy"))
+            self.assertTrue((np.isfinite(corr_arr).sum(axis=1) == 50).all())
+            candidate_found = np.isfinite(corr_arr)
+            np.testing.assert_allclose(corr_arr[candidate_found], self.exact_corr_df.to_numpy()[candidate_found], rtol=1e-5, atol=1e-5)
+            np.testing.assert_array_equal(np.nanargmax(corr_arr, axis=1), np.argmax(self.exact_corr_df.to_numpy(), axis=1))
+
+            # recompiling the store makes the saved index stale: it is not used until rebuilt
+            reference_store.main(reference_store.build_parser().parse_args(["--ref_expr_filepath", self.ref_expr_filepath,
+                                                                            "--output_store_dir", store_dir]))
+            self.assertIsNone(candidate_index.load_candidate_index(store_dir))
+
+
+if __name__ == "__main__":
+    setup_logger.setup(verbose=True)
+
+    unittest.main()
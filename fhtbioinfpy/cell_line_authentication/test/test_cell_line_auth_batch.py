@@ -0,0 +1,76 @@
+import unittest
+import logging
+import fhtbioinfpy.setup_logger as setup_logger
+import fhtbioinfpy.cell_line_authentication.cell_line_auth_batch as clab
+import fhtbioinfpy.cell_line_authentication.cell_line_auth_pipeline as clap
+import fhtbioinfpy.cell_line_authentication.cell_line_authentication as cla
+import pandas as pd
+import os
+import tempfile
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+class TestCellLineAuthBatch(unittest.TestCase):
+
+    def setUp(self):
+        logger.debug("setUp")
+
+        self.query_expr_filepath = "./assets/test_cell_line_auth/test_cell_line_auth_query_data_r110x86.gctx"
+        self.ref_expr_filepath   = "./assets/test_cell_line_auth/test_cell_line_auth_ref_data_r108x1406.gctx"
+
+    def tearDown(self):
+        logger.debug("tearDown")
+
+    def test_read_manifest(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            manifest_filepath = os.path.join(tmpdirname, "manifest.txt")
+            pd.DataFrame({"experiment_id": ["exp1"], "query_filepath": [self.query_expr_filepath]}).to_csv(manifest_filepath, sep="\t", index=False)
+            with self.assertRaises(clab.FhtbioinfpyCellLineAuthBatchManifestMissingColumns) as context:
+                clab.read_manifest(manifest_filepath)
+
+    def test_main_functional(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            logger.debug("test_main tmpdirname:  {}".format(tmpdirname))
+            manifest_filepath = os.path.join(tmpdirname, "manifest.txt")
+            pd.DataFrame({"experiment_id": ["exp1", "exp2", "exp3"],
+                          "query_expr_filepath": [self.query_expr_filepath, self.query_expr_filepath, "./does_not_exist.gctx"]}
+                ).to_csv(manifest_filepath, sep="\t", index=False)
+
+            args = clab.build_parser().parse_args(["--manifest_filepath", manifest_filepath,
+                                                   "--ref_expr_filepath", self.ref_expr_filepath,
+                                                   "--experiment_id", "test_batch",
+                                                   "--output_subdir", tmpdirname])
+            with self.assertRaises(clab.FhtbioinfpyCellLineAuthBatchExperimentsFailed) as context:
+                clab.main(args)
+            # the query samples of a single run are not a batch option: they would be applied to every experiment
+            with self.assertRaises(SystemExit):
+                clab.build_parser().parse_args(["--manifest_filepath", manifest_filepath, "--ref_expr_filepath", self.ref_expr_filepath,
+                                                "--experiment_id", "test_batch", "--query_sample_ids", "A1"])
+
+            summary_filepath = os.path.join(tmpdirname, "test_batch_cell_line_authentication_batch_summary_r3x7.txt")
+            self.assertTrue(os.path.isfile(summary_filepath))
+            summary_df = pd.read_csv(summary_filepath, sep = "\t", index_col = 0)
+            logger.debug("\nsummary_df\n{}".format(summary_df))
+            self.assertEqual(list(summary_df["status"][:2]), ["mismatch", "mismatch"])
+            self.assertTrue(summary_df.loc["exp3", "status"].startswith("error"))
+            self.assertEqual(list(summary_df["n_samples"][:2]), [86, 86])
+
+            # the usual per-experiment outputs, with the same matches as a single pipeline run
+            pipeline_subdir = os.path.join(tmpdirname, "pipeline")
+            with self.assertRaises(cla.FhtbioinfpyCellLineAuthenticationNoDepMapIDMatch) as context:
+                clap.main(clap.build_parser().parse_args(["--query_expr_filepath", self.query_expr_filepath,
+                                                          "--ref_expr_filepath", self.ref_expr_filepath,
+                                                          "--experiment_id", "exp1",
+                                                          "--output_subdir", pipeline_subdir]))
+            compared_depmap_filename = "exp1_cell_line_authentication_compared_depmap_r86x35.txt"
+            pipeline_df = pd.read_csv(os.path.join(pipeline_subdir, compared_depmap_filename), sep = "\t", index_col = 0)
+            for exp_id in ["exp1", "exp2"]:
+                batch_df = pd.read_csv(os.path.join(tmpdirname, compared_depmap_filename.replace("exp1", exp_id)), sep = "\t", index_col = 0)
+                self.assertTrue(batch_df["top_corr_depmap_ID"].equals(pipeline_df["top_corr_depmap_ID"]))
+                self.assertTrue(os.path.isfile(os.path.join(tmpdirname, "{}_cell_line_authentication_match_scores_r86x9.txt".format(exp_id))))
+
+
+if __name__ == "__main__":
+    setup_logger.setup(verbose=True)
+
+    unittest.main()
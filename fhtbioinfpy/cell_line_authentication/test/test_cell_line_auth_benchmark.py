@@ -0,0 +1,92 @@
+import unittest
+import logging
+import fhtbioinfpy.setup_logger as setup_logger
+import fhtbioinfpy.cell_line_authentication.cell_line_auth_benchmark as cell_line_auth_benchmark
+import cmapPy.pandasGEXpress.parse as parse
+import os
+import json
+import tempfile
+import numpy as np
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+class TestCellLineAuthBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        logger.debug("setUp")
+        self.config = cell_line_auth_benchmark.BenchmarkConfig(n_genes=200, n_query_samples=12, n_ref_lines=40,
+            gene_overlap=0.8, noise=0.5, random_state=0)
+
+    def tearDown(self):
+        logger.debug("tearDown")
+
+    def test_generate_synthetic_datasets(self):
+        query_gctoo, ref_gctoo = cell_line_auth_benchmark.generate_synthetic_datasets(self.config)
+        self.assertEqual(ref_gctoo.data_df.shape, (200, 40))
+        self.assertEqual(query_gctoo.data_df.shape, (200, 12))
+        self.assertEqual(query_gctoo.row_metadata_df["gene_symbol"].isin(ref_gctoo.data_df.index).sum(), 160)
+        self.assertTrue(query_gctoo.col_metadata_df["DepMap_ID"].isin(ref_gctoo.data_df.columns).all())
+
+        # same seed, same data
+        query_gctoo_2, _ = cell_line_auth_benchmark.generate_synthetic_datasets(self.config)
+        np.testing.assert_array_equal(query_gctoo.data_df.to_numpy(), query_gctoo_2.data_df.to_numpy())
+
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            query_filepath, ref_filepath = cell_line_auth_benchmark.write_synthetic_datasets(query_gctoo, ref_gctoo, tmpdirname)
+            self.assertEqual(os.path.basename(query_filepath), "synthetic_query_r200x12.gctx")
+            reread_query_gctoo = parse.parse(query_filepath)
+            self.assertEqual(reread_query_gctoo.data_df.shape, (200, 12))
+            self.assertEqual(parse.parse(ref_filepath).data_df.shape, (200, 40))
+
+    def test_run_benchmark(self):
+        query_gctoo, ref_gctoo = cell_line_auth_benchmark.generate_synthetic_datasets(self.config)
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            results = cell_line_auth_benchmark.run_benchmark(query_gctoo, ref_gctoo, tmpdirname, repeats=2)
+        logger.debug("results: {}".format(results))
+        self.assertEqual(list(results["steps"].keys()), ["build_matched_datasets", "run_correlation_calculation",
+            "save_corr_df", "load_correlation_df", "rank_full_row", "build_match_scores", "compare_depmap_id"])
+        self.assertEqual(results["n_matched_genes"], 160)
+        # every query sample is a noisy copy of its reference line
+        self.assertEqual(results["match_rate"], 1.0)
+
+    def test_compare_to_baseline(self):
+        baseline = {"config": {"n_genes": 200}, "steps": {"a": {"wall_s": 1.0}, "b": {"wall_s": 1.0}}}
+        results = {"config": {"n_genes": 200}, "steps": {"a": {"wall_s": 1.2}, "b": {"wall_s": 6.0}, "c": {"wall_s": 1.0}}}
+        comparison_df = cell_line_auth_benchmark.compare_to_baseline(results, baseline, regression_tolerance=1.5)
+        logger.debug("\ncomparison_df\n{}".format(comparison_df))
+        self.assertEqual(comparison_df["regression"].to_dict(), {"a": False, "b": True, "c": False})
+        # b takes 6 / 7.2 of the time against half in the baseline
+        self.assertAlmostEqual(comparison_df.loc["b", "ratio"], 6.0 / 7.2 / 0.5)
+        self.assertTrue(np.isnan(comparison_df.loc["c", "ratio"]))
+
+        # a machine twice as slow on every step is no regression
+        results = {"config": {"n_genes": 200}, "steps": {"a": {"wall_s": 2.0}, "b": {"wall_s": 2.0}}}
+        comparison_df = cell_line_auth_benchmark.compare_to_baseline(results, baseline, regression_tolerance=1.5)
+        self.assertFalse(comparison_df["regression"].any())
+
+    def test_main_functional(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            baseline_filepath = os.path.join(tmpdirname, "baseline.json")
+            args = cell_line_auth_benchmark.build_parser().parse_args(["--output_dir", os.path.join(tmpdirname, "out"),
+                "--n_genes", "200", "--n_query_samples", "12", "--n_ref_lines", "40", "--repeats", "1",
+                "--baseline_filepath", baseline_filepath, "--save_baseline"])
+            cell_line_auth_benchmark.main(args)
+            with open(baseline_filepath, "r") as f:
+                baseline = json.load(f)
+            self.assertEqual(baseline["config"]["n_genes"], 200)
+
+            # a baseline where the correlation took no time makes it a regression, which only fails the run when asked to
+            baseline["steps"]["run_correlation_calculation"]["wall_s"] = 1e-9
+            with open(baseline_filepath, "w") as f:
+                json.dump(baseline, f)
+            args.save_baseline = False
+            cell_line_auth_benchmark.main(args)
+            args.fail_on_regression = True
+            with self.assertRaises(cell_line_auth_benchmark.FhtbioinfpyCellLineAuthBenchmarkRegression):
+                cell_line_auth_benchmark.main(args)
+
+
+if __name__ == "__main__":
+    setup_logger.setup(verbose=True)
+
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+import logging
+import fhtbioinfpy.setup_logger as setup_logger
+import fhtbioinfpy.cell_line_authentication.cell_line_auth_pipeline as clap
+import fhtbioinfpy.cell_line_authentication.cell_line_authentication as cla
+import fhtbioinfpy.cell_line_authentication.cell_line_correlation as clc
+import pandas as pd
+import os
+import tempfile
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+class TestCellLineAuthPipeline(unittest.TestCase):
+
+    def setUp(self):
+        logger.debug("setUp")
+
+        self.query_expr_filepath = "./assets/test_cell_line_auth/test_cell_line_auth_query_data_r110x86.gctx"
+        self.ref_expr_filepath   = "./assets/test_cell_line_auth/test_cell_line_auth_ref_data_r108x1406.gctx"
+        self.exp_id = "test_experiment_id"
+        self.compared_depmap_filename = "test_experiment_id_cell_line_authentication_compared_depmap_r86x35.txt"
+        self.match_scores_filename = "test_experiment_id_cell_line_authentication_match_scores_r86x9.txt"
+
+    def tearDown(self):
+        logger.debug("tearDown")
+
+    def test_main_functional(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            logger.debug("test_main tmpdirname:  {}".format(tmpdirname))
+            two_step_subdir = os.path.join(tmpdirname, "two_step")
+            fused_subdir = os.path.join(tmpdirname, "fused")
+
+            # today's two invocations
+            clc.main(clc.build_parser().parse_args(["--query_expr_filepath", self.query_expr_filepath,
+                                                    "--ref_expr_filepath", self.ref_expr_filepath,
+                                                    "--experiment_id", self.exp_id,
+                                                    "--output_subdir", two_step_subdir]))
+            with self.assertRaises(cla.FhtbioinfpyCellLineAuthenticationNoDepMapIDMatch) as context:
+                cla.main(cla.build_parser().parse_args(["--query_expr_filepath", self.query_expr_filepath,
+                                                        "--experiment_id", self.exp_id,
+                                                        "--output_subdir", two_step_subdir,
+                                                        "--corr_filepath", os.path.join(two_step_subdir, "test_experiment_id_cell_line_authentication_corr_r86x1406.txt")]))
+
+            # one fused invocation
+            args = clap.build_parser().parse_args(["--query_expr_filepath", self.query_expr_filepath,
+                                                   "--ref_expr_filepath", self.ref_expr_filepath,
+                                                   "--experiment_id", self.exp_id,
+                                                   "--output_subdir", fused_subdir])
+            with self.assertRaises(cla.FhtbioinfpyCellLineAuthenticationNoDepMapIDMatch) as context:
+                clap.main(args)
+
+            # no intermediate matrix unless asked for
+            self.assertEqual(sorted(os.listdir(fused_subdir)), [self.compared_depmap_filename, self.match_scores_filename])
+
+            two_step_df = pd.read_csv(os.path.join(two_step_subdir, self.compared_depmap_filename), sep = "\t", index_col = 0)
+            fused_df = pd.read_csv(os.path.join(fused_subdir, self.compared_depmap_filename), sep = "\t", index_col = 0)
+            self.assertTrue(two_step_df["top_corr_depmap_ID"].equals(fused_df["top_corr_depmap_ID"]))
+            self.assertTrue(two_step_df["cell_line_match"].equals(fused_df["cell_line_match"]))
+
+    def test_main_functional_save_corr_df_top_k(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            args = clap.build_parser().parse_args(["--query_expr_filepath", self.query_expr_filepath,
+                                                   "--ref_expr_filepath", self.ref_expr_filepath,
+                                                   "--experiment_id", self.exp_id,
+                                                   "--output_subdir", tmpdirname,
+                                                   "--top_k", "2",
+                                                   "--save_corr_df"])
+            with self.assertRaises(cla.FhtbioinfpyCellLineAuthenticationNoDepMapIDMatch) as context:
+                clap.main(args)
+
+            self.assertTrue(os.path.isfile(os.path.join(tmpdirname, self.compared_depmap_filename)))
+            self.assertTrue(os.path.isfile(os.path.join(tmpdirname, "test_experiment_id_cell_line_authentication_top2_r172x4.txt")))
+
+
+if __name__ == "__main__":
+    setup_logger.setup(verbose=True)
+
+    unittest.main()
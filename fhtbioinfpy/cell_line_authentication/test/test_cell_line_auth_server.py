@@ -0,0 +1,97 @@
+import unittest
+import logging
+import fhtbioinfpy.setup_logger as setup_logger
+import fhtbioinfpy.cell_line_authentication.cell_line_auth_server as clas
+import cmapPy.pandasGEXpress.parse as parse
+import threading
+import json
+import urllib.request
+import urllib.error
+import tempfile
+import os
+import pandas as pd
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+class TestCellLineAuthServer(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.query_expr_filepath = "./assets/test_cell_line_auth/test_cell_line_auth_query_data_r110x86.gctx"
+        cls.ref_expr_filepath   = "./assets/test_cell_line_auth/test_cell_line_auth_ref_data_r108x1406.gctx"
+
+        args = clas.build_parser().parse_args(["--ref_expr_filepath", cls.ref_expr_filepath, "--port", "0", "--request_workers", "2",
+                                               "--data_root", "./assets"])
+        cls.server = clas.build_server(args)
+        cls.url = "http://{}:{}".format(*cls.server.server_address[:2])
+        cls.server_thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.server_thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.server.state.executor.shutdown()
+
+    def post(self, request):
+        http_request = urllib.request.Request(self.url + "/authenticate", data=json.dumps(request).encode(),
+            headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(http_request) as response:
+            return json.loads(response.read())
+
+    def test_health(self):
+        with urllib.request.urlopen(self.url + "/health") as response:
+            health = json.loads(response.read())
+        logger.debug("health: {}".format(health))
+        self.assertEqual((health["n_genes"], health["n_columns"]), (108, 1406))
+
+    def test_authenticate(self):
+        by_path = self.post({"query_expr_filepath": os.path.relpath(self.query_expr_filepath, "./assets")})
+        self.assertEqual(by_path["n_samples"], 86)
+
+        # the same query sent as a matrix, concurrently
+        query_expr_gctoo = parse.parse(self.query_expr_filepath)
+        query_expr_df = query_expr_gctoo.data_df.join(query_expr_gctoo.row_metadata_df[["gene_symbol"]]).set_index("gene_symbol")
+        request = {"query_expr": {"index": list(query_expr_df.index), "columns": list(query_expr_df.columns),
+                                  "data": query_expr_df.to_numpy().tolist()},
+                   "depmap_ids": query_expr_gctoo.col_metadata_df["DepMap_ID"].to_dict()}
+        responses = [None] * 3
+        def post_into(i):
+            responses[i] = self.post(request)
+        threads = [threading.Thread(target=post_into, args=(i,)) for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        for by_matrix in responses:
+            self.assertEqual(by_matrix["n_mismatched"], by_path["n_mismatched"])
+            for sample_id, scores in by_path["match_scores"].items():
+                self.assertEqual(by_matrix["match_scores"][sample_id]["top_corr_depmap_ID"], scores["top_corr_depmap_ID"])
+                self.assertAlmostEqual(by_matrix["match_scores"][sample_id]["top1_r"], scores["top1_r"], places=6)
+
+    def test_bad_request(self):
+        # no query, a malformed matrix, and files outside the data root (or missing)
+        for request in [{"no_query": True}, {"query_expr": {"index": ["a"]}}, {"query_expr_filepath": "../setup.py"},
+                {"query_expr_filepath": os.path.abspath(self.ref_expr_filepath) + ".missing"}]:
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                self.post(request)
+            self.assertEqual(context.exception.code, 400)
+
+    def test_workers_not_supported(self):
+        args = clas.build_parser().parse_args(["--ref_expr_filepath", self.ref_expr_filepath, "--port", "0", "--workers", "2"])
+        with self.assertRaises(clas.FhtbioinfpyCellLineAuthServerWorkersNotSupported):
+            clas.build_server(args)
+
+    def test_build_parser(self):
+        # options of a single run's query and outputs are not server options
+        for extra_args in [["--query_sample_ids", "A1"], ["--output_subdir", "out"], ["--output_format", "npy"],
+                ["--output_dtype", "float32"], ["--save_corr_df"], ["--profile"], ["--request_workers", "0"]]:
+            with self.assertRaises(SystemExit):
+                clas.build_parser().parse_args(["--ref_expr_filepath", self.ref_expr_filepath] + extra_args)
+
+
+if __name__ == "__main__":
+    setup_logger.setup(verbose=True)
+
+    unittest.main()
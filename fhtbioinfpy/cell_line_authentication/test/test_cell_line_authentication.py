@@ -4,9 +4,11 @@ import unittest
 import logging
 import fhtbioinfpy.setup_logger as setup_logger
 import fhtbioinfpy.cell_line_authentication.cell_line_authentication as cla
+import fhtbioinfpy.cell_line_authentication.cell_line_correlation as clc
 import pandas as pd
 import os
 import tempfile
+import json
 import numpy as np
 import cmapPy
 import cmapPy.pandasGEXpress.parse as parse
@@ -59,6 +61,28 @@ class TestCellLineAuthentication(unittest.TestCase):
             loaded_csv_file = pd.read_csv(expected_output_file, sep = "\t")
             self.assertFalse(loaded_csv_file.empty)
 
+            match_scores_file = os.path.join(tmpdirname, "test_experiment_id_cell_line_authentication_match_scores_r86x9.txt")
+            self.assertTrue(os.path.isfile(match_scores_file))
+            match_scores_df = pd.read_csv(match_scores_file, sep = "\t", index_col = 0)
+            loaded_csv_file = loaded_csv_file.set_index(loaded_csv_file.columns[0])
+            self.assertTrue((match_scores_df["top_corr_depmap_ID"] == loaded_csv_file["top_corr_depmap_ID"]).all())
+
+    def test_main_functional_profile(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            args = cla.build_parser().parse_args(["--query_expr_filepath", self.query_expr_filepath,
+                                                  "--experiment_id", "test_experiment_id",
+                                                  "--output_subdir", tmpdirname,
+                                                  "--corr_filepath", self.corr_filepath,
+                                                  "--profile"])
+            with self.assertRaises(cla.FhtbioinfpyCellLineAuthenticationNoDepMapIDMatch) as context:
+                cla.main(args)
+
+            # written before the mismatch is raised
+            with open(os.path.join(tmpdirname, "test_experiment_id_cell_line_authentication_profile.json")) as f:
+                report = json.load(f)
+            self.assertEqual([s["stage"] for s in report["stages"]], ["load", "rank", "compare", "save"])
+            self.assertEqual(report["stages"][0]["shapes"]["corr_df"], [86, 1406])
+
     def test_load_correlation_df(self):
         logger.debug("\ntest_read_RNA_seq_gctx\n")
 
@@ -72,6 +96,25 @@ class TestCellLineAuthentication(unittest.TestCase):
         logger.debug("\nquery_expr_df.iloc[1,2]:\n{}".format(corr_df.iloc[1,2])) 
         self.assertEqual(corr_df.iloc[1,2], 0.7613657886411502)
     
+    def test_load_correlation_df_binary_formats(self):
+        logger.debug("\ntest_load_correlation_df_binary_formats\n")
+
+        expected_corr_df = cla.load_correlation_df(self.corr_filepath)
+        with tempfile.TemporaryDirectory(prefix = "fhtbioinfpy_test_cell_line_authentication") as tmpdirname:
+            for output_format in ["npy", "parquet", "gctx"]:
+                corr_filepath = clc.save_corr_df(expected_corr_df, self.exp_id, tmpdirname, output_format=output_format)
+                corr_df = cla.load_correlation_df(corr_filepath)
+                logger.debug("\n{} corr_df.shape\n{}".format(output_format, corr_df.shape))
+
+                self.assertEqual(corr_df.shape, (86, 1406))
+                self.assertEqual(list(corr_df.index), list(expected_corr_df.index))
+                self.assertEqual(list(corr_df.columns), list(expected_corr_df.columns))
+                if output_format == "gctx":
+                    # cmapPy stores gctx matrices as float32
+                    np.testing.assert_allclose(corr_df.to_numpy(), expected_corr_df.to_numpy(), rtol=1e-6)
+                else:
+                    self.assertEqual(corr_df.iloc[1,2], 0.7613657886411502)
+
     def test_read_RNA_seq_gctx(self):
         logger.debug("\ntest_read_RNA_seq_gctx\n")
 
@@ -105,6 +148,61 @@ class TestCellLineAuthentication(unittest.TestCase):
         self.assertTrue(isEqual.all())
 
 
+    def test_identify_top_k_match(self):
+        logger.debug("\ntest_identify_top_k_match\n")
+
+        top_k_df = pd.DataFrame({"sample_id": ["a", "a", "b", "b", "c", "c"], "rank": [1, 2, 1, 2, 1, 2],
+                                 "DepMap_ID": ["depmap_id1", "depmap_id3", "depmap_id2", "depmap_id1", "depmap_id3", "depmap_id2"],
+                                 "r": [0.9, 0.8, 0.95, 0.7, 0.9, 0.1]}).set_index("sample_id")
+        self.assertTrue(cla.is_top_k_df(top_k_df))
+        self.assertFalse(cla.is_top_k_df(self.df))
+
+        cl_match_ID_s = cla.identify_top_k_match(top_k_df)
+        logger.debug("\ncl_match_ID_s\n{}".format(cl_match_ID_s))
+        expected_series = pd.Series(["depmap_id1", "depmap_id2", "depmap_id3"], index = ['a', 'b', 'c'])
+        self.assertEqual(cl_match_ID_s.name, "top_corr_depmap_ID")
+        self.assertTrue((expected_series == cl_match_ID_s).all())
+
+    def test_score_matches(self):
+        logger.debug("\ntest_score_matches\n")
+
+        corr_df = pd.DataFrame({"depmap_id1": [0.9, 0.2, 0.5], "depmap_id2": [0.1, 0.8, 0.5], "depmap_id3": [0.85, 0.3, np.nan]},
+            index = ['a', 'b', 'c'])
+        expected_depmap_s = pd.Series(["depmap_id3", "depmap_id2", "depmap_id4"], index = ['a', 'b', 'c'])
+        scores_df = cla.score_matches(corr_df, expected_depmap_s, ambiguous_margin=0.1)
+        logger.debug("\nscores_df\n{}".format(scores_df))
+
+        # same top match as ranking the whole row, including the first of tied columns for c
+        expected_series = cla.identify_rank(corr_df.rank(axis = 1, method = "first", ascending = False))
+        self.assertTrue((scores_df["top_corr_depmap_ID"] == expected_series).all())
+        self.assertEqual(list(scores_df["top_corr_depmap_ID"]), ["depmap_id1", "depmap_id2", "depmap_id1"])
+
+        np.testing.assert_allclose(scores_df["top1_r"], [0.9, 0.8, 0.5])
+        np.testing.assert_allclose(scores_df["margin"], [0.05, 0.5, 0.0], atol=1e-12)
+        row = np.array([0.9, 0.1, 0.85])
+        self.assertAlmostEqual(scores_df.loc["a", "zscore"], (0.9 - row.mean()) / row.std())
+
+        self.assertEqual(list(scores_df["expected_rank"].astype(object).fillna(-1)), [2, 1, -1])
+        self.assertAlmostEqual(scores_df.loc["a", "expected_r"], 0.85)
+        self.assertTrue(np.isnan(scores_df.loc["c", "expected_r"]))
+        self.assertEqual(list(scores_df["ambiguous_match"]), [True, False, True])
+
+    def test_score_top_k_matches(self):
+        logger.debug("\ntest_score_top_k_matches\n")
+
+        top_k_df = pd.DataFrame({"sample_id": ["a", "a", "b", "b"], "rank": [1, 2, 1, 2],
+                                 "DepMap_ID": ["depmap_id1", "depmap_id3", "depmap_id2", "depmap_id1"],
+                                 "r": [0.9, 0.85, 0.8, 0.3]}).set_index("sample_id")
+        expected_depmap_s = pd.Series(["depmap_id3", "depmap_id4"], index = ['a', 'b'])
+        scores_df = cla.score_top_k_matches(top_k_df, expected_depmap_s, ambiguous_margin=0.1)
+        logger.debug("\nscores_df\n{}".format(scores_df))
+
+        self.assertEqual(list(scores_df["top_corr_depmap_ID"]), ["depmap_id1", "depmap_id2"])
+        np.testing.assert_allclose(scores_df["margin"], [0.05, 0.5])
+        self.assertEqual(scores_df.loc["a", "expected_rank"], 2)
+        self.assertTrue(pd.isna(scores_df.loc["b", "expected_rank"]))
+        self.assertEqual(list(scores_df["ambiguous_match"]), [True, False])
+
     def test_compare_depmap_id(self):
         logger.debug("\ntest_compare_depmap_id\n")
 
@@ -4,12 +4,20 @@ import unittest
 import logging
 import fhtbioinfpy.setup_logger as setup_logger
 import fhtbioinfpy.cell_line_authentication.cell_line_correlation as clc
+import fhtbioinfpy.cell_line_authentication.reference_store as reference_store
+import fhtbioinfpy.cell_line_authentication.candidate_index as candidate_index
 import pandas as pd
 import os
 import tempfile
+import shutil
+import unittest.mock
+import json
 import numpy as np
+import h5py
 import cmapPy
 import cmapPy.pandasGEXpress.parse as parse
+import cmapPy.math.fast_corr as fast_corr
+import cmapPy.pandasGEXpress.write_gctx as write_gctx
 
 logger = logging.getLogger(setup_logger.LOGGER_NAME)
 
@@ -57,6 +65,33 @@ class TestCellLineCorrelation(unittest.TestCase):
             self.assertTrue(os.path.isfile(expected_output_file))
             loaded_csv_file = pd.read_csv(expected_output_file, sep = "\t")
             self.assertFalse(loaded_csv_file.empty)  
+            # no profile report unless asked for
+            self.assertEqual(len(os.listdir(tmpdirname)), 1)
+
+    def test_main_functional_profile(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            args = clc.build_parser().parse_args(["--query_expr_filepath", self.query_expr_filepath,
+                                                  "--ref_expr_filepath", self.ref_expr_filepath,
+                                                  "--experiment_id", self.exp_id,
+                                                  "--output_subdir", tmpdirname,
+                                                  "--profile"])
+            clc.main(args)
+
+            profile_filepath = os.path.join(tmpdirname, "test_experiment_id_cell_line_correlation_profile.json")
+            self.assertTrue(os.path.isfile(profile_filepath))
+            with open(profile_filepath) as f:
+                report = json.load(f)
+            logger.debug("report: {}".format(report))
+            self.assertEqual(report["tool"], "cell_line_correlation")
+            self.assertEqual([s["stage"] for s in report["stages"]], ["load_align", "prepare", "correlate", "save"])
+            for stage in report["stages"]:
+                self.assertGreaterEqual(stage["wall_s"], 0)
+                self.assertGreaterEqual(stage["cpu_s"], 0)
+                self.assertGreater(stage["rss_mb"], 0)
+                self.assertIsNotNone(stage["rss_delta_mb"])
+                self.assertGreaterEqual(stage["process_peak_rss_mb"], stage["rss_mb"])
+            self.assertEqual(report["stages"][0]["shapes"]["subset_query_expr"], [97, 86])
+            self.assertEqual(report["stages"][2]["shapes"]["corr_df"], [86, 1406])
 
     def test_read_RNA_seq_gctx(self):
         logger.debug("\ntest_read_RNA_seq_gctx\n")
@@ -86,6 +121,72 @@ class TestCellLineCorrelation(unittest.TestCase):
         logger.debug("\nref_expr_df.iloc[1,2]:\n{}".format(ref_expr_df.iloc[1,2])) 
         self.assertEqual(ref_expr_df.iloc[1,2], 4.372951984405518) 
 
+    def test_read_gctx_rows(self):
+        logger.debug("\ntest_read_gctx_rows\n")
+
+        expected_df = self.query_expr_gctoo.data_df
+        ridx = [5, 1, 2, 3, 40, 7]
+        cidx = [4, 0, 2]
+
+        # the fixture is stored contiguous and uncompressed - read through a memory map
+        data_array = clc.read_gctx_rows(self.query_expr_filepath, ridx, cidx)
+        self.assertEqual(data_array.shape, (6, 3))
+        np.testing.assert_array_equal(data_array, expected_df.iloc[ridx, cidx].to_numpy())
+
+        # chunked, compressed gctx as written by cmapPy - read in contiguous slices
+        with tempfile.TemporaryDirectory(prefix = "fhtbioinfpy_test_cell_line_authentication") as tmpdirname:
+            chunked_filepath = os.path.join(tmpdirname, "chunked.gctx")
+            write_gctx.write(self.query_expr_gctoo, chunked_filepath)
+            data_array = clc.read_gctx_rows(chunked_filepath, ridx)
+            self.assertEqual(data_array.shape, (6, 86))
+            np.testing.assert_array_equal(data_array, expected_df.iloc[ridx].to_numpy())
+            data_array = clc.read_gctx_rows(chunked_filepath, ridx, cidx + [4])
+            np.testing.assert_array_equal(data_array, expected_df.iloc[ridx, cidx + [4]].to_numpy())
+
+            # the values come back in the dtype of the file (cmapPy writes float32, so the matrix is written with h5py)
+            float64_filepath = os.path.join(tmpdirname, "float64.gctx")
+            with h5py.File(float64_filepath, "w") as gctx:
+                gctx.create_dataset("0/DATA/0/matrix", data=expected_df.to_numpy().T.astype(np.float64))
+            data_array = clc.read_gctx_rows(float64_filepath, ridx, cidx)
+            self.assertEqual(data_array.dtype, np.float64)
+            np.testing.assert_array_equal(data_array, expected_df.iloc[ridx, cidx].to_numpy())
+
+            # a path relative to the home directory reaches the memory map expanded
+            shutil.copy(self.query_expr_filepath, os.path.join(tmpdirname, "query.gctx"))
+            with unittest.mock.patch.dict(os.environ, {"HOME": tmpdirname}):
+                data_array = clc.read_gctx_rows(os.path.join("~", "query.gctx"), ridx, cidx)
+            np.testing.assert_array_equal(data_array, expected_df.iloc[ridx, cidx].to_numpy())
+
+    def test_find_query_samples(self):
+        logger.debug("\ntest_find_query_samples\n")
+
+        self.assertEqual(list(clc.find_query_samples(["c", "a"], ["a", "b", "c"])), [2, 0])
+        with self.assertRaises(clc.FhtbioinfpyCellLineCorrelationQuerySampleNotFound):
+            clc.find_query_samples(["a", "not_a_sample"], pd.Index(["a", "b"]))
+
+    def test_load_matched_gctx_datasets(self):
+        logger.debug("\ntest_load_matched_gctx_datasets\n")
+
+        query_expr_df = clc.query_set_index(self.query_expr_gctoo, self.row_metadata_for_matching)
+        ref_expr_gctoo = clc.load_ref_expr_data(self.ref_expr_filepath)
+        expected_query_expr, expected_ref_expr = clc.build_matched_datasets(query_expr_df, ref_expr_gctoo.data_df)
+
+        subset_query_expr, subset_ref_expr, ref_manifest = clc.load_matched_gctx_datasets(self.query_expr_filepath,
+            self.ref_expr_filepath, self.row_metadata_for_matching)
+        self.assertIsNone(ref_manifest)
+        self.assertTrue(subset_query_expr.equals(expected_query_expr))
+        self.assertTrue(subset_ref_expr.equals(expected_ref_expr))
+        self.assertEqual(subset_query_expr.index.name, self.row_metadata_for_matching)
+
+        # only the requested samples
+        subset_query_expr, subset_ref_expr, ref_manifest = clc.load_matched_gctx_datasets(self.query_expr_filepath,
+            self.ref_expr_filepath, self.row_metadata_for_matching, query_sample_ids=["A3", "A1"])
+        self.assertTrue(subset_query_expr.equals(expected_query_expr[["A3", "A1"]]))
+
+        with self.assertRaises(clc.FhtbioinfpyCellLineCorrelationQuerySampleNotFound) as context:
+            clc.load_matched_gctx_datasets(self.query_expr_filepath, self.ref_expr_filepath,
+                self.row_metadata_for_matching, query_sample_ids=["A1", "not_a_sample"])
+
     def test_query_set_index(self):
         logger.debug("\ntest_query_set_index\n")
 
@@ -188,6 +289,275 @@ class TestCellLineCorrelation(unittest.TestCase):
         self.assertTrue(valuesEqual.all)
         
 
+    def test_compute_block_sizes(self):
+        logger.debug("\ntest_compute_block_sizes\n")
+
+        # budget large enough for everything in one block
+        query_block_size, ref_block_size = clc.compute_block_sizes(100, 10, 20, 10**9)
+        self.assertEqual((query_block_size, ref_block_size), (10, 20))
+
+        # small budget - blocks respect it
+        n_genes = 1000
+        budget_bytes = 8 * 100000
+        query_block_size, ref_block_size = clc.compute_block_sizes(n_genes, 500, 1406, budget_bytes)
+        logger.debug("\nquery_block_size: {}  ref_block_size: {}".format(query_block_size, ref_block_size))
+        used_bytes = 8 * (n_genes * (query_block_size + ref_block_size) + query_block_size * ref_block_size)
+        self.assertLessEqual(used_bytes, budget_bytes)
+        self.assertGreaterEqual(query_block_size, 1)
+        self.assertGreaterEqual(ref_block_size, 1)
+
+        # budget too small for even one column - still makes progress one column at a time
+        self.assertEqual(clc.compute_block_sizes(n_genes, 500, 1406, 8), (1, 1))
+
+    def test_run_blocked_correlation(self):
+        logger.debug("\ntest_run_blocked_correlation\n")
+
+        ref_expr_gctoo = clc.load_ref_expr_data(self.ref_expr_filepath)
+        query_expr_df = clc.query_set_index(self.query_expr_gctoo, self.row_metadata_for_matching)
+        subset_query_expr, subset_ref_expr = clc.build_matched_datasets(query_expr_df, ref_expr_gctoo.data_df)
+
+        # fast_corr works in the float32 precision of the fixtures, the blocks are standardized in float64
+        expected = clc.run_correlation_calculation(subset_query_expr, subset_ref_expr)
+        # ~0.5 MB budget forces many blocks over the 86 x 1406 correlations
+        result = clc.run_blocked_correlation(subset_query_expr, subset_ref_expr, 0.5)
+        logger.debug("\nresult.shape: {}".format(result.shape))
+
+        self.assertEqual(result.shape, expected.shape)
+        self.assertTrue((result.index == expected.index).all())
+        self.assertTrue((result.columns == expected.columns).all())
+        self.assertEqual(result.index.name, expected.index.name)
+        np.testing.assert_allclose(result.to_numpy(), expected.to_numpy(), rtol=1e-6, atol=1e-6)
+
+        # same result through the dispatching entry point
+        result = clc.run_correlation(subset_query_expr, subset_ref_expr, memory_budget_mb=0.5)
+        np.testing.assert_allclose(result.to_numpy(), expected.to_numpy(), rtol=1e-6, atol=1e-6)
+
+    def test_run_top_k_correlation(self):
+        logger.debug("\ntest_run_top_k_correlation\n")
+
+        ref_expr_gctoo = clc.load_ref_expr_data(self.ref_expr_filepath)
+        query_expr_df = clc.query_set_index(self.query_expr_gctoo, self.row_metadata_for_matching)
+        subset_query_expr, subset_ref_expr = clc.build_matched_datasets(query_expr_df, ref_expr_gctoo.data_df)
+        corr_df = clc.run_blocked_correlation(subset_query_expr, subset_ref_expr, 0.5)
+
+        k = 5
+        # small budget so the running top k is merged over many reference blocks
+        top_k_df = clc.run_top_k_correlation(subset_query_expr, subset_ref_expr, k, memory_budget_mb=0.5)
+        logger.debug("\ntop_k_df\n{}".format(top_k_df))
+        self.assertEqual(list(top_k_df.columns), clc.TOP_K_COLUMNS)
+        self.assertEqual(top_k_df.shape, (86 * k, 4))
+
+        for sample_id, sample_top_k_df in top_k_df.groupby("sample_id"):
+            expected_s = corr_df.loc[sample_id].sort_values(ascending=False)[:k]
+            self.assertEqual(list(sample_top_k_df["rank"]), list(range(1, k + 1)))
+            self.assertEqual(list(sample_top_k_df["DepMap_ID"]), list(expected_s.index))
+            np.testing.assert_allclose(sample_top_k_df["r"].to_numpy(), expected_s.to_numpy())
+
+        # k larger than the reference keeps every reference column
+        matched_query_df = pd.DataFrame({"a": [2, 3, 4], "b": [7, 5, 1]})
+        matched_ref_df = pd.DataFrame({"c": [13, 11, 12], "d": [17, 19, 20]})
+        top_k_df = clc.run_top_k_correlation(matched_query_df, matched_ref_df, 10)
+        self.assertEqual(top_k_df.shape, (4, 4))
+        self.assertEqual(list(top_k_df["DepMap_ID"]), ["d", "c", "c", "d"])
+
+        # tied reference columns rank by their position, whatever the reference block size
+        tied_ref_df = pd.DataFrame({"e": [1, 2, 3], "f": [2, 4, 6], "g": [3, 2, 1], "h": [1, 2, 3]})
+        for memory_budget_mb in [1e-4, 1]:
+            top_k_df = clc.run_top_k_correlation(matched_query_df[["a"]], tied_ref_df, 2, memory_budget_mb=memory_budget_mb)
+            self.assertEqual(list(top_k_df["DepMap_ID"]), ["e", "f"])
+        self.assertEqual(list(clc.top_k_from_corr_df(clc.run_correlation_calculation(matched_query_df[["a"]], tied_ref_df), 3)["DepMap_ID"]), ["e", "f", "h"])
+
+        # k must be a positive integer
+        for top_k in ["0", "-2"]:
+            with self.assertRaises(SystemExit):
+                clc.build_parser().parse_args(["--query_expr_filepath", "q", "--ref_expr_filepath", "r", "--experiment_id", "e", "--top_k", top_k])
+
+    def test_save_top_k_df(self):
+        logger.debug("\ntest_save_top_k_df\n")
+
+        top_k_df = pd.DataFrame({"sample_id": ["a", "a", "b", "b"], "rank": [1, 2, 1, 2],
+                                 "DepMap_ID": ["d", "e", "c", "d"], "r": [1.0, 0.5, 1.0, -1.0]})
+        with tempfile.TemporaryDirectory(prefix = "fhtbioinfpy_test_cell_line_authentication") as tmpdirname:
+            expected_output_file = clc.save_top_k_df(top_k_df, 2, self.exp_id, tmpdirname)
+            self.assertEqual(os.path.basename(expected_output_file), "test_experiment_id_cell_line_authentication_top2_r4x4.txt")
+            loaded_csv_file = pd.read_csv(expected_output_file, sep = "\t")
+            self.assertEqual(list(loaded_csv_file.columns), clc.TOP_K_COLUMNS)
+            self.assertEqual(loaded_csv_file.iloc[3, 3], -1.0)
+
+    def test_build_query_partitions(self):
+        logger.debug("\ntest_build_query_partitions\n")
+
+        # a few partitions per worker, but never narrower than min_columns
+        self.assertEqual(clc.build_query_partitions(5, 2, min_columns=2), [(0, 2), (2, 4), (4, 5)])
+        self.assertEqual(clc.build_query_partitions(100, 2), [(0, 32), (32, 64), (64, 96), (96, 100)])
+        self.assertEqual(clc.build_query_partitions(200, 4), [(0, 32), (32, 64), (64, 96), (96, 128), (128, 160), (160, 192), (192, 200)])
+        partitions = clc.build_query_partitions(10000, 8)
+        self.assertEqual(len(partitions), 8 * clc.QUERY_PARTITIONS_PER_WORKER)
+        self.assertEqual(partitions[0][0], 0)
+        self.assertEqual(partitions[-1][1], 10000)
+
+    def test_run_parallel_correlation(self):
+        logger.debug("\ntest_run_parallel_correlation\n")
+
+        ref_expr_gctoo = clc.load_ref_expr_data(self.ref_expr_filepath)
+        query_expr_df = clc.query_set_index(self.query_expr_gctoo, self.row_metadata_for_matching)
+        subset_query_expr, subset_ref_expr = clc.build_matched_datasets(query_expr_df, ref_expr_gctoo.data_df)
+
+        # 86 query samples make 3 partitions of at least 32 columns, scored in the pool
+        self.assertEqual(len(clc.build_query_partitions(subset_query_expr.shape[1], 3)), 3)
+        parallel_corr_df = clc.run_correlation(subset_query_expr, subset_ref_expr, workers=3)
+        logger.debug("\nparallel_corr_df.shape: {}".format(parallel_corr_df.shape))
+
+        # the same as the serial engine up to floating point rounding, with the same top matches
+        expected = clc.run_correlation(subset_query_expr, subset_ref_expr, workers=1)
+        self.assertTrue(parallel_corr_df.index.equals(expected.index))
+        self.assertTrue(parallel_corr_df.columns.equals(expected.columns))
+        np.testing.assert_allclose(parallel_corr_df.to_numpy(), expected.to_numpy(), rtol=1e-6, atol=1e-6)
+        self.assertTrue(clc.summarize_top_matches(parallel_corr_df)["top_corr_depmap_ID"].equals(
+            clc.summarize_top_matches(expected)["top_corr_depmap_ID"]))
+
+        # engine options the pool does not honor are rejected rather than ignored
+        args = clc.build_parser().parse_args(["--query_expr_filepath", "q.gctx", "--ref_expr_filepath", "r.gctx", "--experiment_id", "exp", "--workers", "2", "--top_k", "3"])
+        with self.assertRaises(clc.FhtbioinfpyCellLineCorrelationIncompatibleArguments):
+            clc.check_engine_arguments(args)
+        args.workers = 1
+        clc.check_engine_arguments(args)
+        with self.assertRaises(SystemExit):
+            clc.build_parser().parse_args(["--query_expr_filepath", "q.gctx", "--ref_expr_filepath", "r.gctx", "--experiment_id", "exp", "--workers", "0"])
+
+        # the candidate search runs in float64, so a float32 run would be neither float32 nor checked against float64
+        args = clc.build_parser().parse_args(["--query_expr_filepath", "q.gctx", "--ref_expr_filepath", "r.gctx", "--experiment_id", "exp", "--pca_candidates", "5", "--dtype", "float32"])
+        with self.assertRaises(clc.FhtbioinfpyCellLineCorrelationIncompatibleArguments):
+            clc.check_engine_arguments(args)
+        for accuracy_check_samples in ["0", "-1"]:
+            with self.assertRaises(SystemExit):
+                clc.build_parser().parse_args(["--query_expr_filepath", "q.gctx", "--ref_expr_filepath", "r.gctx", "--experiment_id", "exp", "--accuracy_check_samples", accuracy_check_samples])
+
+    def test_build_ranked_datasets(self):
+        logger.debug("\ntest_build_ranked_datasets\n")
+
+        ref_expr_gctoo = clc.load_ref_expr_data(self.ref_expr_filepath)
+        query_expr_df = clc.query_set_index(self.query_expr_gctoo, self.row_metadata_for_matching)
+        subset_query_expr, subset_ref_expr = clc.build_matched_datasets(query_expr_df, ref_expr_gctoo.data_df)
+
+        with tempfile.TemporaryDirectory(prefix = "fhtbioinfpy_test_cell_line_authentication") as tmpdirname:
+            ranked_query_expr, ref_rank_std_df = clc.build_ranked_datasets(subset_query_expr, subset_ref_expr,
+                "fingerprint", rank_cache_dir=tmpdirname)
+            corr_df = clc.run_correlation(ranked_query_expr, ref_rank_std_df, ref_is_standardized=True)
+
+        expected = fast_corr.fast_spearman(subset_query_expr.to_numpy(), subset_ref_expr.to_numpy())
+        self.assertEqual(corr_df.shape, (86, 1406))
+        np.testing.assert_allclose(corr_df.to_numpy(), expected, rtol=1e-6, atol=1e-6)
+
+    def test_top_match_margins(self):
+        logger.debug("\ntest_top_match_margins\n")
+
+        corr_arr = np.array([[0.1, 0.9, 0.5], [0.7, np.nan, 0.2], [0.3, 0.3, 0.1]])
+        best_positions, margins = clc.top_match_margins(corr_arr)
+        self.assertEqual(list(best_positions), [1, 0, 0])
+        np.testing.assert_allclose(margins, [0.4, 0.5, 0.0])
+
+        corr_df = pd.DataFrame(corr_arr, index = ["a", "b", "c"], columns = ["d", "e", "f"])
+        top_matches_df = clc.summarize_top_matches(corr_df)
+        self.assertEqual(list(top_matches_df["top_corr_depmap_ID"]), ["e", "d", "d"])
+
+        top_k_df = clc.run_top_k_correlation(pd.DataFrame({"a": [2, 3, 4], "b": [7, 5, 1]}),
+            pd.DataFrame({"c": [13, 11, 12], "d": [17, 19, 20]}), 2)
+        top_matches_df = clc.summarize_top_k_matches(top_k_df)
+        self.assertEqual(list(top_matches_df["top_corr_depmap_ID"]), ["d", "c"])
+        self.assertTrue((top_matches_df["margin"] > 0).all())
+
+    def test_check_float32_accuracy(self):
+        logger.debug("\ntest_check_float32_accuracy\n")
+
+        ref_expr_gctoo = clc.load_ref_expr_data(self.ref_expr_filepath)
+        query_expr_df = clc.query_set_index(self.query_expr_gctoo, self.row_metadata_for_matching)
+        subset_query_expr, subset_ref_expr = clc.build_matched_datasets(query_expr_df, ref_expr_gctoo.data_df)
+
+        corr32_df = clc.run_correlation(subset_query_expr, subset_ref_expr, dtype="float32")
+        self.assertEqual(corr32_df.to_numpy().dtype, np.float32)
+        corr64_df = clc.run_standardized_correlation(subset_query_expr, subset_ref_expr, ref_is_standardized=False)
+        np.testing.assert_allclose(corr32_df.to_numpy(), corr64_df.to_numpy(), atol=1e-5)
+
+        top_matches_df = clc.summarize_top_matches(corr32_df)
+        disagreement_df = clc.check_float32_accuracy(subset_query_expr, subset_ref_expr, top_matches_df, n_check_samples=86)
+        self.assertTrue(disagreement_df.empty)
+
+        # a wrong top match is reported
+        top_matches_df.loc["A1", "top_corr_depmap_ID"] = "not_the_best_match"
+        disagreement_df = clc.check_float32_accuracy(subset_query_expr, subset_ref_expr, top_matches_df, n_check_samples=86)
+        self.assertEqual(list(disagreement_df.index), ["A1"])
+
+    def test_compute_cached_correlations(self):
+        logger.debug("\ntest_compute_cached_correlations\n")
+
+        ref_expr_gctoo = clc.load_ref_expr_data(self.ref_expr_filepath)
+        query_expr_df = clc.query_set_index(self.query_expr_gctoo, self.row_metadata_for_matching)
+        subset_query_expr, subset_ref_expr = clc.build_matched_datasets(query_expr_df, ref_expr_gctoo.data_df)
+
+        with tempfile.TemporaryDirectory(prefix = "fhtbioinfpy_test_cell_line_correlation") as tmpdirname:
+            for top_k in [None, 3]:
+                cache_dir = os.path.join(tmpdirname, "cache_top_k_{}".format(top_k))
+                arg_list = ["--query_expr_filepath", self.query_expr_filepath, "--ref_expr_filepath", self.ref_expr_filepath,
+                            "--experiment_id", self.exp_id, "--cache_dir", cache_dir]
+                if top_k is not None:
+                    arg_list += ["--top_k", str(top_k)]
+                args = clc.build_parser().parse_args(arg_list)
+                expected_df = clc.run_correlation_engine(subset_query_expr, subset_ref_expr, False, args)
+
+                cached_df = clc.compute_correlations(subset_query_expr, subset_ref_expr, False, args)
+                self.assertEqual(len(os.listdir(cache_dir)), 86)
+                pd.testing.assert_frame_equal(cached_df, expected_df)
+
+                # a rerun with one re-sequenced sample adds one entry and merges the rest
+                changed_query_expr = subset_query_expr.copy()
+                changed_query_expr["A1"] = changed_query_expr["A1"] + 1.0
+                changed_query_expr.iloc[0, 0] = 0.0
+                merged_df = clc.compute_correlations(changed_query_expr, subset_ref_expr, False, args)
+                self.assertEqual(len(os.listdir(cache_dir)), 87)
+                pd.testing.assert_frame_equal(merged_df, clc.run_correlation_engine(changed_query_expr, subset_ref_expr, False, args))
+
+            # another method gets its own entries
+            args.method = "spearman"
+            clc.compute_correlations(subset_query_expr.iloc[:, :2], subset_ref_expr, False, args)
+            self.assertEqual(len(os.listdir(cache_dir)), 89)
+
+    def test_run_candidate_correlation(self):
+        logger.debug("\ntest_run_candidate_correlation\n")
+
+        ref_expr_gctoo = clc.load_ref_expr_data(self.ref_expr_filepath)
+        query_expr_df = clc.query_set_index(self.query_expr_gctoo, self.row_metadata_for_matching)
+        subset_query_expr, subset_ref_expr = clc.build_matched_datasets(query_expr_df, ref_expr_gctoo.data_df)
+        exact_corr_df = clc.run_correlation_calculation(subset_query_expr, subset_ref_expr)
+
+        args = clc.build_parser().parse_args(["--query_expr_filepath", self.query_expr_filepath, "--ref_expr_filepath", self.ref_expr_filepath,
+                                              "--experiment_id", self.exp_id, "--pca_candidates", "50", "--top_k", "3"])
+        ref_std_df, _ = reference_store.standardize_reference(subset_ref_expr)
+        index = candidate_index.build_candidate_index(ref_std_df)
+        corr_df = clc.run_candidate_correlation(subset_query_expr, subset_ref_expr, index, 50)
+        self.assertEqual(corr_df.shape, exact_corr_df.shape)
+        self.assertTrue((corr_df.notna().sum(axis=1) == 50).all())
+        pd.testing.assert_frame_equal(corr_df[corr_df.notna()].fillna(0), exact_corr_df[corr_df.notna()].fillna(0))
+
+        # the top k of the candidates is the exact top k on the fixtures
+        top_k_df = clc.top_k_from_corr_df(corr_df, 3)
+        expected_top_k_df = clc.top_k_from_corr_df(exact_corr_df, 3)
+        self.assertEqual(list(top_k_df.columns), clc.TOP_K_COLUMNS)
+        self.assertTrue(top_k_df["DepMap_ID"].equals(expected_top_k_df["DepMap_ID"]))
+
+        # a GCTX reference has no saved index: the exact engine runs instead of building one
+        self.assertIsNone(clc.load_store_candidate_index(subset_ref_expr, args))
+        args.method = "spearman"
+        with self.assertLogs(logger, level="WARNING") as logs:
+            self.assertIsNone(clc.load_store_candidate_index(subset_ref_expr, args))
+        self.assertIn("only serves --method pearson", logs.output[0])
+        args.method = "pearson"
+        with self.assertRaises(SystemExit):
+            clc.build_parser().parse_args(["--query_expr_filepath", self.query_expr_filepath, "--ref_expr_filepath", self.ref_expr_filepath,
+                                           "--experiment_id", self.exp_id, "--pca_candidates", "0"])
+        top_k_df = clc.run_correlation_engine(subset_query_expr, subset_ref_expr, False, args)
+        pd.testing.assert_frame_equal(top_k_df, expected_top_k_df)
+
     def test_save_corr_df(self):
         logger.debug("\ntest_save_df\n")
 
@@ -203,6 +573,45 @@ class TestCellLineCorrelation(unittest.TestCase):
             self.assertEqual(loaded_csv_file.iloc[1,2], -1.0)
             
 
+    def test_save_corr_df_binary_formats(self):
+        logger.debug("\ntest_save_corr_df_binary_formats\n")
+
+        with tempfile.TemporaryDirectory(prefix = "fhtbioinfpy_test_cell_line_authentication") as tmpdirname:
+            for output_format in ["npy", "parquet", "gctx"]:
+                expected_output_file = clc.save_corr_df(self.df, self.exp_id, tmpdirname, output_format=output_format, output_dtype="float32")
+                logger.debug("\nexpected_output_file\n{}".format(expected_output_file))
+                self.assertEqual(os.path.basename(expected_output_file),
+                    "test_experiment_id_cell_line_authentication_corr_r2x3.{}".format(output_format))
+                self.assertTrue(os.path.exists(expected_output_file))
+
+            self.assertTrue(os.path.exists(os.path.join(tmpdirname, "test_experiment_id_cell_line_authentication_corr_r2x3" + clc.NPY_LABELS_SUFFIX)))
+            loaded_arr = np.load(os.path.join(tmpdirname, "test_experiment_id_cell_line_authentication_corr_r2x3.npy"))
+            self.assertEqual(loaded_arr.dtype, np.float32)
+            np.testing.assert_array_equal(loaded_arr, self.df.to_numpy())
+
+    def test_check_output_arguments(self):
+        logger.debug("\ntest_check_output_arguments\n")
+        base_args = ["--query_expr_filepath", "q.gctx", "--ref_expr_filepath", "r.gctx", "--experiment_id", "exp"]
+        args = clc.build_parser().parse_args(base_args)
+        self.assertIsNone(args.output_dtype)
+        clc.check_output_arguments(args)
+
+        # the top k long table is always txt with the computed r, so these would be silently ignored
+        for output_args in [["--output_format", "npy"], ["--output_dtype", "float32"]]:
+            args = clc.build_parser().parse_args(base_args + ["--top_k", "3"] + output_args)
+            with self.assertRaises(clc.FhtbioinfpyCellLineCorrelationIncompatibleArguments):
+                clc.check_output_arguments(args)
+        clc.check_output_arguments(clc.build_parser().parse_args(base_args + ["--top_k", "3", "--output_format", "txt"]))
+
+    def test_save_corr_df_keeps_dtype(self):
+        logger.debug("\ntest_save_corr_df_keeps_dtype\n")
+
+        with tempfile.TemporaryDirectory(prefix = "fhtbioinfpy_test_cell_line_authentication") as tmpdirname:
+            # without output_dtype the float32 correlations are not upcast
+            expected_output_file = clc.save_corr_df(self.df.astype(np.float32), self.exp_id, tmpdirname, output_format="npy")
+            self.assertEqual(np.load(expected_output_file).dtype, np.float32)
+
+
 if __name__ == "__main__":
     setup_logger.setup(verbose=True)
 
@@ -0,0 +1,70 @@
+import unittest
+import logging
+import fhtbioinfpy.setup_logger as setup_logger
+import fhtbioinfpy.cell_line_authentication.correlation_cache as correlation_cache
+import pandas as pd
+import os
+import tempfile
+import numpy as np
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+class TestCorrelationCache(unittest.TestCase):
+
+    def setUp(self):
+        logger.debug("setUp")
+
+        self.query_expr = pd.DataFrame({"a": [1.0, 2.0, 3.0], "b": [3.0, 2.0, 1.0], "c": [1.0, 2.0, 3.0]},
+            index = pd.Index(["ENSG1", "ENSG2", "ENSG3"], name = "gene_symbol"))
+
+    def tearDown(self):
+        logger.debug("tearDown")
+
+    def test_sample_keys(self):
+        settings_hexdigest = correlation_cache.settings_key("fingerprint", self.query_expr.index, ["c1", "c2"], {"method": "pearson"})
+        keys = correlation_cache.sample_keys(self.query_expr, settings_hexdigest)
+        logger.debug("\nkeys:\n{}".format(keys))
+
+        # keyed by the expression values, not the sample id
+        self.assertEqual(keys[0], keys[2])
+        self.assertNotEqual(keys[0], keys[1])
+
+        # the reference, genes and settings are all part of the key
+        for other_settings_hexdigest in [
+                correlation_cache.settings_key("other_fingerprint", self.query_expr.index, ["c1", "c2"], {"method": "pearson"}),
+                correlation_cache.settings_key("fingerprint", ["ENSG1", "ENSG2", "ENSG4"], ["c1", "c2"], {"method": "pearson"}),
+                correlation_cache.settings_key("fingerprint", self.query_expr.index, ["c1", "c3"], {"method": "pearson"}),
+                correlation_cache.settings_key("fingerprint", self.query_expr.index, ["c1", "c2"], {"method": "spearman"})]:
+            self.assertNotEqual(correlation_cache.sample_keys(self.query_expr, other_settings_hexdigest)[0], keys[0])
+
+    def test_save_and_load_entry(self):
+        with tempfile.TemporaryDirectory(prefix = "fhtbioinfpy_test_correlation_cache") as tmpdirname:
+            self.assertIsNone(correlation_cache.load_entry(tmpdirname, "missing"))
+
+            correlation_cache.save_entry(tmpdirname, "key", r=np.array([0.5, -0.25]), positions=np.array([3, 1]))
+            entry = correlation_cache.load_entry(tmpdirname, "key")
+            np.testing.assert_array_equal(entry["r"], [0.5, -0.25])
+            np.testing.assert_array_equal(entry["positions"], [3, 1])
+            self.assertEqual(os.listdir(tmpdirname), ["key" + correlation_cache.ENTRY_SUFFIX])
+
+    def test_evict(self):
+        with tempfile.TemporaryDirectory(prefix = "fhtbioinfpy_test_correlation_cache") as tmpdirname:
+            for i, key in enumerate(["old", "used", "new"]):
+                path = correlation_cache.save_entry(tmpdirname, key, r=np.zeros(1000))
+                os.utime(path, ns=(i * 10**9, i * 10**9))
+            entry_size = os.path.getsize(path)
+
+            # loading an entry makes it the most recently used
+            correlation_cache.load_entry(tmpdirname, "used")
+
+            self.assertEqual(correlation_cache.evict(tmpdirname, 3 * entry_size), 0)
+            self.assertEqual(correlation_cache.evict(tmpdirname, 2 * entry_size), 1)
+            self.assertEqual(sorted(os.listdir(tmpdirname)), ["new.npz", "used.npz"])
+            self.assertEqual(correlation_cache.evict(tmpdirname, entry_size), 1)
+            self.assertEqual(os.listdir(tmpdirname), ["used.npz"])
+
+
+if __name__ == "__main__":
+    setup_logger.setup(verbose=True)
+
+    unittest.main()
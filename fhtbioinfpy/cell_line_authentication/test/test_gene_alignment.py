@@ -0,0 +1,84 @@
+import unittest
+import logging
+import fhtbioinfpy.setup_logger as setup_logger
+import fhtbioinfpy.cell_line_authentication.gene_alignment as gene_alignment
+import fhtbioinfpy.cell_line_authentication.cell_line_correlation as clc
+import pandas as pd
+import os
+import tempfile
+import numpy as np
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+class TestGeneAlignment(unittest.TestCase):
+
+    def setUp(self):
+        logger.debug("setUp")
+
+        # ENSG2 appears twice in the query, ENSG3 is only in the query and ENSMUSG3 only in the reference
+        self.query_expr = pd.DataFrame({"a": [1.0, 2.0, 4.0, 3.0, 5.0], "b": [10.0, 20.0, 30.0, 40.0, 50.0]},
+            index = pd.Index(["ENSG4", "ENSG2", "ENSG3", "ENSG2", "ENSG1"], name = "gene_symbol"))
+        self.ref_expr = pd.DataFrame({"c": [13.0, 11.0, 2.0, 7.0], "d": [17.0, 19.0, 5.0, 3.0]},
+            index = pd.Index(["ENSG1", "ENSG2", "ENSMUSG3", "ENSG4"], name = "rid"))
+
+    def tearDown(self):
+        logger.debug("tearDown")
+
+    def test_build_gene_alignment(self):
+        alignment = gene_alignment.build_gene_alignment(self.query_expr.index, self.ref_expr.index, aggregation="sum")
+        logger.debug("\nalignment:\n{}".format(alignment))
+
+        self.assertEqual(list(alignment.genes), ["ENSG1", "ENSG2", "ENSG4"])
+        self.assertEqual(list(alignment.query_positions), [4, 1, 3, 0])
+        self.assertEqual(list(alignment.query_group_starts), [0, 1, 3])
+        self.assertEqual(list(alignment.ref_positions), [0, 1, 3])
+        self.assertEqual(list(alignment.ref_group_starts), [0, 1, 2])
+
+        with self.assertRaises(gene_alignment.FhtbioinfpyGeneAlignmentUnknownAggregation) as context:
+            gene_alignment.build_gene_alignment(self.query_expr.index, self.ref_expr.index, aggregation="median")
+
+    def test_apply_gene_alignment(self):
+        expected_b = {"sum": [50.0, 60.0, 10.0], "mean": [50.0, 30.0, 10.0], "max": [50.0, 40.0, 10.0]}
+        for aggregation in gene_alignment.AGGREGATIONS:
+            alignment = gene_alignment.build_gene_alignment(self.query_expr.index, self.ref_expr.index, aggregation=aggregation)
+            subset_query_expr, subset_ref_expr = gene_alignment.apply_gene_alignment(alignment, self.query_expr, self.ref_expr)
+            logger.debug("\n{}\nsubset_query_expr:\n{}".format(aggregation, subset_query_expr))
+
+            # duplicate symbols no longer multiply rows
+            self.assertEqual(subset_query_expr.shape, (3, 2))
+            self.assertEqual(list(subset_query_expr.index), ["ENSG1", "ENSG2", "ENSG4"])
+            self.assertEqual(subset_query_expr.index.name, "gene_symbol")
+            self.assertEqual(list(subset_query_expr["b"]), expected_b[aggregation])
+
+            self.assertEqual(list(subset_ref_expr.index), ["ENSG1", "ENSG2", "ENSG4"])
+            self.assertEqual(subset_ref_expr.index.name, "rid")
+            self.assertEqual(list(subset_ref_expr["d"]), [17.0, 19.0, 3.0])
+
+        # the matched datasets feed straight into the correlation
+        subset_query_expr, subset_ref_expr = clc.build_matched_datasets(self.query_expr, self.ref_expr, aggregation="sum")
+        self.assertEqual(clc.run_correlation_calculation(subset_query_expr, subset_ref_expr).shape, (2, 2))
+
+    def test_load_or_build_gene_alignment(self):
+        with tempfile.TemporaryDirectory(prefix = "fhtbioinfpy_test_gene_alignment") as tmpdirname:
+            alignment = gene_alignment.load_or_build_gene_alignment(self.query_expr.index, self.ref_expr.index,
+                aggregation="max", cache_dir=tmpdirname)
+            self.assertEqual(len(os.listdir(tmpdirname)), 1)
+
+            cached_alignment = gene_alignment.load_or_build_gene_alignment(self.query_expr.index, self.ref_expr.index,
+                aggregation="max", cache_dir=tmpdirname)
+            self.assertEqual(len(os.listdir(tmpdirname)), 1)
+            self.assertEqual(list(cached_alignment.genes), list(alignment.genes))
+            for field in ["query_positions", "query_group_starts", "ref_positions", "ref_group_starts"]:
+                np.testing.assert_array_equal(getattr(cached_alignment, field), getattr(alignment, field))
+            self.assertEqual(cached_alignment.aggregation, "max")
+
+            # another aggregation is another alignment
+            gene_alignment.load_or_build_gene_alignment(self.query_expr.index, self.ref_expr.index,
+                aggregation="sum", cache_dir=tmpdirname)
+            self.assertEqual(len(os.listdir(tmpdirname)), 2)
+
+
+if __name__ == "__main__":
+    setup_logger.setup(verbose=True)
+
+    unittest.main()
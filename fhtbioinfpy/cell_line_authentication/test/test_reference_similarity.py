@@ -0,0 +1,97 @@
+import unittest
+import logging
+import fhtbioinfpy.setup_logger as setup_logger
+import fhtbioinfpy.cell_line_authentication.reference_similarity as reference_similarity
+import fhtbioinfpy.cell_line_authentication.reference_store as reference_store
+import fhtbioinfpy.cell_line_authentication.cell_line_correlation as clc
+import fhtbioinfpy.cell_line_authentication.cell_line_authentication as cla
+import cmapPy.pandasGEXpress.parse as parse
+import pandas as pd
+import os
+import tempfile
+import numpy as np
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+class TestReferenceSimilarity(unittest.TestCase):
+
+    def setUp(self):
+        logger.debug("setUp")
+
+        self.query_expr_filepath = "./assets/test_cell_line_auth/test_cell_line_auth_query_data_r110x86.gctx"
+        self.ref_expr_filepath   = "./assets/test_cell_line_auth/test_cell_line_auth_ref_data_r108x1406.gctx"
+        self.ref_expr_df = clc.load_ref_expr_data(self.ref_expr_filepath).data_df
+
+    def tearDown(self):
+        logger.debug("tearDown")
+
+    def test_compute_self_similarity(self):
+        ref_standardized = reference_store.standardize_columns(self.ref_expr_df.to_numpy())
+        # blocks that do not divide the number of columns give the same matrix as one product
+        self_similarity = reference_similarity.compute_self_similarity(ref_standardized, block_size=500)
+        self.assertEqual(self_similarity.shape, (1406, 1406))
+        self.assertEqual(self_similarity.dtype, np.float32)
+        np.testing.assert_allclose(self_similarity, ref_standardized.T.dot(ref_standardized), atol=1e-6)
+        np.testing.assert_allclose(np.diag(self_similarity), 1.0, atol=1e-6)
+
+    def test_save_and_load_self_similarity(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            self.assertIsNone(reference_similarity.load_self_similarity(tmpdirname))
+
+            reference_store.compile_reference_store(self.ref_expr_df, tmpdirname)
+            self.assertIsNone(reference_similarity.load_near_twins(tmpdirname))
+            self_similarity_filepath = reference_similarity.save_self_similarity(tmpdirname, block_size=300)
+            self.assertEqual(os.listdir(tmpdirname).count(reference_similarity.SELF_SIMILARITY_FILENAME), 1)
+            self.assertTrue(os.path.isfile(self_similarity_filepath))
+
+            self_similarity_df = reference_similarity.load_self_similarity(tmpdirname)
+            self.assertTrue(self_similarity_df.columns.equals(self.ref_expr_df.columns.astype(str)))
+            expected = np.corrcoef(self.ref_expr_df.to_numpy(), rowvar=False)
+            np.testing.assert_allclose(self_similarity_df.to_numpy(), expected, atol=1e-6)
+
+    def test_find_near_twins(self):
+        columns = pd.Index(["a", "b", "c"])
+        self_similarity_df = pd.DataFrame([[1.0, 0.98, 0.5], [0.98, 1.0, np.nan], [0.5, np.nan, 1.0]], index=columns, columns=columns)
+        near_twins_df = reference_similarity.find_near_twins(self_similarity_df, min_r=0.97, block_size=2)
+        logger.debug("\nnear_twins_df\n{}".format(near_twins_df))
+        self.assertEqual(list(near_twins_df.columns), reference_similarity.NEAR_TWIN_COLUMNS)
+        self.assertEqual(sorted(zip(near_twins_df["DepMap_ID"], near_twins_df["near_twin_depmap_ID"])), [("a", "b"), ("b", "a")])
+
+        self.assertTrue(reference_similarity.find_near_twins(self_similarity_df, min_r=0.99).empty)
+
+    def test_compare_depmap_id_near_twins(self):
+        # the mismatched samples of the query fixture correlate best with a reference line that correlates 0.89 - 0.96
+        # with their annotated one
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            reference_store.compile_reference_store(self.ref_expr_df, tmpdirname)
+            reference_similarity.save_self_similarity(tmpdirname)
+            near_twins_df = reference_similarity.load_near_twins(tmpdirname, min_r=0.945)
+
+        query_expr_gctoo = parse.parse(self.query_expr_filepath)
+        subset_query_expr, subset_ref_expr = clc.build_matched_datasets(clc.query_set_index(query_expr_gctoo, "gene_symbol"), self.ref_expr_df)
+        corr_df = clc.run_correlation_calculation(subset_query_expr, subset_ref_expr)
+        cl_match_ID_s = cla.identify_best_match(corr_df)
+
+        compared_depmap_df = cla.compare_depmap_id(query_expr_gctoo.col_metadata_df, cl_match_ID_s)
+        self.assertNotIn("near_twin_match", compared_depmap_df.columns)
+
+        compared_depmap_df = cla.compare_depmap_id(query_expr_gctoo.col_metadata_df, cl_match_ID_s, near_twins_df=near_twins_df)
+        near_twin_df = compared_depmap_df[compared_depmap_df["near_twin_match"]]
+        logger.debug("\nnear_twin_df\n{}".format(near_twin_df))
+        self.assertGreater(len(near_twin_df), 0)
+        self.assertFalse(near_twin_df["cell_line_match"].any())
+        self_similarity = np.corrcoef(self.ref_expr_df.to_numpy(), rowvar=False)
+        positions = self.ref_expr_df.columns.get_indexer
+        self.assertTrue((self_similarity[positions(near_twin_df["DepMap_ID"]), positions(near_twin_df["top_corr_depmap_ID"])] >= 0.945).all())
+
+        # the remaining mismatches still raise
+        with self.assertRaises(cla.FhtbioinfpyCellLineAuthenticationNoDepMapIDMatch):
+            cla.check_for_warnings(compared_depmap_df)
+        # only near-twin mismatches are warnings
+        cla.check_for_warnings(compared_depmap_df[compared_depmap_df["cell_line_match"] | compared_depmap_df["near_twin_match"]])
+
+
+if __name__ == "__main__":
+    setup_logger.setup(verbose=True)
+
+    unittest.main()
@@ -0,0 +1,129 @@
+import unittest
+import logging
+import fhtbioinfpy.setup_logger as setup_logger
+import fhtbioinfpy.cell_line_authentication.reference_store as reference_store
+import fhtbioinfpy.cell_line_authentication.cell_line_correlation as clc
+import pandas as pd
+import os
+import json
+import tempfile
+import numpy as np
+import cmapPy.pandasGEXpress.parse as parse
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+class TestReferenceStore(unittest.TestCase):
+
+    def setUp(self):
+        logger.debug("setUp")
+
+        self.query_expr_filepath = "./assets/test_cell_line_auth/test_cell_line_auth_query_data_r110x86.gctx"
+        self.ref_expr_filepath   = "./assets/test_cell_line_auth/test_cell_line_auth_ref_data_r108x1406.gctx"
+        self.exp_id = "test_experiment_id"
+
+        self.ref_expr_df = pd.DataFrame({"c": [13.0, 11.0, 2.0], "d": [17.0, 19.0, 5.0], "e": [23.0, 29.0, 1.0]},
+            index = pd.Index(["ENSG1", "ENSG2", "ENSG3"], name = "rid"))
+        self.ref_expr_df.columns.name = "cid"
+
+    def tearDown(self):
+        logger.debug("tearDown")
+
+    def test_standardize_columns(self):
+        standardized = reference_store.standardize_columns(self.ref_expr_df.to_numpy())
+        logger.debug("\nstandardized:\n{}".format(standardized))
+
+        np.testing.assert_allclose(standardized.mean(axis=0), 0.0, atol=1e-12)
+        np.testing.assert_allclose(np.linalg.norm(standardized, axis=0), 1.0)
+
+        # the dot product of standardized columns is the pearson correlation
+        expected = np.corrcoef(self.ref_expr_df.to_numpy(), rowvar=False)
+        np.testing.assert_allclose(standardized.T.dot(standardized), expected)
+
+    def test_rank_columns(self):
+        arr = np.array([[3.0, 1.0], [1.0, 1.0], [2.0, np.nan], [2.0, 0.0]])
+        ranks = reference_store.rank_columns(arr)
+        logger.debug("\nranks:\n{}".format(ranks))
+
+        expected = pd.DataFrame(arr).rank(method="average").to_numpy()
+        np.testing.assert_allclose(ranks, expected)
+        np.testing.assert_allclose(ranks[:, 0], [4.0, 1.0, 2.5, 2.5])
+
+    def test_load_or_compute_standardized_ranks(self):
+        with tempfile.TemporaryDirectory(prefix = "fhtbioinfpy_test_reference_store") as tmpdirname:
+            cache_dir = os.path.join(tmpdirname, "rank_cache")
+            ref_rank_std_df = reference_store.load_or_compute_standardized_ranks(self.ref_expr_df, "fingerprint", cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            self.assertTrue(ref_rank_std_df.index.equals(self.ref_expr_df.index))
+            expected = reference_store.standardize_columns(self.ref_expr_df.rank().to_numpy())
+            np.testing.assert_allclose(ref_rank_std_df.to_numpy(), expected)
+
+            # second run with the same reference and genes is served from the cache
+            cached_df = reference_store.load_or_compute_standardized_ranks(self.ref_expr_df, "fingerprint", cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            np.testing.assert_allclose(cached_df.to_numpy(), expected)
+
+            # a different gene subset or reference gets its own entry
+            reference_store.load_or_compute_standardized_ranks(self.ref_expr_df.iloc[:2], "fingerprint", cache_dir=cache_dir)
+            reference_store.load_or_compute_standardized_ranks(self.ref_expr_df, "other_fingerprint", cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 3)
+
+    def test_compile_and_load_reference_store(self):
+        with tempfile.TemporaryDirectory(prefix = "fhtbioinfpy_test_reference_store") as tmpdirname:
+            store_dir = os.path.join(tmpdirname, "ref_store")
+            self.assertFalse(reference_store.is_reference_store(store_dir))
+
+            manifest = reference_store.compile_reference_store(self.ref_expr_df, store_dir)
+            self.assertTrue(reference_store.is_reference_store(store_dir))
+            self.assertEqual(manifest["format_version"], reference_store.STORE_FORMAT_VERSION)
+            self.assertEqual((manifest["n_genes"], manifest["n_columns"]), (3, 3))
+
+            ref_std_df, loaded_manifest = reference_store.load_reference_store(store_dir)
+            logger.debug("\nref_std_df:\n{}".format(ref_std_df))
+            self.assertEqual(list(ref_std_df.index), ["ENSG1", "ENSG2", "ENSG3"])
+            self.assertEqual(list(ref_std_df.columns), ["c", "d", "e"])
+            self.assertEqual(ref_std_df.index.name, "rid")
+            self.assertEqual(ref_std_df.columns.name, "cid")
+            np.testing.assert_allclose(ref_std_df.to_numpy(), reference_store.standardize_columns(self.ref_expr_df.to_numpy()))
+
+    def test_load_manifest_unsupported_version(self):
+        with tempfile.TemporaryDirectory(prefix = "fhtbioinfpy_test_reference_store") as tmpdirname:
+            reference_store.compile_reference_store(self.ref_expr_df, tmpdirname)
+            manifest_path = os.path.join(tmpdirname, reference_store.MANIFEST_FILENAME)
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            manifest["format_version"] = reference_store.STORE_FORMAT_VERSION + 1
+            with open(manifest_path, "w") as f:
+                json.dump(manifest, f)
+
+            with self.assertRaises(reference_store.FhtbioinfpyReferenceStoreUnsupportedVersion) as context:
+                reference_store.load_reference_store(tmpdirname)
+
+    def test_main_functional(self):
+        with tempfile.TemporaryDirectory(prefix = "fhtbioinfpy_test_reference_store") as tmpdirname:
+            store_dir = os.path.join(tmpdirname, "ref_store")
+            args = reference_store.build_parser().parse_args(["--ref_expr_filepath", self.ref_expr_filepath,
+                                                              "--output_store_dir", store_dir])
+            reference_store.main(args)
+            self.assertTrue(reference_store.is_reference_store(store_dir))
+
+            # correlations against the store match correlations against the parsed reference file
+            arg_list = ["--query_expr_filepath", self.query_expr_filepath,
+                        "--experiment_id", self.exp_id]
+            gctx_args = clc.build_parser().parse_args(arg_list + ["--ref_expr_filepath", self.ref_expr_filepath,
+                                                                  "--output_subdir", os.path.join(tmpdirname, "from_gctx")])
+            store_args = clc.build_parser().parse_args(arg_list + ["--ref_expr_filepath", store_dir,
+                                                                   "--output_subdir", os.path.join(tmpdirname, "from_store")])
+            clc.main(gctx_args)
+            clc.main(store_args)
+
+            output_filename = "test_experiment_id_cell_line_authentication_corr_r86x1406.txt"
+            gctx_corr_df = pd.read_csv(os.path.join(tmpdirname, "from_gctx", output_filename), sep = "\t", index_col = 0)
+            store_corr_df = pd.read_csv(os.path.join(tmpdirname, "from_store", output_filename), sep = "\t", index_col = 0)
+            self.assertEqual(list(gctx_corr_df.columns), list(store_corr_df.columns))
+            np.testing.assert_allclose(store_corr_df.to_numpy(), gctx_corr_df.to_numpy(), rtol=1e-6, atol=1e-6)
+
+
+if __name__ == "__main__":
+    setup_logger.setup(verbose=True)
+
+    unittest.main()
@@ -0,0 +1,68 @@
+"""
+fhtbioinfpy command line: one entry point for the tools, run as "python -m fhtbioinfpy <subcommand> [options]".
+Only the standard library is imported until a subcommand is chosen; its module (and pandas, cmapPy, h5py, ...) is then
+imported and its own parser reads the remaining options, so "fhtbioinfpy --help" and a mistyped subcommand answer at
+once. The parsers live in the tool modules, so "fhtbioinfpy <subcommand> --help" still pays for the imports of that
+tool (see startup_benchmark) before it shows its options.
+"""
+import logging
+import fhtbioinfpy.setup_logger as setup_logger
+import argparse
+import sys
+import collections
+import importlib
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+# subcommand -> (module with build_parser / main, one line help)
+SUBCOMMANDS = collections.OrderedDict([
+    ("prep-metadata", ("fhtbioinfpy.prep_metadata.prep_metadata", "look up the DepMap IDs of a metadata file")),
+    ("prep-metadata-batch", ("fhtbioinfpy.prep_metadata.prep_metadata_batch", "prepare every metadata sheet of a directory in parallel")),
+    ("resolve-cell-line", ("fhtbioinfpy.prep_metadata.cell_line_resolver", "suggest DepMap IDs for unmatched bio_context_ids")),
+    ("correlate", ("fhtbioinfpy.cell_line_authentication.cell_line_correlation", "correlate query samples with the reference lines")),
+    ("authenticate", ("fhtbioinfpy.cell_line_authentication.cell_line_authentication", "match each sample to its best correlated DepMap ID")),
+    ("pipeline", ("fhtbioinfpy.cell_line_authentication.cell_line_auth_pipeline", "correlate and authenticate in one run")),
+    ("batch", ("fhtbioinfpy.cell_line_authentication.cell_line_auth_batch", "correlate and authenticate every experiment of a manifest")),
+    ("serve", ("fhtbioinfpy.cell_line_authentication.cell_line_auth_server", "run the localhost authentication server")),
+    ("compile-reference", ("fhtbioinfpy.cell_line_authentication.reference_store", "compile a reference GCTX into a reference store")),
+    ("build-index", ("fhtbioinfpy.cell_line_authentication.candidate_index", "build the PCA candidate index of a reference store")),
+    ("self-similarity", ("fhtbioinfpy.cell_line_authentication.reference_similarity", "precompute the near-twin map of a reference store")),
+    ("benchmark", ("fhtbioinfpy.cell_line_authentication.cell_line_auth_benchmark", "time the authentication steps on synthetic data")),
+    ("startup-benchmark", ("fhtbioinfpy.startup_benchmark", "time the startup of the command line and the imports of each tool")),
+])
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="fhtbioinfpy", description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="subcommand", metavar="subcommand")
+    for subcommand, (_, subcommand_help) in SUBCOMMANDS.items():
+        # the options are parsed by the tool's own parser once its module is imported
+        subparsers.add_parser(subcommand, help=subcommand_help, add_help=False)
+    return parser
+
+
+# imports the module of the subcommand and parses the remaining options with its parser
+def load_subcommand(subcommand, subcommand_argv):
+    module_name, _ = SUBCOMMANDS[subcommand]
+    module = importlib.import_module(module_name)
+    subcommand_parser = module.build_parser()
+    subcommand_parser.prog = "fhtbioinfpy {}".format(subcommand)
+    return module, subcommand_parser.parse_args(subcommand_argv)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    args, subcommand_argv = build_parser().parse_known_args(argv[:1])
+    if args.subcommand is None:
+        build_parser().print_help()
+        return 2
+
+    module, subcommand_args = load_subcommand(args.subcommand, subcommand_argv + argv[1:])
+    setup_logger.setup(verbose=subcommand_args.verbose)
+    logger.debug("args:  {}".format(subcommand_args))
+    module.main(subcommand_args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
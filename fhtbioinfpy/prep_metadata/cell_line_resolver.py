@@ -0,0 +1,133 @@
+"""
+fuzzy resolver for bio_context_id values without an exact match in sample_info (e.g.
+KYSE70_sh_ctrl, HSES2R). An inverted index maps every character n-gram (default trigrams, with ^ / $ marking the start
+and end of a name) to the sample_info names containing it; a lookup only touches the names sharing a gram with the
+value and ranks them by the Dice similarity of their gram sets, instead of comparing the value with every cell line.
+prep_metadata writes the ranked candidate DepMap IDs of the unmatched values to a suggestions file when verify_match
+fails; run as a script to resolve values directly.
+"""
+import logging
+import fhtbioinfpy.setup_logger as setup_logger
+import argparse
+import sys
+import collections
+
+import os
+import pandas as pd
+import numpy
+import fhtbioinfpy.prep_metadata.depmapID_lookup as dmid
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+DEFAULT_NGRAM_SIZE = 3
+DEFAULT_N_SUGGESTIONS = 5
+SUGGESTION_COLUMNS = ["bio_context_id", "stripped_bio_context_id", "rank", "DepMap_ID", "stripped_cell_line_name", "score"]
+
+# names / depmap_ids: the indexed sample_info rows, postings: n-gram -> positions of the names containing it,
+# n_grams: number of distinct n-grams of each name (for the Dice similarity), ngram_size: n
+ResolverIndex = collections.namedtuple("ResolverIndex", ["names", "depmap_ids", "postings", "n_grams", "ngram_size"])
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--verbose", "-v", help="Whether to print a bunch of output.", action="store_true", default=False)
+    parser.add_argument("--sample_info_file", help = "sample info containing DepMap_ID and the cell line name", type = str, required = True)
+    parser.add_argument("--bio_context_ids", help="bio_context_id values to resolve", type=str, nargs="+", required = True)
+    parser.add_argument("--n_suggestions", help="number of candidate DepMap IDs per value", type=int, default=DEFAULT_N_SUGGESTIONS)
+    parser.add_argument("--lookup_cache_dir", help="directory of the cached DepMap alias index (see depmapID_lookup.load_alias_index)", type=str, default=None)
+    return parser
+
+
+# the distinct n-grams of a stripped name, with ^ and $ marking its start and end so prefixes weigh in
+def name_ngrams(name, ngram_size=DEFAULT_NGRAM_SIZE):
+    padded = "^" + name + "$"
+    return {padded[i:i + ngram_size] for i in range(max(len(padded) - ngram_size + 1, 1))}
+
+
+# inverted n-gram index over an alias index (see depmapID_lookup.load_alias_index): the n-grams are taken from its
+# lookup keys, already cleaned like stripped_bio_context_id, and each key names its line by stripped_cell_line_name.
+# Rows without a key are left out
+def build_resolver_index(look_up_df, ngram_size=DEFAULT_NGRAM_SIZE):
+    has_name = look_up_df.index.notna()
+    depmap_ids = look_up_df["DepMap_ID"].to_numpy()[has_name]
+    cleaned_names = look_up_df.index[has_name].astype(str).to_numpy()
+    names = look_up_df["stripped_cell_line_name"][has_name].fillna(look_up_df.index[has_name].to_series()).astype(str).to_numpy()
+
+    postings = collections.defaultdict(list)
+    n_grams = numpy.empty(len(names), dtype=numpy.int64)
+    for position, name in enumerate(cleaned_names):
+        grams = name_ngrams(name, ngram_size)
+        n_grams[position] = len(grams)
+        for gram in grams:
+            postings[gram].append(position)
+    postings = {gram: numpy.array(positions, dtype=numpy.int64) for gram, positions in postings.items()}
+    logger.debug("resolver index: {} names, {} distinct {}-grams".format(len(names), len(postings), ngram_size))
+    return ResolverIndex(names, depmap_ids, postings, n_grams, ngram_size)
+
+
+# the n_suggestions indexed names most similar to a stripped value, best first, as a dataframe with the rank, DepMap_ID,
+# stripped_cell_line_name and Dice score (2 x shared n-grams / (n-grams of the value + n-grams of the name))
+def resolve(index, stripped_value, n_suggestions=DEFAULT_N_SUGGESTIONS):
+    grams = name_ngrams(str(stripped_value).upper(), index.ngram_size)
+    hits = [index.postings[gram] for gram in grams if gram in index.postings]
+    if len(hits) == 0:
+        return pd.DataFrame(columns=["rank", "DepMap_ID", "stripped_cell_line_name", "score"])
+
+    positions, shared = numpy.unique(numpy.concatenate(hits), return_counts=True)
+    scores = 2.0 * shared / (len(grams) + index.n_grams[positions])
+    # best score first; ties go to the shorter name, then the sample_info order
+    order = numpy.lexsort((positions, index.n_grams[positions], -scores))
+    # an alias index holds several keys per line, each line is suggested once with its best key
+    _, first_of_line = numpy.unique(index.depmap_ids[positions[order]], return_index=True)
+    order = order[numpy.sort(first_of_line)][:n_suggestions]
+    return pd.DataFrame({"rank": numpy.arange(1, len(order) + 1), "DepMap_ID": index.depmap_ids[positions[order]],
+        "stripped_cell_line_name": index.names[positions[order]], "score": scores[order]})
+
+
+# candidate DepMap IDs for every distinct stripped_bio_context_id of the metadata that has no exact match in the lookup
+# table, one row per candidate (see SUGGESTION_COLUMNS)
+def suggest_depmap_ids(metadata, look_up_df, n_suggestions=DEFAULT_N_SUGGESTIONS, index=None):
+    if index is None:
+        index = build_resolver_index(look_up_df)
+    unmatched_df = metadata.loc[~metadata["stripped_bio_context_id"].isin(look_up_df.index), ["bio_context_id", "stripped_bio_context_id"]]
+    unmatched_df = unmatched_df.drop_duplicates("stripped_bio_context_id")
+
+    suggestion_tables = []
+    for bio_context_id, stripped_value in unmatched_df.itertuples(index=False):
+        candidates_df = resolve(index, stripped_value, n_suggestions=n_suggestions)
+        candidates_df.insert(0, "stripped_bio_context_id", stripped_value)
+        candidates_df.insert(0, "bio_context_id", bio_context_id)
+        suggestion_tables.append(candidates_df)
+    suggestions_df = pd.concat(suggestion_tables, ignore_index=True) if suggestion_tables else pd.DataFrame(columns=SUGGESTION_COLUMNS)
+    logger.debug("\nsuggestions_df\n{}".format(suggestions_df))
+    return suggestions_df[SUGGESTION_COLUMNS]
+
+
+# saves the suggestions as a csv/txt file next to the metadata output, returns its path
+def save_suggestions_df(suggestions_df, exp_id, subdir):
+    output_filename = "{exp_id}_depmap_suggestions_r{nrows}x{ncols}.txt".format(
+        exp_id=exp_id, nrows=suggestions_df.shape[0], ncols=suggestions_df.shape[1]
+    )
+    output_filepath = os.path.join(subdir, output_filename)
+    logger.debug("output_filepath : {}".format(output_filepath))
+    suggestions_df.to_csv(output_filepath, sep="\t", index=False)
+    return output_filepath
+
+
+def main(args):
+    look_up_df = dmid.load_alias_index(args.sample_info_file, cache_dir=args.lookup_cache_dir)
+    metadata = dmid.add_cleaned_cl_name(pd.DataFrame({"bio_context_id": args.bio_context_ids}), "bio_context_id")
+    suggestions_df = suggest_depmap_ids(metadata, look_up_df, n_suggestions=args.n_suggestions)
+    exact_df = metadata[metadata["stripped_bio_context_id"].isin(look_up_df.index)]
+    for bio_context_id, stripped_value in exact_df[["bio_context_id", "stripped_bio_context_id"]].itertuples(index=False):
+        logger.info("{}: exact match {}".format(bio_context_id, look_up_df.loc[stripped_value, "DepMap_ID"]))
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None):
+        print(suggestions_df.to_string(index=False))
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args(sys.argv[1:])
+    setup_logger.setup(verbose=args.verbose)
+    logger.debug("args:  {}".format(args))
+
+    main(args)
@@ -4,26 +4,24 @@
       - after the differential analysis , cell line Authentication
       - only will need to run the correlation calculation 
 """
-import ast
 import logging
-import operator
-import re
-import shutil
 import fhtbioinfpy.setup_logger as setup_logger
 import argparse
-import sys
+import hashlib
 
 import os
 import pandas as pd
-import numpy
-import collections
-import cmapPy
-import cmapPy.pandasGEXpress.parse as parse
-
-import plotly.express as pltexpr
 
 logger = logging.getLogger(setup_logger.LOGGER_NAME)
 
+SAMPLE_INFO_LOOKUP_COLUMNS = ['DepMap_ID', 'stripped_cell_line_name']
+# identifiers a bio_context_id can be resolved through, most authoritative first: a key claimed by several DepMap IDs
+# goes to the first of these columns claiming it
+ALIAS_KEY_COLUMNS = ['stripped_cell_line_name', 'cell_line_name', 'CCLE_Name', 'alias', 'RRID', 'COSMICID', 'Sanger_Model_ID']
+ALIAS_INDEX_COLUMNS = ['DepMap_ID', 'stripped_cell_line_name', 'lookup_key_source']
+# bump when the cached lookup table changes shape, so old artifacts are not picked up
+LOOKUP_CACHE_FORMAT_VERSION = 1
+
 def build_parser():
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("--verbose", "-v", help="Whether to print a bunch of output.", action="store_true", default=False)
@@ -42,19 +40,114 @@ def add_cleaned_cl_name(metadata, col_name):
     metadata["stripped_" + col_name] = metadata["stripped_" + col_name].astype(str).str.replace('NCI','')
     return metadata
 
+# only the lookup columns are parsed from the sample info csv
 def shorten_sample_info(sample_info_file):
-    sample_info = pd.read_csv(sample_info_file)
+    sample_info = pd.read_csv(sample_info_file, usecols=SAMPLE_INFO_LOOKUP_COLUMNS)
     # sample_info.set_index(['DepMap_ID'], inplace=True)
-    sample_info = sample_info[['DepMap_ID', 'stripped_cell_line_name']]
+    sample_info = sample_info[SAMPLE_INFO_LOOKUP_COLUMNS]
     return sample_info
 
+# sha256 of the sample info file, read in chunks - a new DepMap release gives a new key
+def sample_info_sha256(sample_info_file):
+    sha256 = hashlib.sha256()
+    with open(sample_info_file, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+# build_table(sample_info_file), cached in cache_dir under the hash of the sample info file: a repeat run reads the
+# ready table instead of parsing the csv, and a changed sample info file is rebuilt. No cache_dir, no caching
+def load_cached_table(build_table, table_name, sample_info_file, cache_dir=None):
+    if cache_dir is None:
+        return build_table(sample_info_file)
+
+    cache_filepath = os.path.join(cache_dir, "{}_v{}_{}.pkl".format(table_name, LOOKUP_CACHE_FORMAT_VERSION, sample_info_sha256(sample_info_file)))
+    if os.path.isfile(cache_filepath):
+        logger.debug("loading cached {}: {}".format(table_name, cache_filepath))
+        return pd.read_pickle(cache_filepath)
+
+    table = build_table(sample_info_file)
+    os.makedirs(cache_dir, exist_ok=True)
+    # written under a temporary name first, so a concurrent run never reads a partial table
+    tmp_filepath = "{}.{}.tmp".format(cache_filepath, os.getpid())
+    table.to_pickle(tmp_filepath)
+    os.replace(tmp_filepath, cache_filepath)
+    logger.debug("saved {} to cache: {}".format(table_name, cache_filepath))
+    return table
+
+# every (lookup_key, DepMap_ID) claim of the sample info identifier columns, in the order of ALIAS_KEY_COLUMNS. Keys
+# are cleaned like stripped_bio_context_id (see add_cleaned_cl_name) so the two join directly - stripped_cell_line_name
+# included, so NCI lines are found by their name without "NCI" (NCIH460 by H460), which the raw stripped_cell_line_name
+# never matched. The comma separated alias lists are split and the float COSMIC IDs written as integers. Columns
+# missing from the file are skipped
+def build_alias_keys(sample_info):
+    key_tables = []
+    for col_name in ALIAS_KEY_COLUMNS:
+        if col_name not in sample_info.columns:
+            continue
+        values = sample_info[col_name]
+        if col_name == "COSMICID":
+            values = values.astype("Int64")
+        values = values.dropna().astype(str)
+        if col_name == "alias":
+            values = values.str.split(",").explode()
+        keys_df = add_cleaned_cl_name(pd.DataFrame({"key": values}), "key")
+        keys_df = pd.DataFrame({"lookup_key": keys_df["stripped_key"], "DepMap_ID": sample_info.loc[keys_df.index, "DepMap_ID"],
+            "stripped_cell_line_name": sample_info.loc[keys_df.index, "stripped_cell_line_name"], "lookup_key_source": col_name})
+        key_tables.append(keys_df[keys_df["lookup_key"] != ""])
+    # one claim per key and DepMap ID, from its most authoritative column
+    return pd.concat(key_tables, ignore_index=True).drop_duplicates(["lookup_key", "DepMap_ID"])
+
+# the claims of keys claimed by more than one DepMap ID
+def find_alias_collisions(alias_keys_df):
+    n_claims = alias_keys_df.groupby("lookup_key")["DepMap_ID"].transform("size")
+    return alias_keys_df[n_claims > 1].sort_values(["lookup_key", "DepMap_ID"])
+
+# lookup table of every identifier of sample_info (see ALIAS_KEY_COLUMNS), indexed by the cleaned lookup_key. A key
+# claimed by several DepMap IDs goes to the claim from the most authoritative column and is left out when that column
+# itself claims it for several lines, so every key is unique and a join on the index never duplicates metadata rows
+def build_alias_index(sample_info_file):
+    wanted_columns = set(["DepMap_ID"] + ALIAS_KEY_COLUMNS)
+    sample_info = pd.read_csv(sample_info_file, usecols=lambda col_name: col_name in wanted_columns)
+    alias_keys_df = build_alias_keys(sample_info)
+
+    collisions_df = find_alias_collisions(alias_keys_df)
+    if not collisions_df.empty:
+        key_priority = alias_keys_df["lookup_key_source"].map({col_name: i for i, col_name in enumerate(ALIAS_KEY_COLUMNS)})
+        alias_keys_df = alias_keys_df[key_priority == key_priority.groupby(alias_keys_df["lookup_key"]).transform("min")]
+        ambiguous = alias_keys_df["lookup_key"].duplicated(keep=False)
+        logger.warning("{} lookup keys of {} are claimed by more than one DepMap_ID; {} are left out as ambiguous, the others go to their most authoritative column.\n{}".format(
+            collisions_df["lookup_key"].nunique(), sample_info_file, alias_keys_df.loc[ambiguous, "lookup_key"].nunique(), collisions_df))
+        alias_keys_df = alias_keys_df[~ambiguous]
+
+    alias_index = alias_keys_df.set_index("lookup_key")[ALIAS_INDEX_COLUMNS]
+    logger.debug("alias index: {} lookup keys for {} DepMap IDs".format(len(alias_index), alias_index["DepMap_ID"].nunique()))
+    return alias_index
+
+# build_alias_index, cached (see load_cached_table)
+def load_alias_index(sample_info_file, cache_dir=None):
+    return load_cached_table(build_alias_index, "depmap_alias_index", sample_info_file, cache_dir=cache_dir)
+
 #metadata has stripped_bio_context_id,
 #sample_info has stripped_cell_line_name
 #exception: 1) stripped_bio_context_id is never equal to a stripped_cell_line_name and no corresponding depmapID is found
+#exception: 2) the lookup table has duplicate keys, which would duplicate the metadata rows matching them
+#sample_info can also be a lookup table already indexed by stripped_cell_line_name or by lookup_key (see
+#load_alias_index); its lookup_key_source column is not joined, so the metadata gains DepMap_ID and stripped_cell_line_name
 
 def verify_match(metadata, sample_info):
-    look_up_df = sample_info.set_index("stripped_cell_line_name")
     #change index in sample info to stripped_cell_line_name
+    if sample_info.index.name in ("stripped_cell_line_name", "lookup_key"):
+        look_up_df = sample_info
+    else:
+        look_up_df = sample_info.set_index("stripped_cell_line_name")
+    if not look_up_df.index.is_unique:
+        duplicated_keys = look_up_df[look_up_df.index.duplicated(keep=False)]
+        msg = """\n\n!!!\nThe lookup table has duplicate {} values, the metadata rows matching them would be duplicated.\n\n{}""".format(look_up_df.index.name, duplicated_keys)
+        logger.exception(msg)
+        raise FhtbioinfpydepmapIDLookupKeyCollision(msg)
+    # which identifier column a key came from only matters while building the alias index, it is not added to the metadata
+    look_up_df = look_up_df.drop(columns=["lookup_key_source"], errors="ignore")
     joined_dataframe = metadata.join(look_up_df, on = "stripped_bio_context_id", how = "left")
     logger.debug("\njoined_dataframe:\n\n{}".format(joined_dataframe))
     isNull_df = joined_dataframe["DepMap_ID"].isnull()
@@ -92,3 +185,6 @@ def verify_match(metadata, sample_info):
 
 class FhtbioinfpydepmapIDVerifyEquivalenceOfCLMandBCID(Exception):
     pass
+
+class FhtbioinfpydepmapIDLookupKeyCollision(Exception):
+    pass
@@ -1,33 +1,50 @@
-import ast
 import logging
-import operator
-import re
-import shutil
 import fhtbioinfpy.setup_logger as setup_logger
+import fhtbioinfpy.stage_profiler as stage_profiler
 import argparse
 import sys
+import codecs
 
 import os
 import pandas as pd
 import numpy
-
-import plotly.express as pltexpr
 import fhtbioinfpy.prep_metadata.depmapID_lookup as dmid
+import fhtbioinfpy.prep_metadata.cell_line_resolver as cell_line_resolver
+
+try:
+    import openpyxl
+except ImportError:
+    # only needed to read xlsx metadata sheets
+    openpyxl = None
 
 logger = logging.getLogger(setup_logger.LOGGER_NAME)
 
+GROUP_NAME_INVALID_CHARS = "[^A-Za-z0-9.]"
+# metadata file extension -> field separator, or "xlsx" for Excel workbooks; other extensions are read as tab separated
+METADATA_FILE_FORMATS = {".txt": "\t", ".tsv": "\t", ".csv": ",", ".xlsx": "xlsx", ".xlsm": "xlsx"}
+# columns main uses besides the group definition columns, always loaded
+REQUIRED_METADATA_COLUMNS = ["sample_id", "bio_context_id", "pert_dose", "pert_dose_unit", "pert_time", "pert_time_unit"]
+
 
 def build_parser():
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument("--verbose", "-v", help="Whether to print a bunch of output.", action="store_true", default=False)
-    parser.add_argument("--output_metadata_subdir", help="subdirectory for metadata", type=str, default="./metadata/")
     # parser.add_argument("--input_metadata_file_path", help = "the entire metadata path inputted by user", type = str, required = True)
     parser.add_argument("--input_metadata_file", help = "the metadata file", type = str, required = True)
     parser.add_argument("--experiment_id", help = "specific id for experiment", required = True)
+    return add_common_arguments(parser)
+
+# the options of a metadata sheet besides its file and experiment id, shared with the prep_metadata_batch parser
+def add_common_arguments(parser):
+    parser.add_argument("--verbose", "-v", help="Whether to print a bunch of output.", action="store_true", default=False)
+    parser.add_argument("--output_metadata_subdir", help="subdirectory for metadata", type=str, default="./metadata/")
     parser.add_argument("--samples_to_remove_from_metadata", help = "which samples user desires to remove from metadata, if any.", default=[], nargs="+")
     parser.add_argument("--metadata_columns_to_build_groups", help="metadata columns selected to build groups.", required = True,  nargs="+")
-    parser.add_argument("--expected_number_replicates", help = "the expected number of replicates the user wants", default = 3)
+    parser.add_argument("--expected_number_replicates", help = "the expected number of replicates the user wants", type = int, default = 3)
     parser.add_argument("--sample_info_file", help = "sample info containing DepMap_ID and the cell line name", type = str, required = True)
+    parser.add_argument("--lookup_cache_dir", help="directory to cache the DepMap alias index built from sample_info_file in; repeat runs with the same sample info file skip parsing it", type=str, default=None)
+    parser.add_argument("--n_suggestions", help="number of candidate DepMap IDs written per unmatched bio_context_id to the suggestions file", type=int, default=cell_line_resolver.DEFAULT_N_SUGGESTIONS)
+    parser.add_argument("--metadata_columns_to_load", help="only load these columns of the input metadata (plus the group definition columns and the columns prep_metadata needs); default all", type=str, nargs="+", default=None)
+    parser.add_argument("--profile", help="record wall time, CPU time, RSS and dataframe shapes of each stage into a JSON report in output_metadata_subdir", action="store_true", default=False)
     return parser
 
 # def create_full_path(metadata_subdir, metadata_file):
@@ -36,8 +53,82 @@ def build_parser():
 #     return input_metadata_dir
 
 
-def load_metadata(input_file):
-    orig_metadata = pd.read_csv(open (input_file, "r"), encoding = "utf-8", sep='\t',  index_col = "sample_id")
+# field separator of a metadata file from its extension, or "xlsx"
+def detect_metadata_format(input_file):
+    return METADATA_FILE_FORMATS.get(os.path.splitext(input_file)[1].lower(), "\t")
+
+# encoding announced by a byte order mark (sheets saved as "Unicode text" / "CSV UTF-8" by Excel), otherwise utf-8
+def detect_text_encoding(input_file):
+    with open(input_file, "rb") as f:
+        head = f.read(4)
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return "utf-16"
+    if head.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    return "utf-8"
+
+# raises when columns to load are not in the header of the metadata file
+def check_metadata_columns(input_file, header, usecols):
+    missing_columns = [] if usecols is None else [c for c in usecols if c not in set(header)]
+    if len(missing_columns) > 0:
+        msg = """\n!!!\nSome columns to load are not in the metadata file.
+        input_file:  {}
+        missing columns:  {}
+        metadata columns:  {}\n""".format(input_file, missing_columns, list(header))
+        logger.exception(msg)
+        raise FhtbioinfpyPrepMetadataLoadMissingColumns(msg)
+
+# csv / tsv metadata, only the usecols columns kept (default all): the other columns are skipped by the parser rather
+# than dropped afterwards. A file that is not utf-8 (Excel's "Text (Tab delimited)" is latin-1) is parsed a second time
+# as latin-1
+def read_delimited_metadata(input_file, sep, usecols=None):
+    encoding = detect_text_encoding(input_file)
+    try:
+        return _read_delimited(input_file, sep, encoding, usecols)
+    except UnicodeDecodeError:
+        logger.debug("{} is not {}, reading it as latin-1".format(input_file, encoding))
+        return _read_delimited(input_file, sep, "latin-1", usecols)
+
+def _read_delimited(input_file, sep, encoding, usecols):
+    header = pd.read_csv(input_file, sep=sep, encoding=encoding, nrows=0).columns
+    check_metadata_columns(input_file, header, usecols)
+    return pd.read_csv(input_file, sep=sep, encoding=encoding, usecols=usecols, index_col="sample_id")
+
+# first worksheet of an xlsx workbook read with openpyxl's read-only reader, only the values of the usecols columns
+# (default all) kept from each row. Empty rows and trailing empty header cells are dropped
+def read_xlsx_metadata(input_file, usecols=None):
+    if openpyxl is None:
+        msg = "\n!!!\nReading xlsx metadata needs openpyxl (pip install openpyxl): {}\n".format(input_file)
+        logger.exception(msg)
+        raise FhtbioinfpyPrepMetadataXlsxNotSupported(msg)
+
+    workbook = openpyxl.load_workbook(input_file, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = list(next(rows, ()))
+        while len(header) > 0 and header[-1] is None:
+            header.pop()
+        check_metadata_columns(input_file, header, usecols)
+        positions = [i for i, col in enumerate(header) if usecols is None or col in usecols]
+        records = [[row[i] if i < len(row) else None for i in positions] for row in rows if any(v is not None for v in row)]
+    finally:
+        workbook.close()
+    metadata = pd.DataFrame.from_records(records, columns=[header[i] for i in positions]).infer_objects()
+    # empty columns as float nan, like read_csv gives them
+    empty_columns = metadata.columns[metadata.isna().all()]
+    metadata[empty_columns] = metadata[empty_columns].astype(float)
+    return metadata.set_index("sample_id")
+
+# metadata sheet as a dataframe indexed by sample_id, the format detected from the extension (see
+# METADATA_FILE_FORMATS); usecols: only load these columns (default all)
+def load_metadata(input_file, usecols=None):
+    if usecols is not None and "sample_id" not in usecols:
+        usecols = ["sample_id"] + list(usecols)
+    metadata_format = detect_metadata_format(input_file)
+    if metadata_format == "xlsx":
+        orig_metadata = read_xlsx_metadata(input_file, usecols=usecols)
+    else:
+        orig_metadata = read_delimited_metadata(input_file, metadata_format, usecols=usecols)
     logger.debug("orig_metadata.shape: {}".format(orig_metadata.shape))
     return orig_metadata
 
@@ -100,11 +191,11 @@ def verify_group_def_columns_in_metadata(metadata_df, metadata_columns_to_build_
     logger.debug('\nupdate2:\n{}'.format(new_series))
     return new_series
 '''
+# group name of each row: the group definition columns, cleaned of everything but letters, digits and dots, joined
+# with "_" by vectorized string concatenation. Returned as a categorical, a pooled sheet has few distinct groups
 def build_group_names(metadata_df, group_def_cols):
-    group_def_df = metadata_df[group_def_cols].copy() # subset the columns that will create the groups
-    for col in group_def_cols:
-        group_def_df[col] = group_def_df[col].astype(str).str.replace("[^A-Za-z0-9.]","")
-    group_names = group_def_df.fillna('').apply(lambda row: "_".join(row), axis = 1)
+    cleaned_cols = [metadata_df[col].astype(str).str.replace(GROUP_NAME_INVALID_CHARS, "", regex=True) for col in group_def_cols]
+    group_names = cleaned_cols[0].str.cat([col.to_numpy() for col in cleaned_cols[1:]], sep="_").astype("category")
     logger.debug('\ngroup_names:\n{}'.format(group_names))
     return group_names
 
@@ -116,20 +207,19 @@ def add_experiment_id(original_df, experiment_id):
     original_df['experiment_id'] = experiment_id
     return original_df
 
+# R_group: the group name prefixed with "x_" where it starts with a digit, so R accepts it as a name - nan for the other
+# rows. Built once per distinct group (categorical codes) rather than per row
 def create_R_Groups(original_df, col_name):
-    original_df["R_group"] = original_df[col_name]
-    logger.debug('df with R_group:\n {}'.format(original_df))
-    logger.debug('df[col_name]:\n {}'.format(original_df[col_name]))
-    locs = original_df[col_name].str[0].str.isdigit() # list of whether or not the first char of each item in the column name is a number 
+    group_s = original_df[col_name].astype("category")
+    categories = group_s.cat.categories.astype(str)
+    locs = numpy.asarray(categories.str[:1].str.isdigit(), dtype=bool) # whether each group name starts with a number
     logger.debug('locs:\n {}\n'.format(locs))
 
-    R_group_s = original_df[locs][col_name]
-    logger.debug('R_group_s: \n{}\n'.format(R_group_s))
-    R_group_s_withX = 'x_' + R_group_s
-    logger.debug('\nR_group_s_withX:\n {}\n'.format(R_group_s_withX))
-    original_df["R_group"] = R_group_s_withX
+    R_group_codes = numpy.full(len(categories), -1)
+    R_group_codes[locs] = numpy.arange(locs.sum())
+    codes = group_s.cat.codes.to_numpy()
+    original_df["R_group"] = pd.Categorical.from_codes(numpy.where(codes >= 0, R_group_codes[codes], -1), categories="x_" + categories[locs])
     logger.debug('\nR_group columns\n{}'.format(original_df["R_group"]))
-    logger.debug('\ndf:\n {}\n'.format(original_df))
 
     return original_df
 
@@ -146,42 +236,61 @@ def build_output_file_name(id, df_shape):
 
     return output_filename
 
-def main(args):
+# sample_info: an already loaded lookup table (see depmapID_lookup.load_alias_index), loaded from args.sample_info_file
+# when not given. Returns the path of the saved metadata
+def main(args, sample_info=None, ask_user_about_replicates=ask_user_about_replicates):
+    profiler = stage_profiler.StageProfiler("prep_metadata", enabled=args.profile)
 
     #convert files to data frame
-    inp_df = load_metadata(args.input_metadata_file)
+    with profiler.stage("load") as stage:
+        usecols = None
+        if args.metadata_columns_to_load is not None:
+            usecols = list(dict.fromkeys(REQUIRED_METADATA_COLUMNS + args.metadata_columns_to_build_groups + args.metadata_columns_to_load))
+        inp_df = load_metadata(args.input_metadata_file, usecols=usecols)
+        stage_profiler.add_shapes(stage, metadata=inp_df)
 
-    #removal of metadata rows not sequenced bc of QC issues
-    reduced_df = remove_samples(inp_df, args.samples_to_remove_from_metadata)
+    with profiler.stage("build_groups") as stage:
+        #removal of metadata rows not sequenced bc of QC issues
+        reduced_df = remove_samples(inp_df, args.samples_to_remove_from_metadata)
 
-    check_replicate_number_per_group(reduced_df, args.metadata_columns_to_build_groups, args.expected_number_replicates, ask_user_about_replicates=ask_user_about_replicates)
+        check_replicate_number_per_group(reduced_df, args.metadata_columns_to_build_groups, args.expected_number_replicates, ask_user_about_replicates=ask_user_about_replicates)
 
-    #add pert_dose_str and pert_str columns
-    metadata_df = add_string_concated_columns(reduced_df)
+        #add pert_dose_str and pert_str columns
+        metadata_df = add_string_concated_columns(reduced_df)
 
-    #check that "group definition columns" are present in the metadata
-    verify_group_def_columns_in_metadata(metadata_df, args.metadata_columns_to_build_groups)
+        #check that "group definition columns" are present in the metadata
+        verify_group_def_columns_in_metadata(metadata_df, args.metadata_columns_to_build_groups)
 
-    #remove dashes and other special characters from group definition columns
-    # cleaned_series = clean_group_names(args.metadata_columns_to_build_groups)
+        #remove dashes and other special characters from group definition columns
+        # cleaned_series = clean_group_names(args.metadata_columns_to_build_groups)
 
-    #concatenate "group definitions" columns to form group names
-    group_names = build_group_names(metadata_df,  args.metadata_columns_to_build_groups)
+        #concatenate "group definitions" columns to form group names
+        group_names = build_group_names(metadata_df,  args.metadata_columns_to_build_groups)
 
-    #add groups to metadata dataframe
-    metadata_df = add_groups_to_df(metadata_df, group_names)
+        #add groups to metadata dataframe
+        metadata_df = add_groups_to_df(metadata_df, group_names)
 
-    #add experiment id
-    metadata_df = add_experiment_id(metadata_df, args.experiment_id)
+        #add experiment id
+        metadata_df = add_experiment_id(metadata_df, args.experiment_id)
 
-    #create R_groups by modifying name of groups to start with an "x_" only if it start with a number
-    metadata_df = create_R_Groups(metadata_df, 'group')
+        #create R_groups by modifying name of groups to start with an "x_" only if it start with a number
+        metadata_df = create_R_Groups(metadata_df, 'group')
+        stage_profiler.add_shapes(stage, metadata=metadata_df)
 
    
-    metadata_df = dmid.add_cleaned_cl_name(metadata_df, "bio_context_id")
-    sample_info = dmid.shorten_sample_info(args.sample_info_file)
-    sample_info = dmid.add_cleaned_cl_name(sample_info, "stripped_cell_line_name")
-    df_wtih_dmID = dmid.verify_match(metadata_df, sample_info)
+    with profiler.stage("lookup") as stage:
+        metadata_df = dmid.add_cleaned_cl_name(metadata_df, "bio_context_id")
+        if sample_info is None:
+            sample_info = dmid.load_alias_index(args.sample_info_file, cache_dir=args.lookup_cache_dir)
+        try:
+            df_wtih_dmID = dmid.verify_match(metadata_df, sample_info)
+        except dmid.FhtbioinfpydepmapIDVerifyEquivalenceOfCLMandBCID:
+            # ranked candidates for the unmatched values, for whoever fixes the metadata
+            suggestions_df = cell_line_resolver.suggest_depmap_ids(metadata_df, sample_info, n_suggestions=args.n_suggestions)
+            suggestions_filepath = cell_line_resolver.save_suggestions_df(suggestions_df, args.experiment_id, args.output_metadata_subdir)
+            logger.info("candidate DepMap IDs for the unmatched bio_context_id values: {}".format(suggestions_filepath))
+            raise
+        stage_profiler.add_shapes(stage, sample_info=sample_info, df_with_dmID=df_wtih_dmID)
     
 
     # # metadata: build output file path
@@ -202,13 +311,16 @@ def main(args):
 
 
     #df_wtih_dmID: build output file path
-    df_with_dmID_output_filename = build_output_file_name(args.experiment_id, df_wtih_dmID.shape)
-    df_with_dmID_output_filepath = os.path.join(args.output_metadata_subdir, df_with_dmID_output_filename)
-    #save as csv/txt file
-    metadata_df.to_csv(df_with_dmID_output_filepath, sep="\t") 
+    with profiler.stage("save"):
+        df_with_dmID_output_filename = build_output_file_name(args.experiment_id, df_wtih_dmID.shape)
+        df_with_dmID_output_filepath = os.path.join(args.output_metadata_subdir, df_with_dmID_output_filename)
+        #save as csv/txt file
+        metadata_df.to_csv(df_with_dmID_output_filepath, sep="\t") 
+    profiler.save_report(args.experiment_id, args.output_metadata_subdir)
 
     logger.debug("metadata_df.shape: {}".format(metadata_df.shape))
-    logger.debug("metadata_df.iloc[3,2]: {}".format(metadata_df.iloc[3,2]))
+    logger.debug("metadata_df.head():\n{}".format(metadata_df.head()))
+    return df_with_dmID_output_filepath
 
 
 
@@ -221,6 +333,12 @@ class FhtbioinfpyPrepMetadataVerifyColumnsForGroups(Exception):
 class FhtbioinfpyPrepMetadataCheckValueReplicatesForGroups(Exception):
     pass
 
+class FhtbioinfpyPrepMetadataLoadMissingColumns(Exception):
+    pass
+
+class FhtbioinfpyPrepMetadataXlsxNotSupported(Exception):
+    pass
+
 if __name__ == "__main__":
     args = build_parser().parse_args(sys.argv[1:]) #list of command line that isnt python
     setup_logger.setup(verbose=args.verbose)
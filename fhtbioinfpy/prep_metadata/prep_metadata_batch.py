@@ -0,0 +1,180 @@
+"""
+batch mode of prep_metadata: prepares every metadata sheet of a directory (or matching a glob pattern) in a pool of
+--workers processes. The DepMap lookup table is loaded once and handed to every worker, each sheet is named by its file
+name (without extension) as experiment id and writes its usual {experiment_id}_metadata_r{n}x{m}.txt output. A sheet
+that fails is recorded in the summary and the others carry on; --experiment_id names the summary with one row per
+sheet. Sheets are never asked about unexpected replicate counts, --unexpected_replicates decides for all of them.
+"""
+import logging
+import fhtbioinfpy.setup_logger as setup_logger
+import sys
+import argparse
+import copy
+import glob
+import concurrent.futures
+
+import os
+import pandas as pd
+import fhtbioinfpy.prep_metadata.prep_metadata as prep_metadata
+import fhtbioinfpy.prep_metadata.depmapID_lookup as dmid
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+METADATA_FILE_EXTENSIONS = sorted(prep_metadata.METADATA_FILE_FORMATS)
+SUMMARY_COLUMNS = ["experiment_id", "input_metadata_file", "status", "error", "metadata_filepath"]
+
+# lookup table and replicate handling of a batch worker process, set by _init_batch_worker
+_worker_sample_info = None
+_worker_break_on_unexpected_replicates = None
+
+
+# the prep_metadata options, with the metadata file and experiment id of each sheet coming from --input_metadata
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--input_metadata", help="directory of metadata sheets ({} files) or a glob pattern of sheets".format(", ".join(METADATA_FILE_EXTENSIONS)), type=str, required = True)
+    parser.add_argument("--experiment_id", help="id of the batch, names the summary", required = True)
+    prep_metadata.add_common_arguments(parser)
+    parser.add_argument("--workers", help="number of processes preparing sheets at the same time", type=int, default=os.cpu_count())
+    parser.add_argument("--unexpected_replicates", help="what to do with a sheet having groups with an unexpected number of replicates: ignore them, or break (the sheet fails)", choices=["ignore", "break"], default="break")
+    return parser
+
+
+# the sheets of a directory, or the files matching a glob pattern, sorted
+def list_metadata_files(input_metadata):
+    if os.path.isdir(input_metadata):
+        # "~$" files are the lock files of workbooks open in Excel
+        metadata_files = [os.path.join(input_metadata, f) for f in os.listdir(input_metadata)
+            if os.path.splitext(f)[1].lower() in METADATA_FILE_EXTENSIONS and not f.startswith("~$")]
+    else:
+        metadata_files = glob.glob(input_metadata)
+    metadata_files = sorted(f for f in metadata_files if os.path.isfile(f))
+    logger.debug("metadata_files: {}".format(metadata_files))
+    return metadata_files
+
+
+# experiment id of every sheet: its file name without extension. Two sheets with the same id would overwrite each
+# other's output, so the batch refuses to start
+def build_experiment_ids(metadata_files):
+    experiment_ids = pd.Series([os.path.splitext(os.path.basename(f))[0] for f in metadata_files], index=metadata_files)
+    duplicated = experiment_ids[experiment_ids.duplicated(keep=False)]
+    if not duplicated.empty:
+        msg = """\n!!!\nSome metadata sheets of the batch have the same experiment id (file name without extension).\n{}\n""".format(duplicated)
+        logger.exception(msg)
+        raise FhtbioinfpyPrepMetadataBatchDuplicateExperimentIds(msg)
+    return experiment_ids
+
+
+def _init_batch_worker(sample_info, unexpected_replicates, verbose):
+    global _worker_sample_info, _worker_break_on_unexpected_replicates
+    setup_logger.setup(verbose=verbose)
+    _worker_sample_info = sample_info
+    _worker_break_on_unexpected_replicates = unexpected_replicates == "break"
+
+
+def _ask_worker_about_replicates():
+    return _worker_break_on_unexpected_replicates
+
+
+# first line of an exception's message that says something, for the summary
+def summarize_error(e):
+    lines = [line.strip() for line in str(e).splitlines() if line.strip().strip("!")]
+    return "{}: {}".format(type(e).__name__, lines[0] if lines else "")
+
+
+# prepares one sheet in a worker, returns its summary row; a failing sheet is logged and returned as an error row
+def run_sheet(sheet_args):
+    try:
+        metadata_filepath = prep_metadata.main(sheet_args, sample_info=_worker_sample_info,
+            ask_user_about_replicates=_ask_worker_about_replicates)
+        status, error = "ok", None
+    except Exception as e:
+        logger.exception("batch sheet {} failed: {}".format(sheet_args.input_metadata_file, e))
+        metadata_filepath, status, error = None, "error", summarize_error(e)
+    return {"experiment_id": sheet_args.experiment_id, "input_metadata_file": sheet_args.input_metadata_file,
+        "status": status, "error": error, "metadata_filepath": metadata_filepath}
+
+
+# prepares every sheet, in a pool of workers processes sharing the lookup table. workers=1 prepares them in turn in
+# this process
+def run_batch(metadata_files, sample_info, args):
+    experiment_ids = build_experiment_ids(metadata_files)
+    sheet_args_list = []
+    for metadata_file, experiment_id in experiment_ids.items():
+        sheet_args = copy.copy(args)
+        sheet_args.input_metadata_file = metadata_file
+        sheet_args.experiment_id = experiment_id
+        sheet_args_list.append(sheet_args)
+
+    initargs = (sample_info, args.unexpected_replicates, args.verbose)
+    if args.workers > 1 and len(sheet_args_list) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(args.workers, len(sheet_args_list)),
+                initializer=_init_batch_worker, initargs=initargs) as executor:
+            summary_rows = list(executor.map(run_sheet, sheet_args_list))
+    else:
+        _init_batch_worker(*initargs)
+        summary_rows = [run_sheet(sheet_args) for sheet_args in sheet_args_list]
+
+    summary_df = pd.DataFrame(summary_rows, columns=SUMMARY_COLUMNS).set_index("experiment_id")
+    logger.debug("\nsummary_df\n{}".format(summary_df))
+    return summary_df
+
+
+# saves the summary as a csv/txt file
+def save_summary_df(summary_df, batch_id, subdir):
+    output_filename = "{batch_id}_prep_metadata_batch_summary_r{nrows}x{ncols}.txt".format(
+        batch_id=batch_id, nrows=summary_df.shape[0], ncols=summary_df.shape[1]
+    )
+    output_filepath = os.path.join(subdir, output_filename)
+    logger.debug("output_filepath : {}".format(output_filepath))
+    summary_df.to_csv(output_filepath, sep="\t")
+    return output_filepath
+
+
+# raises when any sheet of the batch failed
+def check_batch_for_warnings(summary_df):
+    failed_df = summary_df[summary_df["status"] != "ok"]
+    if not failed_df.empty:
+        msg = """\n!!!\n The following metadata sheets failed. \n{}\n""".format(failed_df)
+        with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.max_colwidth', None):
+            logger.exception(msg)
+            print(failed_df[["input_metadata_file", "error"]])
+            raise FhtbioinfpyPrepMetadataBatchSheetsFailed(msg)
+
+
+def main(args):
+    metadata_files = list_metadata_files(args.input_metadata)
+    if len(metadata_files) == 0:
+        msg = "\n!!!\nNo metadata sheets found: {}\n".format(args.input_metadata)
+        logger.exception(msg)
+        raise FhtbioinfpyPrepMetadataBatchNoSheets(msg)
+    logger.info("prep_metadata batch: {} sheets, {} workers".format(len(metadata_files), args.workers))
+
+    sample_info = dmid.load_alias_index(args.sample_info_file, cache_dir=args.lookup_cache_dir)
+    if not os.path.isdir(args.output_metadata_subdir):
+        os.makedirs(args.output_metadata_subdir)
+
+    summary_df = run_batch(metadata_files, sample_info, args)
+    summary_filepath = save_summary_df(summary_df, args.experiment_id, args.output_metadata_subdir)
+    logger.info("prep_metadata batch summary: {}".format(summary_filepath))
+
+    check_batch_for_warnings(summary_df)
+
+
+class FhtbioinfpyPrepMetadataBatchNoSheets(Exception):
+    pass
+
+
+class FhtbioinfpyPrepMetadataBatchDuplicateExperimentIds(Exception):
+    pass
+
+
+class FhtbioinfpyPrepMetadataBatchSheetsFailed(Exception):
+    pass
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args(sys.argv[1:])
+    setup_logger.setup(verbose=args.verbose)
+    logger.debug("args:  {}".format(args))
+
+    main(args)
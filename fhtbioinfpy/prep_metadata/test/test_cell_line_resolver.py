@@ -0,0 +1,76 @@
+import unittest
+import logging
+import fhtbioinfpy.setup_logger as setup_logger
+import fhtbioinfpy.prep_metadata.cell_line_resolver as clr
+import fhtbioinfpy.prep_metadata.depmapID_lookup as dmid
+import pandas as pd
+import os
+import tempfile
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+class TestCellLineResolver(unittest.TestCase):
+
+    def setUp(self):
+        logger.debug("Setup")
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.sample_info_file = os.path.join(self.tmpdir.name, "sample_info.csv")
+        pd.DataFrame({"DepMap_ID": ["ACH-000001", "ACH-000002", "ACH-000003", "ACH-000004"],
+            "stripped_cell_line_name": ["KYSE70", "KYSE70R", "NCIH460", "HSC2"]}).to_csv(self.sample_info_file, index=False)
+        self.look_up_df = dmid.build_alias_index(self.sample_info_file)
+
+    def tearDown(self):
+        logger.debug("Teardown")
+        self.tmpdir.cleanup()
+
+    def test_name_ngrams(self):
+        self.assertEqual(clr.name_ngrams("ABC"), {"^AB", "ABC", "BC$"})
+        # names shorter than the n-grams still give one gram
+        self.assertEqual(clr.name_ngrams("", ngram_size=3), {"^$"})
+
+    def test_resolve(self):
+        index = clr.build_resolver_index(self.look_up_df)
+        self.assertEqual(len(index.names), 4)
+
+        candidates_df = clr.resolve(index, "KYSE70SHCTRL", n_suggestions=2)
+        logger.debug("\ncandidates_df\n{}".format(candidates_df))
+        self.assertEqual(list(candidates_df["rank"]), [1, 2])
+        self.assertEqual(list(candidates_df["DepMap_ID"]), ["ACH-000001", "ACH-000002"])
+        self.assertTrue(candidates_df["score"].is_monotonic_decreasing)
+
+        # the keys of NCI prefixed lines are cleaned without NCI, like stripped_bio_context_id
+        candidates_df = clr.resolve(index, "H460X")
+        self.assertEqual(candidates_df["stripped_cell_line_name"].iloc[0], "NCIH460")
+
+        self.assertTrue(clr.resolve(index, "ZZZZ").empty)
+
+    def test_resolve_alias_index(self):
+        pd.DataFrame({"DepMap_ID": ["ACH-000001", "ACH-000002"], "stripped_cell_line_name": ["KYSE70", "HSC2"],
+            "CCLE_Name": ["KYSE70_OESOPHAGUS", "HSC2_UPPER_AERODIGESTIVE_TRACT"]}).to_csv(self.sample_info_file, index=False)
+        index = clr.build_resolver_index(dmid.build_alias_index(self.sample_info_file))
+        self.assertEqual(len(index.names), 4)
+
+        # each line is suggested once, with the name of the line rather than the matching key
+        candidates_df = clr.resolve(index, "KYSE70OES")
+        logger.debug("\ncandidates_df\n{}".format(candidates_df))
+        self.assertEqual(list(candidates_df["DepMap_ID"]), ["ACH-000001"])
+        self.assertEqual(list(candidates_df["stripped_cell_line_name"]), ["KYSE70"])
+
+    def test_suggest_depmap_ids(self):
+        metadata = dmid.add_cleaned_cl_name(pd.DataFrame({"bio_context_id": ["KYSE70", "KYSE70_sh_ctrl", "KYSE70_sh_ctrl", "NCI-H460_x"]}), "bio_context_id")
+        suggestions_df = clr.suggest_depmap_ids(metadata, self.look_up_df, n_suggestions=1)
+        logger.debug("\nsuggestions_df\n{}".format(suggestions_df))
+        self.assertEqual(list(suggestions_df.columns), clr.SUGGESTION_COLUMNS)
+        # exact matches are left out and each unmatched value is resolved once
+        self.assertEqual(list(suggestions_df["bio_context_id"]), ["KYSE70_sh_ctrl", "NCI-H460_x"])
+        self.assertEqual(list(suggestions_df["DepMap_ID"]), ["ACH-000001", "ACH-000003"])
+
+        output_filepath = clr.save_suggestions_df(suggestions_df, "test_exp", self.tmpdir.name)
+        self.assertEqual(os.path.basename(output_filepath), "test_exp_depmap_suggestions_r2x6.txt")
+        self.assertEqual(pd.read_csv(output_filepath, sep="\t").shape, (2, 6))
+
+
+if __name__ == "__main__":
+    setup_logger.setup(verbose=True)
+
+    unittest.main()
@@ -63,6 +63,25 @@ class TestPrepMetadata(unittest.TestCase):
         logger.debug("orig_metadata.shape: {}".format(orig_metadata.shape))
         # self.assertEqual(orig_metadata.shape, self.df.shape)
 
+    def test_load_metadata_formats(self):
+        # the xlsx source sheet streams to the same dataframe as its tab separated export
+        xlsx_metadata = pm.load_metadata(os.path.join(self.metadata_subdir, "2021-11-09-next-gen-sequencing-annotations-ATACseq-KA.xlsx"))
+        pd.testing.assert_frame_equal(xlsx_metadata, pm.load_metadata(self.input_metadata_file))
+
+        # a latin-1 tab separated export and a utf-8 csv with a byte order mark
+        kyse_filepath = os.path.join(self.metadata_subdir, "2022-04-13-NS-22.0019-metadata-OP-KYSE70-shRNA-TP63-knockdowns")
+        txt_metadata = pm.load_metadata(kyse_filepath + ".txt")
+        csv_metadata = pm.load_metadata(kyse_filepath + ".csv")
+        self.assertEqual(csv_metadata.shape, (18, 27))
+        pd.testing.assert_frame_equal(csv_metadata, txt_metadata)
+
+        for filepath in [self.input_metadata_file, os.path.join(self.metadata_subdir, "2021-11-09-next-gen-sequencing-annotations-ATACseq-KA.xlsx")]:
+            selected_metadata = pm.load_metadata(filepath, usecols=["pert_id", "bio_context_id"])
+            self.assertEqual(list(selected_metadata.columns), ["bio_context_id", "pert_id"])
+            self.assertEqual(selected_metadata.index.name, "sample_id")
+            with self.assertRaises(pm.FhtbioinfpyPrepMetadataLoadMissingColumns):
+                pm.load_metadata(filepath, usecols=["not_a_column"])
+
     def test_remove_samples(self):
         logger.debug("test_remove_samples")
         #edge case 1 --> remove 1 row
@@ -181,6 +200,15 @@ class TestPrepMetadata(unittest.TestCase):
         expected_group_names = ["hello_happy", "apple_sad", "basketball_laugh"]
         logger.debug('\nexpected_groups_df:\n{}'.format(expected_group_names))
         self.assertEqual(list(new_groups_df), expected_group_names)
+
+        #edge case 3 --> special characters are removed, numbers and nan become strings, the result is categorical
+        test_df = pd.DataFrame({"a":["1 uM", "DMSO", "1 uM", None], "b":[2.5, 2.5, float("nan"), 3.0], "c":["ACH-1", "A/B", "ACH-1", "C"]},
+            index = ["s3", "s1", "s2", "s4"])
+        new_groups_df = pm.build_group_names(test_df, ["a", "b", "c"])
+        logger.debug('\nnew_groups_df:\n{}'.format(new_groups_df))
+        self.assertEqual(new_groups_df.dtype.name, "category")
+        self.assertEqual(list(new_groups_df.index), ["s3", "s1", "s2", "s4"])
+        self.assertEqual(list(new_groups_df), ["1uM_2.5_ACH1", "DMSO_2.5_AB", "1uM_nan_ACH1", "None_3.0_C"])
     
     def test_add_groups_to_df(self):
         logger.debug("test_add_groups_to_df")
@@ -245,6 +273,13 @@ class TestPrepMetadata(unittest.TestCase):
             
         #else--> check1 is a nonnumber string and isn't equal to "x_" so continues running through rows
         self.assertTrue(allWork)
+
+        # edge case 4 --> categorical groups: only the groups starting with a number get an R_group, the others are nan
+        test_df = pd.DataFrame({"group": pd.Categorical(["1A", "CC", "1A", "3D", "CC"])})
+        new_df = pm.create_R_Groups(test_df, "group")
+        logger.debug('\nnew_df:\n{}'.format(new_df))
+        self.assertEqual(new_df["R_group"].dtype.name, "category")
+        self.assertEqual(list(new_df["R_group"].astype(object).fillna("nan")), ["x_1A", "nan", "x_1A", "x_3D", "nan"])
     
     def test_build_output_file_name(self):
         experiment_id = "id"
@@ -0,0 +1,91 @@
+import unittest
+import logging
+import fhtbioinfpy.setup_logger as setup_logger
+import fhtbioinfpy.prep_metadata.prep_metadata_batch as pmb
+import fhtbioinfpy.prep_metadata.depmapID_lookup as dmid
+import pandas as pd
+import os
+import tempfile
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+class TestPrepMetadataBatch(unittest.TestCase):
+
+    def setUp(self):
+        logger.debug("Setup")
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.sample_info_file = os.path.join(self.tmpdir.name, "sample_info.csv")
+        pd.DataFrame({"DepMap_ID": ["ACH-000001", "ACH-000002"], "stripped_cell_line_name": ["KYSE70", "HSC2"]}).to_csv(self.sample_info_file, index=False)
+        self.input_dir = os.path.join(self.tmpdir.name, "sheets")
+        self.output_dir = os.path.join(self.tmpdir.name, "metadata")
+        os.makedirs(self.input_dir)
+
+        # three replicates per group, the bio_context_ids of the bad sheet are not in sample_info
+        self.write_sheet("week1_a.txt", ["KYSE-70"] * 3 + ["HSC-2"] * 3)
+        self.write_sheet("week1_b.txt", ["KYSE-70"] * 2 + ["HSC-2"] * 3)
+        self.write_sheet("week1_bad.txt", ["XYZ-1"] * 3)
+        with open(os.path.join(self.input_dir, "notes.md"), "w") as f:
+            f.write("not a sheet")
+
+    def tearDown(self):
+        logger.debug("Teardown")
+        self.tmpdir.cleanup()
+
+    def write_sheet(self, filename, bio_context_ids):
+        n = len(bio_context_ids)
+        pd.DataFrame({"sample_id": ["{}_{}".format(filename, i) for i in range(n)], "pert_id": ["DMSO"] * n,
+            "pert_dose": [1] * n, "pert_dose_unit": ["uM"] * n, "pert_time": [24] * n, "pert_time_unit": ["h"] * n,
+            "bio_context_id": bio_context_ids}).to_csv(os.path.join(self.input_dir, filename), sep="\t", index=False)
+
+    def build_args(self, *extra_args):
+        return pmb.build_parser().parse_args(["--input_metadata", self.input_dir, "--experiment_id", "batch1",
+            "--metadata_columns_to_build_groups", "pert_id", "bio_context_id", "--expected_number_replicates", "3",
+            "--sample_info_file", self.sample_info_file, "--output_metadata_subdir", self.output_dir] + list(extra_args))
+
+    def test_list_metadata_files(self):
+        metadata_files = pmb.list_metadata_files(self.input_dir)
+        self.assertEqual([os.path.basename(f) for f in metadata_files], ["week1_a.txt", "week1_b.txt", "week1_bad.txt"])
+
+        metadata_files = pmb.list_metadata_files(os.path.join(self.input_dir, "week1_[ab].txt"))
+        self.assertEqual([os.path.basename(f) for f in metadata_files], ["week1_a.txt", "week1_b.txt"])
+
+        with self.assertRaises(pmb.FhtbioinfpyPrepMetadataBatchDuplicateExperimentIds):
+            pmb.build_experiment_ids(["a/week1.txt", "b/week1.tsv"])
+
+    def test_run_batch(self):
+        os.makedirs(self.output_dir)
+        sample_info = dmid.load_alias_index(self.sample_info_file)
+        metadata_files = pmb.list_metadata_files(self.input_dir)
+
+        summary_df = pmb.run_batch(metadata_files, sample_info, self.build_args("--workers", "2"))
+        logger.debug("\nsummary_df\n{}".format(summary_df))
+        self.assertEqual(list(summary_df.index), ["week1_a", "week1_b", "week1_bad"])
+        self.assertEqual(list(summary_df["status"]), ["ok", "error", "error"])
+        self.assertTrue(summary_df.loc["week1_b", "error"].startswith("FhtbioinfpyPrepMetadataCheckValueReplicatesForGroups"))
+        self.assertTrue(summary_df.loc["week1_bad", "error"].startswith("FhtbioinfpydepmapIDVerifyEquivalenceOfCLMandBCID"))
+        self.assertEqual(os.path.basename(summary_df.loc["week1_a", "metadata_filepath"]), "week1_a_metadata_r6x14.txt")
+        self.assertTrue(os.path.isfile(summary_df.loc["week1_a", "metadata_filepath"]))
+
+        # unexpected replicate counts can be ignored for the whole batch, one worker runs in this process
+        summary_df = pmb.run_batch(metadata_files, sample_info, self.build_args("--workers", "1", "--unexpected_replicates", "ignore"))
+        self.assertEqual(list(summary_df["status"]), ["ok", "ok", "error"])
+
+    def test_main(self):
+        with self.assertRaises(pmb.FhtbioinfpyPrepMetadataBatchSheetsFailed):
+            pmb.main(self.build_args("--workers", "2"))
+        output_files = sorted(os.listdir(self.output_dir))
+        logger.debug("output_files: {}".format(output_files))
+        self.assertIn("batch1_prep_metadata_batch_summary_r3x4.txt", output_files)
+        self.assertIn("week1_a_metadata_r6x14.txt", output_files)
+        self.assertIn("week1_bad_depmap_suggestions_r0x6.txt", output_files)
+
+        args = self.build_args()
+        args.input_metadata = os.path.join(self.input_dir, "*.csv")
+        with self.assertRaises(pmb.FhtbioinfpyPrepMetadataBatchNoSheets):
+            pmb.main(args)
+
+
+if __name__ == "__main__":
+    setup_logger.setup(verbose=True)
+
+    unittest.main()
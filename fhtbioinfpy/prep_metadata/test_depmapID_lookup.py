@@ -54,6 +54,88 @@ class TestPrepMetadata(unittest.TestCase):
         self.assertTrue(isEqual.all)
 
 
+    def test_load_alias_index(self):
+        expected_alias_index = dmid.build_alias_index(self.sample_info_file)
+
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            cache_dir = os.path.join(tmpdirname, "lookup_cache")
+            alias_index = dmid.load_alias_index(self.sample_info_file, cache_dir=cache_dir)
+            pd.testing.assert_frame_equal(alias_index, expected_alias_index)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+            # the repeat run reads the cached table, without parsing the csv
+            cached_filepath = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+            cached_mtime = os.path.getmtime(cached_filepath)
+            pd.testing.assert_frame_equal(dmid.load_alias_index(self.sample_info_file, cache_dir=cache_dir), expected_alias_index)
+            self.assertEqual(os.path.getmtime(cached_filepath), cached_mtime)
+
+            # a new sample info file gets its own entry
+            new_sample_info_file = os.path.join(tmpdirname, "sample_info.csv")
+            pd.read_csv(self.shortened_sample_info_file).to_csv(new_sample_info_file, index=False)
+            new_alias_index = dmid.load_alias_index(new_sample_info_file, cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+            self.assertEqual(list(new_alias_index["DepMap_ID"].unique()), ["ACH-000001", "ACH-000002", "ACH-000003", "ACH-000004", "ACH-000005"])
+
+        # verify_match takes the lookup table as is
+        metadata = pd.DataFrame({"stripped_bio_context_id":["HL60", "CACO2"]})
+        result = dmid.verify_match(metadata, alias_index)
+        self.assertEqual(list(result["DepMap_ID"]), ["ACH-000002", "ACH-000003"])
+
+    def test_alias_index_nci_names(self):
+        # stripped_bio_context_id drops "NCI"; the raw stripped_cell_line_name keeps it, so NCI-H460 never matched
+        # NCIH460 through sample_info itself, while its cleaned alias key H460 does
+        sample_info = pd.DataFrame({"DepMap_ID":["ACH-1", "ACH-2"], "stripped_cell_line_name":["NCIH460", "HL60"]})
+        metadata = dmid.add_cleaned_cl_name(pd.DataFrame({"bio_context_id":["NCI-H460", "HL-60"]}), "bio_context_id")
+        with self.assertRaises(dmid.FhtbioinfpydepmapIDVerifyEquivalenceOfCLMandBCID):
+            dmid.verify_match(metadata, sample_info)
+
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            sample_info_file = os.path.join(tmpdirname, "sample_info.csv")
+            sample_info.to_csv(sample_info_file, index=False)
+            alias_index = dmid.build_alias_index(sample_info_file)
+        result = dmid.verify_match(metadata, alias_index)
+        self.assertEqual(list(result["DepMap_ID"]), ["ACH-1", "ACH-2"])
+        self.assertEqual(list(result["stripped_cell_line_name"]), ["NCIH460", "HL60"])
+        # the metadata only gains the DepMap ID and its cell line name, not where the matching key came from
+        self.assertEqual(list(result.columns), list(metadata.columns) + ["DepMap_ID", "stripped_cell_line_name"])
+
+    def test_build_alias_index(self):
+        sample_info = pd.DataFrame({"DepMap_ID":["ACH-1", "ACH-2", "ACH-3", "ACH-4"],
+                                    "cell_line_name":["NCI-H460", "HL-60", "Caco-2", "LC-1F"],
+                                    "stripped_cell_line_name":["NCIH460", "HL60", "CACO2", "LC1F"],
+                                    "alias":[None, "HL 60, H460", None, "LC-1/sq-SF"],
+                                    "RRID":["CVCL_0459", "CVCL_0002", "CVCL_0025", "CVCL_0025"],
+                                    "COSMICID":[905942.0, None, 910852.0, None]})
+        alias_keys_df = dmid.build_alias_keys(sample_info)
+        collisions_df = dmid.find_alias_collisions(alias_keys_df)
+        logger.debug("\ncollisions_df:\n{}".format(collisions_df))
+        self.assertEqual(sorted(collisions_df["lookup_key"].unique()), ["CVCL0025", "H460"])
+
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            sample_info_file = os.path.join(tmpdirname, "sample_info.csv")
+            sample_info.to_csv(sample_info_file, index=False)
+            alias_index = dmid.build_alias_index(sample_info_file)
+            logger.debug("\nalias_index:\n{}".format(alias_index))
+            self.assertEqual(list(alias_index.columns), dmid.ALIAS_INDEX_COLUMNS)
+            self.assertTrue(alias_index.index.is_unique)
+            # the stripped name claim wins over the alias, a key claimed twice by the same column is left out
+            self.assertEqual(alias_index.loc["H460", "DepMap_ID"], "ACH-1")
+            self.assertNotIn("CVCL0025", alias_index.index)
+            self.assertEqual(alias_index.loc["910852", "DepMap_ID"], "ACH-3")
+            self.assertEqual(alias_index.loc["LC1SQSF", "lookup_key_source"], "alias")
+
+            cache_dir = os.path.join(tmpdirname, "lookup_cache")
+            pd.testing.assert_frame_equal(dmid.load_alias_index(sample_info_file, cache_dir=cache_dir), alias_index)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+        metadata = dmid.add_cleaned_cl_name(pd.DataFrame({"bio_context_id":["NCI-H460", "HL 60", "CVCL_0002", "LC-1/sq-SF"]}), "bio_context_id")
+        result = dmid.verify_match(metadata, alias_index)
+        self.assertEqual(list(result["DepMap_ID"]), ["ACH-1", "ACH-2", "ACH-2", "ACH-4"])
+
+        # a lookup table with duplicate keys is refused instead of duplicating metadata rows
+        with self.assertRaises(dmid.FhtbioinfpydepmapIDLookupKeyCollision):
+            dmid.verify_match(metadata, alias_keys_df.set_index("lookup_key"))
+
     def test_verify_match(self):
         #edge case 1: all stripped_bio_context_id values and stripped_cell_line_name values match and corresponding depmapIDs are found
         metadata = pd.DataFrame({"a":["1234", "5678", "2468", "3579"], 
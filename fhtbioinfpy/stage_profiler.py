@@ -0,0 +1,108 @@
+"""
+per-stage instrumentation for the command line tools: wall time, CPU time, memory and the shapes of the arrays each
+stage produced, written as a JSON report next to the outputs when a tool is run with --profile. A disabled profiler
+only runs the stages, so main functions instrument unconditionally.
+
+Memory of a stage is the resident set size (RSS) at its end and its change over the stage (rss_mb, rss_delta_mb; linux
+only), and the peak RSS of the process so far (process_peak_rss_mb). The process peak never goes down, so it only
+belongs to a stage when it grew during that stage.
+"""
+import logging
+import fhtbioinfpy.setup_logger as setup_logger
+import contextlib
+import datetime
+import json
+import platform
+import sys
+import time
+
+import os
+import numpy
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    # not available on windows: the process peak RSS is reported as None
+    resource = None
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+
+# peak resident set size of the process so far (MB); ru_maxrss is in kilobytes on linux and bytes on macOS
+def process_peak_rss_mb():
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 1024**2 if sys.platform == "darwin" else max_rss / 1024
+
+
+# current resident set size of the process (MB), from /proc/self/statm; None where there is no /proc
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm", "r") as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / 1024**2
+
+
+# records the shape of each named array / dataframe into a stage record
+def add_shapes(stage_record, **objects):
+    for name, obj in objects.items():
+        stage_record["shapes"][name] = list(obj.shape)
+
+
+class StageProfiler(object):
+
+    def __init__(self, tool, enabled=False):
+        self.tool = tool
+        self.enabled = enabled
+        self.stages = []
+        self.started = datetime.datetime.now().isoformat()
+
+    # times the body of the with block; the yielded record takes the shapes of what the stage produced (see add_shapes)
+    @contextlib.contextmanager
+    def stage(self, name):
+        stage_record = {"stage": name, "shapes": {}}
+        if not self.enabled:
+            yield stage_record
+            return
+
+        rss_start = current_rss_mb()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield stage_record
+        finally:
+            stage_record["wall_s"] = time.perf_counter() - wall_start
+            stage_record["cpu_s"] = time.process_time() - cpu_start
+            stage_record["rss_mb"] = current_rss_mb()
+            stage_record["rss_delta_mb"] = None if rss_start is None or stage_record["rss_mb"] is None else stage_record["rss_mb"] - rss_start
+            stage_record["process_peak_rss_mb"] = process_peak_rss_mb()
+            self.stages.append(stage_record)
+            logger.info("stage {stage}: wall {wall_s:.3f}s  cpu {cpu_s:.3f}s  rss {rss_mb} MB (change {rss_delta_mb} MB)  process peak rss so far {process_peak_rss_mb} MB  shapes {shapes}".format(**stage_record))
+
+    def report(self):
+        return {
+            "tool": self.tool,
+            "started": self.started,
+            "argv": sys.argv,
+            "python": platform.python_version(),
+            "numpy": numpy.__version__,
+            "pandas": pd.__version__,
+            "total_wall_s": sum(s["wall_s"] for s in self.stages),
+            "total_cpu_s": sum(s["cpu_s"] for s in self.stages),
+            "process_peak_rss_mb": process_peak_rss_mb(),
+            "stages": self.stages,
+        }
+
+    # writes the report as {experiment_id}_{tool}_profile.json into subdir, returns its path (None when disabled)
+    def save_report(self, exp_id, subdir):
+        if not self.enabled:
+            return None
+        output_filepath = os.path.join(subdir, "{experiment_id}_{tool}_profile.json".format(experiment_id=exp_id, tool=self.tool))
+        with open(output_filepath, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        logger.info("profile report: {}".format(output_filepath))
+        return output_filepath
@@ -0,0 +1,86 @@
+"""
+startup-time benchmark of the fhtbioinfpy command line: runs "python -m fhtbioinfpy --help" and
+"python -m fhtbioinfpy <subcommand> --help" in fresh interpreters and reports the median wall time of each over
+--repeats runs, optionally with the slowest imports of each subcommand (python -X importtime). Results can be written
+as JSON to compare runs on a shared filesystem.
+"""
+import logging
+import fhtbioinfpy.setup_logger as setup_logger
+import argparse
+import sys
+import json
+import statistics
+import subprocess
+import time
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+DEFAULT_REPEATS = 5
+DEFAULT_TOP_IMPORTS = 5
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--verbose", "-v", help="Whether to print a bunch of output.", action="store_true", default=False)
+    parser.add_argument("--subcommands", help="subcommands to time (default all)", type=str, nargs="+", default=None)
+    parser.add_argument("--repeats", help="number of fresh interpreters started per command", type=int, default=DEFAULT_REPEATS)
+    parser.add_argument("--top_imports", help="number of slowest imports reported per subcommand (0 to skip -X importtime)", type=int, default=DEFAULT_TOP_IMPORTS)
+    parser.add_argument("--output_filepath", help="write the results as JSON to this file", type=str, default=None)
+    return parser
+
+
+# median wall time (s) of starting a fresh interpreter with the command line arguments
+def time_command(cli_args, repeats=DEFAULT_REPEATS):
+    wall_times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-m", "fhtbioinfpy"] + cli_args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        wall_times.append(time.perf_counter() - start)
+    return statistics.median(wall_times)
+
+
+# the top_imports slowest imports (cumulative microseconds) of one run of the command line, from python -X importtime
+def slowest_imports(cli_args, top_imports=DEFAULT_TOP_IMPORTS):
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-m", "fhtbioinfpy"] + cli_args,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    import_times = {}
+    for line in completed.stderr.splitlines():
+        fields = line.split("|")
+        if line.startswith("import time:") and len(fields) == 3 and fields[1].strip().isdigit():
+            # only top-level modules of an import chain: nested ones are part of their parent's cumulative time
+            if not fields[2].startswith("   "):
+                import_times[fields[2].strip()] = int(fields[1])
+    return sorted(import_times.items(), key=lambda item: -item[1])[:top_imports]
+
+
+def run_startup_benchmark(subcommands, repeats=DEFAULT_REPEATS, top_imports=DEFAULT_TOP_IMPORTS):
+    results = {"python": sys.version.split()[0], "repeats": repeats, "help_s": time_command(["--help"], repeats), "subcommands": {}}
+    logger.info("fhtbioinfpy --help: {:.3f}s".format(results["help_s"]))
+    for subcommand in subcommands:
+        subcommand_results = {"help_s": time_command([subcommand, "--help"], repeats)}
+        if top_imports > 0:
+            subcommand_results["slowest_imports_us"] = slowest_imports([subcommand, "--help"], top_imports)
+        results["subcommands"][subcommand] = subcommand_results
+        logger.info("fhtbioinfpy {} --help: {:.3f}s  slowest imports: {}".format(subcommand, subcommand_results["help_s"],
+            subcommand_results.get("slowest_imports_us")))
+    return results
+
+
+def main(args):
+    # the subcommand table is in cli, which imports nothing heavy either
+    import fhtbioinfpy.cli as cli
+    subcommands = [s for s in cli.SUBCOMMANDS if s != "startup-benchmark"] if args.subcommands is None else args.subcommands
+    results = run_startup_benchmark(subcommands, repeats=args.repeats, top_imports=args.top_imports)
+    if args.output_filepath is not None:
+        with open(args.output_filepath, "w") as f:
+            json.dump(results, f, indent=2)
+        logger.info("startup benchmark results: {}".format(args.output_filepath))
+    return results
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args(sys.argv[1:])
+    setup_logger.setup(verbose=args.verbose)
+    logger.debug("args:  {}".format(args))
+
+    main(args)